@@ -0,0 +1,108 @@
+"""
+Fan-out benchmark for :class:`.WebSocketHub`.
+
+This publishes messages to a growing number of subscribed WebSockets, using in-memory transports
+so that only Kyoukai's own overhead is measured. It compares the hub, which encodes each message
+once, against sending to every WebSocket one by one with :meth:`.WebSocket.send`. It runs on both
+the asyncio and uvloop event loops, if uvloop is installed.
+
+Run it with ``python benchmarks/broadcast.py``.
+"""
+import asyncio
+import time
+
+from kyoukai.backends.websocket import WebSocket, WebSocketHub
+from kyoukai.util import new_event_loop
+
+MESSAGE = '{"event": "tick", "value": 12345, "source": "benchmark"}'
+SUBSCRIBER_COUNTS = (10, 100, 1000, 10000, 50000)
+LOOPS = ("asyncio", "uvloop")
+
+
+class BenchTransport(asyncio.Transport):
+    """
+    A transport that counts the bytes written to it, and never has anything buffered.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class BenchProtocol(object):
+    """
+    Just enough of a :class:`.WebSocketProtocol` for a :class:`.WebSocket` to write with.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = BenchTransport()
+
+    def raw_write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        pass
+
+
+def make_subscribers(loop, hub: WebSocketHub, count: int) -> list:
+    websockets = []
+    for _ in range(count):
+        websocket = WebSocket(BenchProtocol(loop), {})
+        websocket.accepted = True
+        hub.subscribe("bench", websocket)
+        websockets.append(websocket)
+
+    return websockets
+
+
+async def send_each(websockets: list):
+    for websocket in websockets:
+        await websocket.send(MESSAGE)
+
+
+def main():
+    for name in LOOPS:
+        if name == "uvloop":
+            try:
+                import uvloop  # noqa
+            except ImportError:
+                print("[uvloop] not installed, skipping")
+                continue
+
+        print("[{}]".format(name))
+        loop = new_event_loop(name)
+        asyncio.set_event_loop(loop)
+        run(loop)
+        loop.close()
+
+
+def run(loop):
+    print("{:>12} {:>20} {:>20}".format("subscribers", "hub writes/sec", "send() writes/sec"))
+    for count in SUBSCRIBER_COUNTS:
+        hub = WebSocketHub()
+        websockets = make_subscribers(loop, hub, count)
+        # Aim for roughly the same number of writes for every subscriber count.
+        rounds = max(1, 200000 // count)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            hub.publish("bench", MESSAGE)
+        hub_rate = rounds * count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            loop.run_until_complete(send_each(websockets))
+        each_rate = rounds * count / (time.perf_counter() - start)
+
+        print("{:>12} {:>20.0f} {:>20.0f}".format(count, hub_rate, each_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+HTTP/2 upload throughput against the initial window size.
+
+This runs the HTTP/2 backend in a separate process for each ``initial_window_size``, and measures
+how fast a client can upload a large request body to it over a real loopback connection. The
+server only opens the flow control windows again as the app reads the body, so with a small window
+the client spends much of its time waiting for a WINDOW_UPDATE.
+
+The client speaks HTTP/2 with prior knowledge, without TLS, so that the encryption doesn't hide
+the difference.
+
+Run it with ``python benchmarks/h2_window.py [megabytes] [delay in ms]``. The delay is added
+before every read from the socket on the client, to stand in for a longer round trip.
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+import warnings
+
+from asphalt.core import Context
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import DataReceived, StreamEnded
+from werkzeug.wrappers import Response
+
+from kyoukai import Kyoukai
+from kyoukai.backends.http2 import H2KyoukaiComponent
+
+PORT = 4461
+WINDOW_SIZES = (65535, 262144, 1048576, 4194304, 16777215)
+
+
+def serve(window_size: int, ready):
+    warnings.simplefilter("ignore")
+    app = Kyoukai("bench")
+
+    @app.route("/", methods=["POST"])
+    async def upload(ctx):
+        body = await ctx.request.environ["wsgi.input"].read_async()
+        return Response(str(len(body)))
+
+    app.finalize()
+    component = H2KyoukaiComponent(app, None, None, initial_window_size=window_size)
+    context = Context()
+    app.loop.run_until_complete(app.loop.create_server(
+        lambda: component.get_protocol(context, ("127.0.0.1", PORT)), "127.0.0.1", PORT
+    ))
+    ready.set()
+    app.loop.run_forever()
+
+
+async def upload(size: int, delay: float) -> float:
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    conn = H2Connection(H2Configuration(client_side=True))
+    conn.initiate_connection()
+    # Let the server's settings arrive first.
+    writer.write(conn.data_to_send())
+    conn.receive_data(await reader.read(65536))
+
+    start = time.perf_counter()
+    conn.send_headers(1, [(":method", "POST"), (":path", "/"), (":scheme", "http"),
+                          (":authority", "localhost")])
+    chunk = b"x" * conn.max_outbound_frame_size
+    sent = 0
+    done = False
+    while not done:
+        while sent < size:
+            length = min(conn.local_flow_control_window(1), len(chunk), size - sent)
+            if length <= 0:
+                break
+            sent += length
+            conn.send_data(1, chunk[:length], end_stream=sent == size)
+            # h2 appends to a bytes object, so take each frame before the next one.
+            writer.write(conn.data_to_send())
+
+        writer.write(conn.data_to_send())
+        if delay:
+            await asyncio.sleep(delay)
+
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+
+        for event in conn.receive_data(data):
+            if isinstance(event, DataReceived):
+                assert int(event.data) == size
+                conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                done = True
+
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return size / elapsed / 1024 / 1024
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 256 * 1024 * 1024
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+
+    print("Uploading {} MiB, with {} ms added to each client read".format(
+        size // 1024 // 1024, delay * 1000))
+    for window_size in WINDOW_SIZES:
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(window_size, ready), daemon=True)
+        server.start()
+        ready.wait(10)
+
+        try:
+            loop = asyncio.new_event_loop()
+            rate = loop.run_until_complete(upload(size, delay))
+            loop.close()
+        finally:
+            server.terminate()
+            server.join()
+
+        print("{:>9} byte window: {:8.1f} MiB/s".format(window_size, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Keep-alive benchmark for the httptools backend.
+
+This feeds requests one after another into a single :class:`.KyoukaiProtocol`, using an in-memory
+transport so that only Kyoukai's own overhead is measured. It reports the throughput, the peak
+memory allocated while handling each request, and the number of memory blocks each request leaves
+allocated, from :func:`sys.getallocatedblocks`. It runs on both the asyncio and uvloop event loops,
+if uvloop is installed.
+
+Python can't count every allocation a request makes, only the blocks left over afterwards, so this
+shows memory that grows with the number of requests rather than allocation churn within each one.
+
+Run it with ``python benchmarks/keepalive.py [requests]``.
+"""
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+
+from asphalt.core import Context
+from werkzeug.wrappers import Response
+
+from kyoukai import Kyoukai, KyoukaiComponent
+from kyoukai.backends.httptools_ import KyoukaiProtocol
+from kyoukai.util import new_event_loop
+
+LOOPS = ("asyncio", "uvloop")
+
+REQUEST = (b"GET / HTTP/1.1\r\n"
+           b"Host: localhost\r\n"
+           b"User-Agent: kyoukai-bench\r\n"
+           b"Accept: */*\r\n"
+           b"Accept-Encoding: gzip, deflate\r\n"
+           b"Connection: keep-alive\r\n"
+           b"\r\n")
+
+
+class BenchTransport(asyncio.Transport):
+    """
+    A transport that discards writes, and wakes the benchmark up once a response is written.
+    """
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.waiter = None
+        self.closed = False
+
+    def write(self, data):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def writelines(self, list_of_data):
+        self.write(b"".join(list_of_data))
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return "127.0.0.1", 12345
+
+        return default
+
+
+def make_protocol(loop) -> (KyoukaiProtocol, BenchTransport):
+    app = Kyoukai("bench", loop=loop)
+
+    @app.route("/")
+    async def index(ctx):
+        return Response("Hello, world!")
+
+    component = KyoukaiComponent(app, "127.0.0.1", 4444)
+    app.finalize()
+
+    protocol = KyoukaiProtocol(component, Context(), "localhost", 4444)
+    transport = BenchTransport(loop)
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+async def send(loop, protocol: KyoukaiProtocol, transport: BenchTransport):
+    transport.waiter = loop.create_future()
+    protocol.data_received(REQUEST)
+    await transport.waiter
+
+
+async def run(loop, count: int):
+    protocol, transport = make_protocol(loop)
+
+    # Warm up, so that caches and lazily imported modules don't count.
+    for _ in range(100):
+        await send(loop, protocol, transport)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        await send(loop, protocol, transport)
+    elapsed = time.perf_counter() - start
+
+    # Collections would free blocks from earlier requests part of the way through.
+    gc.collect()
+    gc.disable()
+    blocks_before = sys.getallocatedblocks()
+    for _ in range(count):
+        await send(loop, protocol, transport)
+    blocks_after = sys.getallocatedblocks()
+    gc.enable()
+
+    tracemalloc.start()
+    peak_total = 0
+    for _ in range(count):
+        current, _ = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        await send(loop, protocol, transport)
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    print("requests:              {}".format(count))
+    print("requests/sec:          {:.0f}".format(count / elapsed))
+    print("peak bytes/request:    {:.0f}".format(peak_total / count))
+    print("blocks left/request:   {:.2f}".format((blocks_after - blocks_before) / count))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for name in LOOPS:
+        if name == "uvloop":
+            try:
+                import uvloop  # noqa
+            except ImportError:
+                print("[uvloop] not installed, skipping")
+                continue
+
+        print("[{}]".format(name))
+        loop = new_event_loop(name)
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(run(loop, count))
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
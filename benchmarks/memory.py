@@ -0,0 +1,85 @@
+"""
+Worker memory benchmark.
+
+This runs the app with several workers, once with the objects created before forking frozen with
+:func:`gc.freeze`, and once without. Every worker then handles requests that run a full garbage
+collection, as a long-running worker eventually would, and the unique set size (USS) of each
+worker is measured. The USS is the memory that isn't shared with the supervisor or other workers.
+
+It needs Linux, for ``/proc``, and Python 3.7+ for :func:`gc.freeze`.
+
+Run it with ``python benchmarks/memory.py [workers]``.
+"""
+import gc
+import http.client
+import os
+import signal
+import sys
+import time
+
+from werkzeug.wrappers import Response
+
+from kyoukai import Kyoukai, KyoukaiComponent
+from kyoukai.workers import WorkerSupervisor, get_uss
+
+PORT = 4459
+
+app = Kyoukai("bench")
+
+# Stands in for everything a real app loads before forking: modules, caches, config.
+STATE = [{"id": i, "name": "item {}".format(i), "tags": ["a", "b"]} for i in range(200000)]
+
+
+@app.route("/")
+async def index(ctx):
+    gc.collect()
+    return Response(str(os.getpid()))
+
+
+def children_of(pid: int) -> list:
+    with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def measure(workers: int, freeze: bool) -> list:
+    pid = os.fork()
+    if pid == 0:
+        component = KyoukaiComponent(app, "127.0.0.1", PORT, gc_freeze=freeze)
+        os._exit(WorkerSupervisor(component, workers).run())
+
+    # Wait for the workers to start, then make sure every one of them has handled requests.
+    seen = set()
+    deadline = time.monotonic() + 30
+    while len(seen) < workers and time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT)
+            conn.request("GET", "/")
+            seen.add(conn.getresponse().read())
+            conn.close()
+        except ConnectionError:
+            time.sleep(0.1)
+
+    usage = [get_uss(child) for child in children_of(pid)]
+
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    return usage
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    if not hasattr(gc, "freeze"):
+        print("gc.freeze needs Python 3.7 or newer.")
+        return
+
+    for freeze in (False, True):
+        usage = measure(workers, freeze)
+        print("gc_freeze={!s:5}  USS per worker: {}  total: {:.1f} MiB".format(
+            freeze,
+            ", ".join("{:.1f} MiB".format(size / 1048576) for size in usage),
+            sum(usage) / 1048576
+        ))
+
+
+if __name__ == "__main__":
+    main()
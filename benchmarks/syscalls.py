@@ -0,0 +1,131 @@
+"""
+Write syscall benchmark for the httptools backend.
+
+This feeds requests into a single :class:`.KyoukaiProtocol` using an in-memory transport, and
+counts the writes the protocol makes to it. On the selector event loops, each write to a transport
+with an empty buffer is one ``send()`` syscall, so this is the number of syscalls the server makes.
+
+Three cases are measured:
+
+  - one request at a time, as a normal keep-alive client sends them
+  - a batch of pipelined requests arriving in a single read
+  - a streamed response, with several small parts produced in the same loop iteration
+
+Run it with ``python benchmarks/syscalls.py [pipeline depth]``.
+"""
+import asyncio
+import sys
+
+from asphalt.core import Context
+from werkzeug.wrappers import Response
+
+from kyoukai import Kyoukai, KyoukaiComponent
+from kyoukai.backends.httptools_ import KyoukaiProtocol
+
+REQUEST = (b"GET / HTTP/1.1\r\n"
+           b"Host: localhost\r\n"
+           b"User-Agent: kyoukai-bench\r\n"
+           b"\r\n")
+
+STREAM_REQUEST = REQUEST.replace(b"GET /", b"GET /stream")
+
+
+class CountingTransport(asyncio.Transport):
+    """
+    A transport that counts the writes made to it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+        self.bytes = 0
+        self.closed = False
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def writelines(self, list_of_data):
+        # The selector transports join these into a single send.
+        self.write(b"".join(list_of_data))
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return "127.0.0.1", 12345
+
+        return default
+
+
+def make_protocol() -> (KyoukaiProtocol, CountingTransport):
+    loop = asyncio.get_event_loop()
+    app = Kyoukai("bench", loop=loop)
+
+    @app.route("/")
+    async def index(ctx):
+        return Response("Hello, world!")
+
+    @app.route("/stream")
+    async def stream(ctx):
+        async def body():
+            for i in range(8):
+                yield "part {}\n".format(i)
+
+        return Response(body())
+
+    component = KyoukaiComponent(app, "127.0.0.1", 4444)
+    app.finalize()
+
+    protocol = KyoukaiProtocol(component, Context(), "localhost", 4444)
+    transport = CountingTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+async def settle():
+    # Let every task and callback scheduled by the requests run.
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+async def run(depth: int):
+    protocol, transport = make_protocol()
+
+    for _ in range(depth):
+        protocol.data_received(REQUEST)
+        await settle()
+    sequential = transport.writes
+
+    transport.writes = 0
+    protocol.data_received(REQUEST * depth)
+    await settle()
+    pipelined = transport.writes
+
+    transport.writes = 0
+    protocol.data_received(STREAM_REQUEST)
+    await settle()
+    streamed = transport.writes
+
+    print("requests per case:          {}".format(depth))
+    print("sequential writes/request:  {:.2f}".format(sequential / depth))
+    print("pipelined writes/request:   {:.2f}".format(pipelined / depth))
+    print("streamed response writes:   {}".format(streamed))
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(run(depth))
+
+
+if __name__ == "__main__":
+    main()
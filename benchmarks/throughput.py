@@ -0,0 +1,92 @@
+"""
+Socket throughput benchmark for the built-in server.
+
+This runs the server in a separate process, on each event loop in turn, and measures how many
+requests per second it serves over real loopback connections. Each client connection sends one
+keep-alive request at a time.
+
+Run it with ``python benchmarks/throughput.py [connections] [seconds]``.
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from werkzeug.wrappers import Response
+
+from kyoukai import Kyoukai
+from kyoukai.util import new_event_loop
+
+PORT = 4460
+LOOPS = ("asyncio", "uvloop")
+
+REQUEST = (b"GET / HTTP/1.1\r\n"
+           b"Host: localhost\r\n"
+           b"User-Agent: kyoukai-bench\r\n"
+           b"\r\n")
+
+
+def serve(loop_name: str, ready):
+    loop = new_event_loop(loop_name)
+    asyncio.set_event_loop(loop)
+    app = Kyoukai("bench", loop=loop)
+
+    @app.route("/")
+    async def index(ctx):
+        return Response("Hello, world!")
+
+    app.loop.run_until_complete(app.start("127.0.0.1", PORT))
+    ready.set()
+    app.loop.run_forever()
+
+
+async def client(deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    count = 0
+    while time.perf_counter() < deadline:
+        writer.write(REQUEST)
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+        await reader.readexactly(length)
+        count += 1
+
+    writer.close()
+    return count
+
+
+async def load(connections: int, seconds: float) -> float:
+    start = time.perf_counter()
+    counts = await asyncio.gather(*[client(start + seconds) for _ in range(connections)])
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    for name in LOOPS:
+        if name == "uvloop":
+            try:
+                import uvloop  # noqa
+            except ImportError:
+                print("{:>8}: not installed, skipping".format(name))
+                continue
+
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(name, ready), daemon=True)
+        server.start()
+        ready.wait(10)
+
+        try:
+            loop = asyncio.new_event_loop()
+            rate = loop.run_until_complete(load(connections, seconds))
+            loop.close()
+        finally:
+            server.terminate()
+            server.join()
+
+        print("{:>8}: {:.0f} requests/sec".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
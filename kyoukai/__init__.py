@@ -12,8 +12,10 @@ Kyoukai is an async web framework for Python 3.5 and above.
     blueprint
     route
     routegroup
+    sse
     testing
     util
+    workers
 """
 import json
 
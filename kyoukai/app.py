@@ -13,7 +13,9 @@ from werkzeug.routing import RequestRedirect, Map
 from werkzeug.wrappers import Request, Response
 
 from kyoukai.asphalt import HTTPRequestContext
+from kyoukai.backends.websocket import WebSocketHub
 from kyoukai.blueprint import Blueprint
+from kyoukai.wsgi import is_streaming_response
 
 __version__ = "2.2.1.post1"
 version_format = "Kyoukai/{}".format(__version__)
@@ -86,7 +88,9 @@ class Kyoukai(object):
             environment created for ``url_for``, if applicable.
         
         :param loop: Keyword-only. The asyncio event loop to use for this app. If no loop is \ 
-            specified it, will be automatically fetched using :meth:`asyncio.get_event_loop`.
+            specified it, will be automatically fetched using :meth:`asyncio.get_event_loop`, and \
+            replaced with the loop the component is started on. If a loop is specified, the \
+            component must be started on that loop.
         
         :param request_class: Keyword-only. The custom request class to instantiate requests with.
         :param response_class: Keyword-only. The custom response class to instantiate responses \ 
@@ -101,6 +105,8 @@ class Kyoukai(object):
         # Try and get the loop from the keyword arguments - don't automatically perform
         # `get_event_loop`.
         self.loop = kwargs.pop("loop", None)
+        # Without a loop of its own, the app runs on whichever loop its component is started on.
+        self._own_loop = self.loop is not None
         if not self.loop:
             self.loop = asyncio.get_event_loop()
 
@@ -121,6 +127,9 @@ class Kyoukai(object):
         # Is this app set to debug mode?
         self.debug = False
 
+        #: The :class:`~.WebSocketHub` for broadcasting to WebSockets.
+        self.hub = WebSocketHub()
+
         # Any extra config.
         self.config = kwargs
 
@@ -240,7 +249,7 @@ class Kyoukai(object):
                            .format(error_handler.callable_repr, result.status_code,
                                    exception.code))
 
-            return result
+        return result
 
     async def process_request(self, request: Request, parent_context: Context) -> Response:
         """
@@ -339,7 +348,9 @@ class Kyoukai(object):
             result.headers["Server"] = version_format
 
             # list means wsgi response probably
-            if not isinstance(result.response, (bytes, str, list)):
+            # async iterables are streamed by the backend instead
+            if not isinstance(result.response, (bytes, str, list)) \
+                    and not is_streaming_response(result):
                 result.set_data(str(result.response))
 
             result.headers["X-Powered-By"] = version_format
@@ -375,15 +386,32 @@ class Kyoukai(object):
         await self.component.start(base_context)
 
     def run(self, ip: str = "127.0.0.1", port: int = 4444, *,
-            component=None):
+            component=None, workers: int = None, event_loop_policy: str = None):
         """
         Runs the Kyoukai server from within your code.
 
         This is not normally invoked - instead Asphalt should invoke the Kyoukai component.
         However, this is here for convenience.
+
+        :param workers: The number of worker processes to fork. Each worker accepts from its own \
+            socket, bound with ``SO_REUSEPORT``. Defaults to the component's ``workers`` option, \
+            or 1.
+        :param event_loop_policy: The event loop policy to run with, as with asphalt's own \
+            ``event_loop_policy`` option; for example, ``"uvloop"``. Defaults to the component's \
+            ``event_loop_policy`` option.
         """
         if not component:
             from kyoukai.asphalt import KyoukaiComponent
             component = KyoukaiComponent(self, ip, port)
 
-        run_application(component)
+        if workers is None:
+            workers = component.cfg.get("workers", 1)
+
+        if event_loop_policy is None:
+            event_loop_policy = component.cfg.get("event_loop_policy")
+
+        if workers > 1:
+            from kyoukai.workers import run_workers
+            run_workers(component, workers, event_loop_policy=event_loop_policy)
+        else:
+            run_application(component, event_loop_policy=event_loop_policy)
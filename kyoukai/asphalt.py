@@ -2,10 +2,13 @@
 Asphalt wrappers for Kyoukai.
 """
 import abc
+import asyncio
 import importlib
+import inspect
 import logging
 import socket
 import ssl as py_ssl
+import typing
 from functools import partial
 
 from asphalt.core import resolve_reference, Context
@@ -16,6 +19,33 @@ from werkzeug.wrappers import Request, Response
 
 from kyoukai.blueprint import Blueprint
 from kyoukai.route import Route
+from kyoukai.util import socket_from_fd
+
+#: The default cipher list for TLS 1.2 and older.
+DEFAULT_CIPHERS = (
+    "ECDH+CHACHA20:"                        # CHACHA20 for newer openssl
+    "ECDH+AES128:RSA+AES128:"               # Standard AES
+    "ECDH+AES256:RSA+AES256:"               # Slower AES
+    "ECDH+3DES:RSA+3DES:"                   # 3DES for older systems
+    "!aNULL:!eNULL:!MD5:!DSS:!RC4"          # Disable insecure ciphers
+)
+
+# SSL_OP_PRIORITIZE_CHACHA from OpenSSL 1.1.1, which the ssl module doesn't export. With server
+# cipher preference, this picks ChaCha20 if it is the client's first choice.
+OP_PRIORITIZE_CHACHA = 0x00200000
+
+
+def _keep_unix_socket(loop: asyncio.AbstractEventLoop) -> dict:
+    """
+    Gets the arguments that stop a Unix server from removing its socket file when it's closed,
+    which newer versions of asyncio do by default.
+    """
+    try:
+        parameters = inspect.signature(loop.create_unix_server).parameters
+    except (TypeError, ValueError):
+        return {}
+
+    return {"cleanup_socket": False} if "cleanup_socket" in parameters else {}
 
 
 # Asphalt events.
@@ -105,8 +135,13 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
         self.cfg = cfg
 
         #: The :class:`asyncio.Server` instance that is serving us today.
+        #: With several listeners, this is the first one. This is None while accepting connections
+        #: is paused.
         self.server = None
 
+        #: The :class:`asyncio.Server` instances for every listener, while accepting connections.
+        self.servers = []
+
         #: The base context for this server.
         self.base_context = None  # type: Context
 
@@ -117,6 +152,46 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
 
         self._server_name = app.server_name or socket.getfqdn()
 
+        #: The protocols for every connection that is currently open.
+        self.connections = set()
+
+        #: The highest number of connections that have been open at once.
+        self.peak_connections = 0
+
+        #: The maximum number of concurrent connections, or None for no limit.
+        #: Once this is reached, the server stops accepting new connections until the number of
+        #: open connections drops to :attr:`max_connections_low_water`.
+        self.max_connections = self.cfg.get("max_connections", None)
+
+        #: The number of open connections at which the server starts accepting again.
+        self.max_connections_low_water = self.cfg.get("max_connections_low_water", None)
+        if self.max_connections is not None and self.max_connections_low_water is None:
+            self.max_connections_low_water = int(self.max_connections * 0.9)
+
+        # The (protocol factory, SSL context, unix, sockets) for every listener, used to resume
+        # accepting. The sockets are copies of the listening sockets, which stay open while the
+        # servers are closed.
+        self._serve_args = []
+        self._accepting_paused = False
+        self._resume_task = None  # type: asyncio.Task
+        # Servers closed by pausing, which are waited on when shutting down.
+        self._closed_servers = []
+
+        #: The number of this worker process, when running with several workers. Otherwise, None.
+        self.worker = None
+
+        #: The number of seconds :meth:`shutdown` waits for open connections to finish.
+        self.shutdown_timeout = self.cfg.get("shutdown_timeout", 30)
+
+        self._shutting_down = False
+        self._drained = None  # type: asyncio.Event
+
+        #: The number of TLS connections that needed a full handshake.
+        self.tls_full_handshakes = 0
+
+        #: The number of TLS connections that resumed a previous session.
+        self.tls_resumed_sessions = 0
+
     @abc.abstractmethod
     async def start(self, ctx: Context):
         """
@@ -129,6 +204,131 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
         """
         return self.app.server_name or self._server_name
 
+    def get_listeners(self) -> typing.List[dict]:
+        """
+        Gets the listeners this server should listen on, from the ``listeners`` option.
+
+        Each listener is a dict, which is one of:
+
+            - ``{"host": "0.0.0.0", "port": 4444}`` for a TCP socket.
+            - ``{"path": "/run/kyoukai.sock"}`` for a Unix domain socket.
+            - ``{"fd": 3}`` for an already listening socket inherited from the parent process.
+
+        :return: The listeners. If none are configured, this is a single TCP listener on the \
+            component's IP and port.
+        """
+        return self.cfg.get("listeners") or [{"host": self.ip, "port": self.port}]
+
+    async def start_listeners(self, ctx: Context, ssl_context: py_ssl.SSLContext = None):
+        """
+        Starts a server for every listener from :meth:`get_listeners`.
+
+        :param ctx: The base context for new connections.
+        :param ssl_context: The SSL context to wrap connections with, if any.
+        """
+        loop = asyncio.get_event_loop()
+        if self.app.loop is not loop:
+            if self.app._own_loop:
+                raise RuntimeError("The app was created with a different event loop to the one "
+                                   "the component is being started on")
+
+            # The app may have been created before the loop that runs it, for example when
+            # asphalt's event_loop_policy option replaced the loop after the app's module was
+            # imported.
+            self.app.loop = loop
+
+        for listener in self.get_listeners():
+            if "fd" in listener:
+                sock = socket_from_fd(int(listener["fd"]))
+                unix = sock.family == getattr(socket, "AF_UNIX", None)
+                port = self.port if unix else sock.getsockname()[1]
+                description = "fd {}".format(listener["fd"])
+                kwargs = {"sock": sock}
+            elif "path" in listener:
+                unix = True
+                port = self.port
+                description = listener["path"]
+                kwargs = {"path": listener["path"]}
+            else:
+                unix = False
+                host, port = listener.get("host", self.ip), listener.get("port", self.port)
+                description = "{}:{}".format(host, port)
+                kwargs = {"host": host, "port": port,
+                          "reuse_port": self.cfg.get("reuse_port", None)}
+
+            protocol = partial(self.get_protocol, ctx, (self._server_name, port))
+            if unix:
+                if self.max_connections is not None:
+                    kwargs.update(_keep_unix_socket(loop))
+                server = await loop.create_unix_server(protocol, ssl=ssl_context, **kwargs)
+            else:
+                server = await loop.create_server(protocol, ssl=ssl_context, **kwargs)
+
+            self.servers.append(server)
+            if self.max_connections is not None:
+                # Pausing closes the server, which closes its sockets, so keep copies of them to
+                # serve from again.
+                sockets = [socket.fromfd(sock.fileno(), sock.family, sock.type)
+                           for sock in server.sockets]
+                self._serve_args.append((protocol, ssl_context, unix, sockets))
+            self.logger.info("Kyoukai serving on {}.".format(description))
+
+        self.server = self.servers[0]
+
+        # Drain connections when the context is closed, e.g. by the asphalt runner on SIGTERM.
+        if hasattr(ctx, "add_teardown_callback"):
+            ctx.add_teardown_callback(self.shutdown)
+        else:
+            # asphalt 2.x
+            ctx.finished.connect(lambda event: self.shutdown())
+
+    async def shutdown(self):
+        """
+        Gracefully shuts the server down.
+
+        This stops accepting new connections, and asks every open connection to close once it has
+        finished with the requests it has already received. Idle keep-alive connections are closed
+        straight away, and HTTP/2 connections are sent a GOAWAY.
+
+        Connections still open after :attr:`shutdown_timeout` seconds are closed regardless.
+        """
+        if self._shutting_down:
+            return
+
+        self._shutting_down = True
+        self._drained = asyncio.Event()
+
+        if self._resume_task is not None:
+            # Let it finish, so that the servers it starts are closed along with the others.
+            await asyncio.wait([self._resume_task])
+
+        for server in self.servers:
+            server.close()
+
+        for _, _, _, sockets in self._serve_args:
+            for sock in sockets:
+                sock.close()
+
+        self.logger.info("Shutting down, waiting for {} connection(s) to finish."
+                         .format(len(self.connections)))
+        for protocol in list(self.connections):
+            protocol.shutdown()
+
+        if self.connections:
+            try:
+                await asyncio.wait_for(self._drained.wait(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning("{} connection(s) still open after {} seconds, closing them."
+                                    .format(len(self.connections), self.shutdown_timeout))
+                for protocol in list(self.connections):
+                    protocol.transport.abort()
+
+                # Let connection_lost run for every aborted connection.
+                await asyncio.sleep(0)
+
+        for server in self._closed_servers + self.servers:
+            await server.wait_closed()
+
     def get_protocol(self, ctx: Context, serv_info: tuple):
         """
         Gets the protocol to use for this webserver.
@@ -142,6 +342,143 @@ class KyoukaiBaseComponent(Component, metaclass=abc.ABCMeta):  # pragma: no cove
         ctx.protocol = proto
         return proto
 
+    def get_metrics(self) -> dict:
+        """
+        :return: A dict of statistics about this server, suitable for exporting to a monitoring \
+            system.
+        """
+        return {
+            "connections": len(self.connections),
+            "peak_connections": self.peak_connections,
+            "accepting": not self._accepting_paused,
+            "tls_full_handshakes": self.tls_full_handshakes,
+            "tls_resumed_sessions": self.tls_resumed_sessions,
+        }
+
+    def track_connection(self, protocol) -> bool:
+        """
+        Called by a protocol when a new connection is made.
+
+        :param protocol: The protocol handling the new connection.
+        :return: False if the connection is over the connection limit and should be closed.
+        """
+        if protocol in self.connections:
+            # Protocols that replace themselves, such as for HTTP/2, are still the same connection.
+            return True
+
+        if self._shutting_down:
+            # Accepted just before the listening sockets were closed.
+            return False
+
+        self._count_handshake(protocol.transport)
+        self.connections.add(protocol)
+        count = len(self.connections)
+        if count > self.peak_connections:
+            self.peak_connections = count
+
+        if self.max_connections is None or count < self.max_connections:
+            return True
+
+        if self._accepting_paused:
+            # These were accepted in the same batch as the connection that hit the limit.
+            return True
+
+        if not self._can_pause_accepting():
+            # We can't apply backpressure to the listening socket, so drop the connection instead.
+            if count > self.max_connections:
+                self.connections.discard(protocol)
+                return False
+
+            return True
+
+        self.logger.warning("Connection limit of {} reached, no longer accepting connections."
+                            .format(self.max_connections))
+        self._pause_accepting()
+        return True
+
+    def _count_handshake(self, transport: asyncio.BaseTransport):
+        """
+        Counts the TLS handshake of a new connection, if it is over TLS.
+        """
+        ssl_object = transport.get_extra_info("ssl_object")
+        if ssl_object is None:
+            return
+
+        if ssl_object.session_reused:
+            self.tls_resumed_sessions += 1
+        else:
+            self.tls_full_handshakes += 1
+
+    def untrack_connection(self, protocol):
+        """
+        Called by a protocol when a connection is lost.
+
+        :param protocol: The protocol that was handling the connection.
+        """
+        self.connections.discard(protocol)
+        if self._shutting_down:
+            if not self.connections:
+                self._drained.set()
+            return
+
+        if self._accepting_paused and self._resume_task is None and \
+                len(self.connections) <= self.max_connections_low_water:
+            self.logger.info("Connection count has dropped to {}, accepting connections again."
+                             .format(len(self.connections)))
+            self._resume_task = self.app.loop.create_task(self._resume_accepting())
+
+    def _can_pause_accepting(self) -> bool:
+        """
+        :return: If the listening sockets of this server can be paused.
+        """
+        return bool(self._serve_args)
+
+    def _pause_accepting(self):
+        """
+        Stops accepting new connections on the listening sockets.
+
+        This closes the servers, but the listening sockets stay open through the copies kept of
+        them, so pending connections are left in the kernel's listen backlog until accepting
+        resumes.
+        """
+        for server in self.servers:
+            server.close()
+
+        self._closed_servers.extend(self.servers)
+        self.servers = []
+        self.server = None
+        self._accepting_paused = True
+
+    async def _resume_accepting(self):
+        """
+        Starts accepting new connections on the listening sockets again, with a new server for
+        each of them.
+        """
+        loop = self.app.loop
+        servers = []
+        try:
+            for factory, ssl_context, unix, sockets in self._serve_args:
+                for sock in sockets:
+                    # The new server closes the socket it's given, so it gets its own copy too.
+                    kwargs = {"sock": socket.fromfd(sock.fileno(), sock.family, sock.type),
+                              "ssl": ssl_context}
+                    if unix:
+                        kwargs.update(_keep_unix_socket(loop))
+                        servers.append(await loop.create_unix_server(factory, **kwargs))
+                    else:
+                        servers.append(await loop.create_server(factory, **kwargs))
+        except BaseException:
+            for server in servers:
+                server.close()
+            self._closed_servers.extend(servers)
+            raise
+        finally:
+            self._resume_task = None
+
+        self.servers = servers
+        self.server = servers[0]
+        self._accepting_paused = False
+
 
 class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
     """
@@ -167,6 +504,12 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
         :param ip: If using the built-in HTTP server, the IP to bind to.
         :param port: If using the built-in HTTP server, the port to bind to.
         :param cfg: Additional configuration.
+            ``max_connections`` caps the number of concurrent connections, and \
+            ``max_connections_low_water`` sets when accepting resumes (90% of the cap by default). \
+            ``workers`` sets the number of worker processes :meth:`.Kyoukai.run` forks, and \
+            ``event_loop_policy`` the event loop policy it runs with, such as ``"uvloop"``. \
+            ``listeners`` replaces the IP and port with several listeners; see \
+            :meth:`~.KyoukaiBaseComponent.get_listeners`.
         """
         super().__init__(app, ip, port, **cfg)
 
@@ -175,12 +518,65 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
         for key, value in cfg.items():
             setattr(self, key, value)
 
+        self._ssl_context = None  # type: py_ssl.SSLContext
+
     def get_server_name(self):
         """
         :return: The server name of this app.
         """
         return self.app.server_name or self._server_name
 
+    def get_ssl_context(self) -> typing.Optional[py_ssl.SSLContext]:
+        """
+        Gets the SSL context for the server, creating it from the ``ssl`` config the first time.
+
+        With several workers, this is called before forking, so every worker shares the same
+        session ticket keys and can resume sessions started on any other worker.
+
+        :return: The SSL context, or None if TLS is not enabled.
+        """
+        if self._ssl_context is not None:
+            return self._ssl_context
+
+        ssl = self.cfg.get("ssl", {})
+        if not ssl or ssl.get("enabled") is not True:
+            return None
+
+        ssl_context = py_ssl.create_default_context(py_ssl.Purpose.CLIENT_AUTH)
+        # override the ciphers
+        ssl_context.set_ciphers(ssl.get("ciphers", DEFAULT_CIPHERS))
+        ssl_context.load_cert_chain(certfile=ssl["ssl_certfile"],
+                                    keyfile=ssl["ssl_keyfile"])
+
+        if ssl.get("prefer_chacha20", False):
+            if py_ssl.OPENSSL_VERSION_INFO >= (1, 1, 1):
+                ssl_context.options |= py_ssl.OP_CIPHER_SERVER_PREFERENCE | OP_PRIORITIZE_CHACHA
+            else:
+                self.logger.warning("prefer_chacha20 needs OpenSSL 1.1.1 or newer, ignoring it.")
+
+        if "ecdh_curve" in ssl:
+            # The ssl module can only set a single curve, which replaces OpenSSL's defaults.
+            ssl_context.set_ecdh_curve(ssl["ecdh_curve"])
+
+        # Sessions are resumed from OpenSSL's built-in session cache, or from session tickets.
+        if not ssl.get("session_tickets", True):
+            ssl_context.options |= py_ssl.OP_NO_TICKET
+        elif "num_tickets" in ssl and hasattr(ssl_context, "num_tickets"):
+            # TLS 1.3 only, and Python 3.8+.
+            ssl_context.num_tickets = ssl["num_tickets"]
+
+        if self.cfg.get("http2", False) is True:
+            ssl_context.set_alpn_protocols(["h2"])
+
+            try:
+                ssl_context.set_npn_protocols(["h2"])
+            except NotImplementedError:
+                # NPN protocol doesn't work here, so don't bother setting it
+                pass
+
+        self._ssl_context = ssl_context
+        return ssl_context
+
     async def start(self, ctx: Context):
         """
         Starts the webserver if required.
@@ -189,39 +585,17 @@ class KyoukaiComponent(KyoukaiBaseComponent):  # pragma: no cover
         """
         self.base_context = ctx
 
-        ssl_context = None
-
-        if self.cfg.get("ssl", {}):
-            ssl = self.cfg["ssl"]
-            if ssl.get("enabled") is True:
-                ssl_context = py_ssl.create_default_context(py_ssl.Purpose.CLIENT_AUTH)
-                # override the ciphers
-                ssl_context.set_ciphers(
-                    "ECDH+CHACHA20:ECDH+CHACHA20:"         # CHACHA20 for newer openssl
-                    "ECDH+AES128:RSA+AES128:"              # Standard AES
-                    "ECDH+AES256:RSA+AES256:"              # Slower AES
-                    "ECDH+3DES:RSA+3DES:"                  # 3DES for older systems
-                    "!aNULL:!eNULL:!MD5:!DSS:!RC4")        # Disable insecure ciphers
-                ssl_context.load_cert_chain(certfile=ssl["ssl_certfile"],
-                                            keyfile=ssl["ssl_keyfile"])
-
-                if self.cfg.get("http2", False) is True:
-                    ssl_context.set_alpn_protocols(["h2"])
-
-                    try:
-                        ssl_context.set_npn_protocols(["h2"])
-                    except NotImplementedError:
-                        # NPN protocol doesn't work here, so don't bother setting it
-                        pass
-
-                self.logger.info("Using HTTP over TLS.")
+        ssl_context = self.get_ssl_context()
+        if ssl_context is not None:
+            self.logger.info("Using HTTP over TLS.")
+
+        if self.cfg.get("workers", 1) > 1 and self.worker is None:
+            self.logger.warning("The workers option only applies when running with "
+                                "Kyoukai.run(). Serving from a single process.")
 
         if self.cfg.get("run_server", True) is True:
-            protocol = partial(self.get_protocol, ctx, (self._server_name, self.port))
             self.app.finalize()
-            self.server = await self.app.loop.create_server(protocol, self.ip, self.port,
-                                                            ssl=ssl_context)
-            self.logger.info("Kyoukai serving on {}:{}.".format(self.ip, self.port))
+            await self.start_listeners(ctx, ssl_context)
 
 
 class HTTPRequestContext(Context):
@@ -259,6 +633,38 @@ class HTTPRequestContext(Context):
         #: The :class:`asyncio.Protocol` protocol handling this connection.
         self.proto = None
 
+        #: The :class:`~.WebSocket` for this request, if it is a WebSocket upgrade request.
+        #: This is None for normal requests.
+        self.websocket = self.environ.get("kyoukai.websocket")
+
+    def push(self, path: str,
+             headers: typing.Union[dict, typing.List[typing.Tuple[str, str]]] = None) -> bool:
+        """
+        Pushes a resource to the client along with the response to this request, using HTTP/2
+        server push.
+
+        The pushed resource is requested with a GET, which the app processes like any other
+        request. This must be called before the route returns.
+
+        .. code-block:: python
+
+            @app.route("/")
+            async def index(ctx: HTTPRequestContext):
+                ctx.push("/static/style.css")
+                return render_index()
+
+        :param path: The path of the resource to push.
+        :param headers: Any extra headers for the pushed request, such as ``Accept``.
+        :return: True if the resource will be pushed. This is False for connections that aren't \
+            HTTP/2, if the client has disabled pushes, or if the connection has used up its \
+            ``max_pushes``.
+        """
+        push = self.environ.get("kyoukai.push")
+        if push is None:
+            return False
+
+        return push(path, headers)
+
     def url_for(self, endpoint: str, *, method: str = None, **kwargs):
         """
         A context-local version of ``url_for``.
@@ -8,5 +8,7 @@ Various backends that interface with the Kyoukai application.
     
     httptools_
     http2
+    priority
+    websocket
 
 """
@@ -6,7 +6,6 @@ to the authors of this page.
 
 This server has some notable pitfalls:
 
-    - It ignores any priority data that is sent by the client.
     - It is not paticularly fast (unbenchmarked, but it can be assumed to be slower than the httptools backend.)
     - It does not fully implement all events.
 
@@ -27,17 +26,28 @@ from h2.config import H2Configuration
 from h2.connection import H2Connection
 from h2.errors import ErrorCodes
 from h2.events import (
-    DataReceived, RequestReceived, WindowUpdated, StreamEnded
+    DataReceived, RequestReceived, WindowUpdated, StreamEnded, StreamReset, PriorityUpdated,
+    RemoteSettingsChanged
 )
 from h2.exceptions import ProtocolError
+from h2.settings import Settings, SettingCodes
+from hyperframe.frame import GoAwayFrame
 from werkzeug.datastructures import MultiDict
 from werkzeug.wrappers import Request, Response
 
 from kyoukai.asphalt import KyoukaiBaseComponent
+from kyoukai.backends.priority import PriorityTree
+from kyoukai.wsgi import is_streaming_response
 
 # Sentinel value for the request being complete.
 REQUEST_FINISHED = object()
 
+# The highest number of concurrent streams HTTP/2 allows.
+MAX_STREAMS_LIMIT = 2 ** 31 - 1
+
+# The largest a flow control window can be.
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+
 
 def get_header(headers: typing.List[typing.Tuple[str, str]], name: str) -> str:
     """
@@ -113,19 +123,85 @@ class H2State:
 
         self.headers = headers
 
-        # The queue of data.
-        # This is a deque as reading from here is implicitly async.
-        self.body = asyncio.Queue()
+        # The body chunks received and not yet read, oldest first, and how much of the first
+        # chunk has already been read.
+        self._chunks = collections.deque()  # type: typing.Deque[bytes]
+        self._offset = 0
+        # The number of body bytes received but not yet read by the app.
+        # The client's flow control window is only opened again as they are read.
+        self.buffered = 0
+        # If the client has sent all of the body.
+        self.finished = False
+        # The future an async read is waiting on for more data.
+        self._waiter = None  # type: asyncio.Future
+
+        # The WSGI environment of the request.
+        self.environ = None  # type: MultiDict
 
         # The data to emit.
         self._emit_headers = None
         self._emit_status = None
+        # If the response body is produced asynchronously.
+        self.streamed = False
+        # The number of bytes of the response body waiting to be sent.
+        self.queued = 0
+        # The future the body is waiting on for the queued data to be sent.
+        self._drain_waiter = None  # type: asyncio.Future
 
     def insert_data(self, data: bytes):
         """
         Writes data from the stream into the body.
+
+        :param data: The data, or ``REQUEST_FINISHED`` once the body is complete.
         """
-        self.body.put_nowait(data)
+        if data is REQUEST_FINISHED:
+            self.finished = True
+        elif data:
+            self._chunks.append(data)
+            self.buffered += len(data)
+        else:
+            return
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _consumed(self, size: int):
+        # Hands the space used by body data the app has read back to the client.
+        size = min(size, self.buffered)
+        if size > 0:
+            self.buffered -= size
+            self._protocol.acknowledge_data(self.stream_id, size)
+
+    def _take(self, size: int = -1) -> typing.List[typing.Union[bytes, memoryview]]:
+        # Removes up to ``size`` bytes from the front of the buffer, without copying them.
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+
+        taken = []
+        remaining = size
+        while remaining:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available > remaining:
+                taken.append(memoryview(chunk)[self._offset:self._offset + remaining])
+                self._offset += remaining
+                break
+
+            taken.append(memoryview(chunk)[self._offset:] if self._offset else chunk)
+            self._chunks.popleft()
+            self._offset = 0
+            remaining -= available
+
+        self._consumed(size)
+        return taken
+
+    async def _wait(self):
+        # Waits for more data, or the end of the body.
+        self._waiter = self._protocol.component.app.loop.create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
 
     async def read_async(self, to_end=True):
         """
@@ -137,58 +213,92 @@ class H2State:
         :param to_end: If ``to_end`` is specified, then read until the end of the request.
             Otherwise, it will read one data chunk.
         """
-        data = b""
-        if to_end:
-            while True:
-                d = await self.body.get()
-                if d == REQUEST_FINISHED:
-                    break
-                data += d
-        else:
-            d = await self.body.get()
-            if not d == REQUEST_FINISHED:
-                data += d
+        if not to_end:
+            while not self._chunks and not self.finished:
+                await self._wait()
+
+            return self.get_chunk()
+
+        # Take the data as it arrives, so that the client can keep sending.
+        pieces = []
+        while True:
+            pieces.extend(self._take())
+            if self.finished:
+                break
+            await self._wait()
 
-        return data
+        return b"".join(pieces)
 
     def read(self, size: int = -1) -> bytes:
         """
-        Reads data from the request until it's all done.
+        Reads data that has been received from the request body, without waiting for more.
+
+        :param size: The maximum amount of data to receive. If this is negative, all of the data
+            received so far is read.
+        """
+        pieces = self._take(size)
+        if len(pieces) == 1 and isinstance(pieces[0], bytes):
+            return pieces[0]
+
+        return b"".join(pieces)
+
+    def readinto(self, buffer) -> int:
+        """
+        Reads data that has been received from the request body into a writable buffer.
+
+        :param buffer: The buffer to fill, such as a :class:`bytearray`.
+        :return: The number of bytes read.
+        """
+        view = memoryview(buffer).cast("B")
+        position = 0
+        for piece in self._take(len(view)):
+            view[position:position + len(piece)] = piece
+            position += len(piece)
+
+        return position
+
+    def readline(self, size: int = -1) -> bytes:
+        """
+        Reads a line that has been received from the request body, including the newline.
 
         :param size: The maximum amount of data to receive.
         """
-        # Thanks h2 docs page for the chunking inspiration
-        # However, we're lazy and just shove it back on the front of the queue when we're done
-        curr_data = b""
-        while size < 0 or len(curr_data) < size:
-            # size < 0 means read until we can't
-            # b''.join is probably faster.
-            try:
-                curr_data += self.body.get_nowait()
-            except asyncio.QueueEmpty:
-                # no more data left to pop
+        length = 0
+        offset = self._offset
+        for chunk in self._chunks:
+            index = chunk.find(b"\n", offset)
+            if index >= 0:
+                length += index + 1 - offset
                 break
 
-        # Get rid of any excess data.
-        d = curr_data[:size]
-        if len(curr_data) != len(d):
-            # we have data left to read, so place it back on the left of the deque.
-            self.body._queue.appendleft(curr_data[size:])
+            length += len(chunk) - offset
+            offset = 0
 
-        return d
+        if 0 <= size < length:
+            length = size
+
+        return self.read(length)
+
+    def readable(self) -> bool:
+        return True
+
+    def discard(self):
+        """
+        Throws away the rest of the body, once nothing is going to read it.
+
+        Reads that are waiting for more data return what they have.
+        """
+        self._take()
+        self.insert_data(REQUEST_FINISHED)
 
     def get_chunk(self) -> bytes:
         """
         Gets a chunk of data from the queue.
         """
-        try:
-            d = self.body.get_nowait()
-            if d == REQUEST_FINISHED:
-                return b""
-        except asyncio.QueueEmpty:
+        if not self._chunks:
             return b""
 
-        return d
+        return bytes(self._take(len(self._chunks[0]) - self._offset)[0])
 
     def start_response(self, status: str, headers: typing.List[typing.Tuple[str, str]],
                        exc_info=None):
@@ -217,7 +327,11 @@ class H2State:
         return self
 
     def __next__(self):
-        return self.get_chunk()
+        chunk = self.get_chunk()
+        if not chunk:
+            raise StopIteration
+
+        return chunk
 
 
 class H2KyoukaiComponent(KyoukaiBaseComponent):
@@ -225,15 +339,19 @@ class H2KyoukaiComponent(KyoukaiBaseComponent):
     A component subclass that creates H2KyoukaiProtocol instances.
     """
     def __init__(self, app, ssl_keyfile: str, ssl_certfile: str,
-                 *, ip: str="127.0.0.1", port: int=4444):
+                 *, ip: str="127.0.0.1", port: int=4444, **cfg):
         """
         Creates a new HTTP/2 SSL-based context.
 
         This will use the HTTP/2 protocol, disabling HTTP/1.1 support for this port. It is possible
         to run two ervers side-by-side, one HTTP/2 and one HTTP/1.1, if you run them on
         different ports.
+
+        The rest of the config is the same as :class:`.KyoukaiComponent`, including the HTTP/2
+        settings (``max_concurrent_streams``, ``initial_window_size``, ``max_frame_size`` and
+        ``header_table_size``).
         """
-        super().__init__(app, ip, port)
+        super().__init__(app, ip, port, **cfg)
 
         self.ssl_keyfile = ssl_keyfile
         self.ssl_certfile = ssl_certfile
@@ -256,18 +374,54 @@ class H2KyoukaiComponent(KyoukaiBaseComponent):
             # NPN protocol doesn't work here, so don't bother setting it
             pass
 
-        protocol = partial(self.get_protocol, ctx, (self._server_name, self.port))
         self.app.finalize()
-        self.server = await self.app.loop.create_server(protocol, self.ip, self.port,
-                                                        ssl=ssl_context)
-        self.logger.info("Kyoukai H2 serving on {}:{}".format(self.ip, self.port))
+        await self.start_listeners(ctx, ssl_context)
+
+
+class _ServerSettings(Settings):
+    """
+    The local settings of a server connection.
+
+    h2 treats a client opening more streams than ``MAX_CONCURRENT_STREAMS`` as an error on the
+    whole connection. The limit is still sent to the client, but h2 is told there is none, and the
+    extra streams are refused in ``request_received`` instead, which the client can retry.
+
+    h2 reads the limit it enforces from this property, which is why h2 is pinned to 3.0.x.
+    """
+
+    @property
+    def max_concurrent_streams(self) -> int:
+        return MAX_STREAMS_LIMIT
 
 
 class H2KyoukaiProtocol(asyncio.Protocol):
     """
     The base protocol for Kyoukai, using H2.
+
+    Responses are sent by a single writer for the whole connection. Each time it runs, it picks
+    frames from the streams with data ready by their priority, within the flow control windows,
+    and writes them to the transport at once.
     """
 
+    #: The number of bytes of DATA frames the writer sends before letting other callbacks run.
+    #: Priorities are only applied within what the writer has not sent yet, so this is also the
+    #: most that a low priority stream can get ahead of a high priority one.
+    WRITE_BATCH_SIZE = 65536
+
+    #: The number of streams the priority tree holds, before PRIORITY frames for streams that
+    #: haven't been opened yet are ignored.
+    MAX_PRIORITY_NODES = 1000
+
+    #: The number of bytes of a response body that can be waiting to be sent on a stream before
+    #: the rest of the body stops being produced.
+    STREAM_BUFFER_SIZE = 65536
+
+    #: The default number of streams a client can have open at once.
+    DEFAULT_MAX_CONCURRENT_STREAMS = 100
+
+    #: The default size of the flow control windows for request bodies.
+    DEFAULT_INITIAL_WINDOW_SIZE = 65535
+
     def __init__(self, component, parent_context: Context):
         # The current component used by this connection.
         self.component = component
@@ -280,17 +434,46 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         # The HTTP/2 state machine.
         self.conn = H2Connection(config=config)
 
+        #: The number of streams a client can have open at once. Streams past this are refused.
+        self.max_concurrent_streams = component.cfg.get("max_concurrent_streams",
+                                                        self.DEFAULT_MAX_CONCURRENT_STREAMS)
+        #: The size of the flow control windows for request bodies.
+        self.initial_window_size = component.cfg.get("initial_window_size",
+                                                     self.DEFAULT_INITIAL_WINDOW_SIZE)
+
+        # The stream limit is sent with the preamble. h2 doesn't keep any state for it besides
+        # the limit it enforces, which _ServerSettings replaces.
+        self.conn.local_settings = _ServerSettings(client=False, initial_values={
+            SettingCodes.MAX_CONCURRENT_STREAMS: self.max_concurrent_streams,
+            SettingCodes.MAX_HEADER_LIST_SIZE: self.conn.DEFAULT_MAX_HEADER_LIST_SIZE,
+        })
+
+        # The rest change how h2 reads frames, so they are sent with update_settings after the
+        # preamble, and h2 applies them once the client acknowledges them.
+        self._settings = {SettingCodes.INITIAL_WINDOW_SIZE: self.initial_window_size}
+        if "max_frame_size" in component.cfg:
+            self._settings[SettingCodes.MAX_FRAME_SIZE] = component.cfg["max_frame_size"]
+        if "header_table_size" in component.cfg:
+            self._settings[SettingCodes.HEADER_TABLE_SIZE] = component.cfg["header_table_size"]
+
         # The current transport for this connection.
         self.transport = None  # type: asyncio.WriteTransport
 
         # The current streams for this request.
         # This is a dictionary of stream_id -> data.
-        self.streams = {}  # type: typing.Dict[H2State]
+        # Every per-stream dictionary below is filled in by ``request_received``, and emptied by
+        # ``release_stream`` once the stream is finished.
+        self.streams = {}  # type: typing.Dict[int, H2State]
 
-        # The current stream data queue.
-        # This is a Queue of two-item tuples: (stream_data, stream_id).
+        # The response data waiting to be sent.
+        # This is a dictionary of stream_id -> deque of data, which ends with REQUEST_FINISHED
+        # once the whole response has been produced.
         # These are plucked off of a Werkzeug request as they come in from Kyoukai.
-        self.stream_data = collections.defaultdict(lambda *args: asyncio.Queue())
+        self.stream_data = {}  # type: typing.Dict[int, typing.Deque[bytes]]
+
+        # The priority of every stream. Streams with data waiting to be sent, and space in their
+        # flow control window, are active.
+        self.priority = PriorityTree()
 
         # The current logger.
         self.logger = logging.getLogger("Kyoukai.HTTP2")
@@ -298,11 +481,20 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         # Client data.
         self.ip, self.client_port = None, None
 
-        # If we're waiting to send data due to the window being exceeded.
-        self._locked = collections.defaultdict(lambda *args: asyncio.Event())
+        # The handle of the scheduled writer, if any.
+        self._write_handle = None  # type: asyncio.Handle
+        self._writing_paused = False
+
+        # The dictionary of tasks producing streamed response bodies.
+        self.body_tasks = {}
+
+        #: The number of pushes left on this connection, from the component's ``max_pushes``
+        #: option.
+        self.pushes_remaining = component.cfg.get("max_pushes", 100)
 
-        # The dictionary of stream tasks.
-        self.stream_tasks = {}
+        # Set once a GOAWAY has been sent because the server is shutting down.
+        self._shutting_down = False
+        self._last_stream_id = None  # type: int
 
     def raw_write(self, data: bytes):
         """
@@ -317,15 +509,52 @@ class H2KyoukaiProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc):
         self.logger.debug("Connection lost from {}:{}".format(self.ip, self.client_port))
+        self.component.untrack_connection(self)
 
-    def connection_made(self, transport: asyncio.WriteTransport):
+        # Streamed bodies might never end by themselves, so stop them.
+        for stream_id in list(self.streams):
+            self.release_stream(stream_id)
+
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+            self._write_handle = None
+
+    def pause_writing(self):
+        """
+        Called when the transport's write buffer is full.
+        """
+        self._writing_paused = True
+
+    def resume_writing(self):
+        """
+        Called when the transport's write buffer has drained.
+        """
+        self._writing_paused = False
+        self.schedule_write()
+
+    def connection_made(self, transport: asyncio.WriteTransport, *,
+                        upgrade_settings: str = None,
+                        upgrade_headers: typing.List[typing.Tuple[str, str]] = None,
+                        upgrade_body: bytes = b""):
         """
         Called when a connection is made.
 
+        This is also called by the httptools protocol when it switches a connection over to
+        HTTP/2.
+
         :param transport: The transport made by the connection.
+        :param upgrade_settings: The ``HTTP2-Settings`` header, if the connection was upgraded \
+            from HTTP/1.1 with h2c.
+        :param upgrade_headers: The headers of the HTTP/1.1 request the connection was upgraded \
+            with, which is answered on stream 1.
+        :param upgrade_body: The body of that request.
         """
         # Set our own attributes, and update the HTTP/2 state machine.
         self.transport = transport
+        if not self.component.track_connection(self):
+            self.transport.close()
+            return
+
         try:
             self.ip, self.client_port = self.transport.get_extra_info("peername")
             self.logger.debug("Connection received from {}:{}".format(self.ip, self.client_port))
@@ -333,7 +562,10 @@ class H2KyoukaiProtocol(asyncio.Protocol):
             # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a None.
             # Or, it returns None (wtf?)
             # So just provide some fake values.
-            warnings.warn("getpeername() returned None, cannot provide transport information.")
+            # Unix domain socket peers don't have an address, which is expected.
+            if not isinstance(self.transport.get_extra_info("peername"), str):
+                warnings.warn("getpeername() returned None, cannot provide "
+                              "transport information.")
             self.ip, self.client_port = None, None
 
         # Ensure that we are talking to a HTTP/2 client.
@@ -346,7 +578,9 @@ class H2KyoukaiProtocol(asyncio.Protocol):
             # For the sake of it, we're gonna assume that the client talks HTTP/2 instead of
             # HTTP/1.1,
             # or some other protocol.
-            warnings.warn("HTTP/2 connection established over a non-TLS stream!")
+            # Cleartext HTTP/2 (h2c) is expected when the server isn't using TLS at all.
+            if self.component.cfg.get("ssl"):
+                warnings.warn("HTTP/2 connection established over a non-TLS stream!")
         else:
             # Ensure we negotiated a `h2` connection.
             # This will check the ALPN protocol, but failing that, fall back to the NPN protocol.
@@ -364,21 +598,59 @@ class H2KyoukaiProtocol(asyncio.Protocol):
 
         # Send the HTTP2 preamble.
         self.logger.debug("Started the HTTP/2 connection.")
-        self.conn.initiate_connection()
+        if upgrade_settings is None:
+            self.conn.initiate_connection()
+        else:
+            # This sends the preamble too. The header is base64 without the padding, which h2
+            # can't decode by itself.
+            self.conn.initiate_upgrade_connection(
+                upgrade_settings + "=" * (-len(upgrade_settings) % 4)
+            )
+
+        # The connection's window isn't changed by SETTINGS, so it's grown to hold a full window
+        # for every stream. Otherwise, one stream whose body isn't being read would use up the
+        # connection's window and stall the uploads on every other stream. The stream windows
+        # still limit how much is buffered.
+        window = min(self.initial_window_size * self.max_concurrent_streams, MAX_WINDOW_SIZE)
+        increment = window - self.conn.inbound_flow_control_window
+        if increment > 0:
+            self.conn.increment_flow_control_window(increment)
+
+        self.conn.update_settings(self._settings)
         self.raw_write(self.conn.data_to_send())
 
+        if upgrade_headers is not None:
+            # The client has already sent all of the upgraded request, on stream 1.
+            self.priority.insert(1)
+            r = self.start_request(1, upgrade_headers)
+            r.environ["kyoukai.push"] = partial(self.push, 1)
+            # The body was sent over HTTP/1.1, outside of flow control. Acknowledging it as it is
+            # read is harmless, as h2 never opens a window past its size.
+            r.insert_data(upgrade_body)
+            r.insert_data(REQUEST_FINISHED)
+
     def data_received(self, data: bytes):
         """
         Called when data is received from the underlying socket.
         """
         # Get a list of events by writing to the state machine.
+        window = self.conn.inbound_flow_control_window
         try:
             events = self.conn.receive_data(data)
         except ProtocolError:
             self.close(0x1)
             return
-        # Find any data we need to send to the client first.
-        self.transport.write(self.conn.data_to_send())
+
+        # h2 takes DATA frames for streams that have already been reset out of the connection's
+        # window, but never gives them to us to acknowledge, so give that space back here.
+        lost = window - self.conn.inbound_flow_control_window - sum(
+            event.flow_controlled_length for event in events if isinstance(event, DataReceived)
+        )
+        if lost > 0:
+            self.conn.increment_flow_control_window(lost)
+
+        # Anything h2 sends in reply, such as acknowledgements, goes out with the next batch.
+        self.schedule_write()
 
         # Then, switch upon the events we've received from the HTTP/2 client.
         for event in events:
@@ -398,108 +670,394 @@ class H2KyoukaiProtocol(asyncio.Protocol):
             # This will unlock the event sender and continue sending data.
             elif isinstance(event, WindowUpdated):
                 self.window_opened(event)
+            # The client has cancelled the stream.
+            elif isinstance(event, StreamReset):
+                self.stream_reset(event)
+            # The client has changed the priority of a stream.
+            elif isinstance(event, PriorityUpdated):
+                self.priority_updated(event)
+            # The initial window size might have changed.
+            elif isinstance(event, RemoteSettingsChanged):
+                self.unblock_streams()
+
+    async def handle_request(self, state: 'H2State'):
+        """
+        Runs the app for the request on a stream, and starts sending its response.
 
-    def _processing_done(self, environ: dict, stream_id):
+        :param state: The :class:`.H2State` for the request.
         """
-        Callback for when processing is done on a request.
+        stream_id = state.stream_id
+        environ = state.environ
+        app = self.component.app  # type: Kyoukai
+
+        request = app.request_class(environ=environ)
+        try:
+            result = await app.process_request(request, self.parent_context)  # type: Response
+        except Exception:
+            self.logger.exception("Error in Kyoukai request handling!")
+            result = None
+
+        if stream_id not in self.streams:
+            # The stream was reset, or the connection lost, while the request was processed.
+            if result is not None:
+                result.close()
+            return
+
+        streaming = result is not None and is_streaming_response(result)
+        try:
+            if result is None:
+                body = ()
+                state.start_response("500 INTERNAL SERVER ERROR", [("Content-Length", "0")])
+            elif streaming:
+                # The body is produced asynchronously, so it is pulled as it is sent.
+                body = result.response
+                headers = result.get_wsgi_headers(environ)
+                state.start_response(result.status, headers.to_wsgi_list())
+            else:
+                body = result(environ, state.start_response)
+        except Exception:
+            self.logger.exception("Error in Kyoukai response handling!")
+            body = ()
+            state.start_response("500 INTERNAL SERVER ERROR", [("Content-Length", "0")])
+
+        self.conn.send_headers(stream_id, state.get_response_headers(), end_stream=False)
+        self.schedule_write()
+
+        if result is not None and not streaming and result.is_sequence:
+            # The body is already in memory, so there's nothing to wait for.
+            for part in body:
+                self.queue_data(stream_id, part)
+            body.close()
+            self.queue_data(stream_id, REQUEST_FINISHED)
+            return
+
+        state.streamed = streaming
+        discard = streaming and (environ["REQUEST_METHOD"] == "HEAD" or
+                                 result.status_code in (204, 304))
+        self.body_tasks[stream_id] = app.loop.create_task(
+            self.send_body(stream_id, body, result.charset if streaming else None, discard)
+        )
+
+    async def send_body(self, stream_id: int,
+                        body: typing.Union[typing.Iterable, typing.AsyncIterable], charset: str,
+                        discard: bool = False):
         """
+        Sends the body of a response on a stream.
 
-        def _inner(fut: asyncio.Future):
-            result = fut.result()  # type: Response
+        Each part of the body is only produced once less than :attr:`STREAM_BUFFER_SIZE` bytes of
+        the parts before it are waiting to be sent, so a client that reads slowly, or has a small
+        flow control window, holds up the body instead of letting it pile up in memory.
 
-            # Get the H2State for this request.
-            state = self.streams[stream_id]  # type: H2State
+        :param stream_id: The stream to send the body on.
+        :param body: The body to send. This can be an iterable or an asynchronous iterable.
+        :param charset: The charset to encode str parts with.
+        :param discard: If the body should be closed without sending any of it.
+        """
+        try:
+            if not discard:
+                if hasattr(body, "__aiter__"):
+                    async for part in body:
+                        await self._send_part(stream_id, part, charset)
+                else:
+                    for part in body:
+                        await self._send_part(stream_id, part, charset)
+        except asyncio.CancelledError:
+            # Stopped by a shutdown, or the stream or connection going away. End the stream
+            # either way; if it is already gone, this does nothing.
+            pass
+        except Exception:
+            self.logger.exception("Error in Kyoukai response body!")
+            # The headers have already been sent, so the client can only be told by a reset.
+            self.body_tasks.pop(stream_id, None)
+            if stream_id in self.streams:
+                self.conn.reset_stream(stream_id, ErrorCodes.INTERNAL_ERROR)
+                self.release_stream(stream_id)
+                self.schedule_write()
+            return
+        finally:
+            self.body_tasks.pop(stream_id, None)
+            aclose = getattr(body, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            elif hasattr(body, "close"):
+                body.close()
 
-            # Get the app iterator.
-            it = result(environ, state.start_response)
-            headers = state.get_response_headers()
+        self.queue_data(stream_id, REQUEST_FINISHED)
 
-            # Send the headers.
-            self.conn.send_headers(stream_id, headers, end_stream=False)
+    async def _send_part(self, stream_id: int, part, charset: str):
+        # Queues one part of a body, and waits for there to be room for the next one.
+        if isinstance(part, str):
+            part = part.encode(charset)
 
-            # Place all the data from the app iterator on the queue.
-            for i in it:
-                self.stream_data[stream_id].put_nowait(i)
+        self.queue_data(stream_id, part)
+        await self.drain(stream_id)
 
-            # Add the sentinel value.
-            self.stream_data[stream_id].put_nowait(REQUEST_FINISHED)
+    async def drain(self, stream_id: int):
+        """
+        Waits until the response data waiting to be sent on a stream is below
+        :attr:`STREAM_BUFFER_SIZE` bytes.
 
-            # This will all be done with the sending task.
+        This returns straight away if the stream has been released.
+        """
+        state = self.streams.get(stream_id)
+        if state is not None and state.queued > self.STREAM_BUFFER_SIZE:
+            state._drain_waiter = self.component.app.loop.create_future()
+            try:
+                await state._drain_waiter
+            finally:
+                state._drain_waiter = None
 
-        return _inner
+    def queue_data(self, stream_id: int, data):
+        """
+        Queues response data to be sent on a stream by the writer.
 
-    async def sending_loop(self, stream_id):
+        :param stream_id: The stream to send the data on.
+        :param data: The data, or REQUEST_FINISHED to end the stream once everything before it \
+            has been sent.
         """
-        This loop continues sending data to the client as it comes off of the queue.
+        queue = self.stream_data.get(stream_id)
+        if queue is None or not data:
+            # The stream has been released.
+            return
+
+        queue.append(data)
+        if data is not REQUEST_FINISHED:
+            self.streams[stream_id].queued += len(data)
+        self.priority.set_active(stream_id, True)
+        self.schedule_write()
+
+    def schedule_write(self):
         """
-        while True:
-            self._locked[stream_id].clear()
-            data = await self.stream_data[stream_id].get()
-
-            if data == REQUEST_FINISHED:
-                # The request is finished - terminate the stream.
-                self.conn.end_stream(stream_id)
-                self.raw_write(self.conn.data_to_send())
-                # This stream is dead, now.
-                return
+        Schedules the writer to run on the next loop iteration, if it isn't already.
+        """
+        if self._write_handle is None and self.transport is not None:
+            self._write_handle = self.component.app.loop.call_soon(self._write_frames)
+
+    def unblock_streams(self):
+        """
+        Marks every stream with data waiting as active again, after the flow control windows
+        have changed.
+        """
+        for stream_id, queue in self.stream_data.items():
+            if queue:
+                self.priority.set_active(stream_id, True)
+
+        self.schedule_write()
+
+    def _write_frames(self):
+        """
+        The writer. This sends frames from the active streams by priority, and then writes
+        everything h2 has to send in a single write.
+        """
+        self._write_handle = None
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        budget = self.WRITE_BATCH_SIZE
+        while budget > 0 and not self._writing_paused:
+            stream_id = self.priority.next()
+            if stream_id is None:
+                break
+
+            budget -= self._send_frame(stream_id)
+        else:
+            if not self._writing_paused:
+                # Out of budget, so let everything else run first.
+                self.schedule_write()
+
+        data = self.conn.data_to_send()
+        if data:
+            self.raw_write(data)
 
-            # Buffer data - don't exceed the control flow window size.
-            window_size = self.conn.local_flow_control_window(stream_id)
-            chunk_size = min(window_size, len(data))
-            data_to_send = data[:chunk_size]
-            data_to_buffer = data[chunk_size:]
-
-            if data_to_send:
-                # Split it into chunks and send it out.
-                max_size = self.conn.max_outbound_frame_size
-                chunks = (
-                    data_to_send[x:x + max_size]
-                    for x in range(0, len(data_to_send), max_size)
-                )
-                for chunk in chunks:
-                    self.conn.send_data(stream_id, chunk)
-                self.raw_write(self.conn.data_to_send())
-
-            if data_to_buffer:
-                # Don't exceed flow window, set this data to be sent later.
-                # Put it back on the left of the deque, then wait for our event to be set.
-                self.stream_data[stream_id]._queue.appendleft(data)
-                await self._locked[stream_id].wait()
-                self._locked[stream_id].clear()
-                continue
+        if self._shutting_down and not self.streams:
+            self.close()
+
+    def _send_frame(self, stream_id: int) -> int:
+        """
+        Sends a single frame of the data waiting on a stream.
+
+        :return: The number of bytes of data sent.
+        """
+        queue = self.stream_data[stream_id]
+        data = queue[0]
+        if data is REQUEST_FINISHED:
+            self.conn.end_stream(stream_id)
+            self._stream_finished(stream_id)
+            return 0
+
+        size = min(len(data), self.conn.local_flow_control_window(stream_id),
+                   self.conn.max_outbound_frame_size)
+        if size <= 0:
+            # The window is closed. This stream waits for a WINDOW_UPDATE.
+            self.priority.set_active(stream_id, False)
+            return 0
+
+        end_stream = False
+        if size == len(data):
+            queue.popleft()
+            # Send the end of the stream with the last of its data, instead of on its own.
+            end_stream = bool(queue) and queue[0] is REQUEST_FINISHED
+        else:
+            # Slice through a memoryview, so a large chunk isn't copied again for every frame.
+            data = memoryview(data)
+            queue[0] = data[size:]
+            data = data[:size]
+
+        self.conn.send_data(stream_id, data, end_stream=end_stream)
+        state = self.streams[stream_id]
+        state.queued -= size
+        waiter = state._drain_waiter
+        if waiter is not None and not waiter.done() and state.queued <= self.STREAM_BUFFER_SIZE:
+            waiter.set_result(None)
+
+        if end_stream:
+            self._stream_finished(stream_id)
+        elif not queue:
+            self.priority.set_active(stream_id, False)
+
+        return size
+
+    def _stream_finished(self, stream_id: int):
+        """
+        Called once the end of a response has been sent.
+        """
+        stream = self.conn.streams.get(stream_id)
+        if stream is not None and not stream.closed:
+            # The response was sent before the client finished sending the request body,
+            # which it no longer needs to send.
+            self.conn.reset_stream(stream_id, ErrorCodes.NO_ERROR)
+
+        # This stream is dead, now.
+        self.release_stream(stream_id)
 
     # H2 callbacks
     def request_received(self, event: RequestReceived):
         """
         Called when a request has been received.
         """
+        if self._shutting_down:
+            # This is past the last stream ID in our GOAWAY, so the client can safely retry it
+            # on a new connection.
+            self.conn.reset_stream(event.stream_id, ErrorCodes.REFUSED_STREAM)
+            self.raw_write(self.conn.data_to_send())
+            return
+
+        if len(self.streams) >= self.max_concurrent_streams and \
+                sum(stream_id % 2 for stream_id in self.streams) >= self.max_concurrent_streams:
+            # Pushed streams don't count against the client's limit, only its own do.
+            self.logger.debug("Refusing stream {}, as {} streams are open".format(
+                event.stream_id, len(self.streams)))
+            self.conn.reset_stream(event.stream_id, ErrorCodes.REFUSED_STREAM)
+            self.schedule_write()
+            return
+
+        priority = event.priority_updated
+        if priority is not None:
+            self.priority.insert(event.stream_id, priority.depends_on, priority.weight,
+                                 priority.exclusive)
+        elif event.stream_id not in self.priority:
+            self.priority.insert(event.stream_id)
+
+        r = self.start_request(event.stream_id, event.headers)
+        # Only requests from the client can have pushes.
+        r.environ["kyoukai.push"] = partial(self.push, event.stream_id)
+
+    def start_request(self, stream_id: int, headers: list) -> 'H2State':
+        """
+        Starts processing a request on a stream.
+
+        :param stream_id: The stream the request is on.
+        :param headers: The request headers.
+        :return: The :class:`.H2State` for the request.
+        """
         # Create the RequestData that stores this event.
-        r = H2State(event.headers, event.stream_id, self)
-        self.streams[event.stream_id] = r
+        r = H2State(headers, stream_id, self)
+        self.streams[stream_id] = r
+        self.stream_data[stream_id] = collections.deque()
 
         # Create the task that runs the app.
         app = self.component.app  # type: Kyoukai
         # Create the fake WSGI environment.
         env = create_wsgi_environment(r)
-        request = app.request_class(environ=env)
+        r.environ = env
+        app.loop.create_task(self.handle_request(r))
+        return r
 
-        loop = app.loop
-        t = loop.create_task(app.process_request(request, self.parent_context))
-        self.stream_tasks[event.stream_id] = loop.create_task(self.sending_loop(event.stream_id))
+    def push(self, stream_id: int, path: str,
+             headers: typing.Union[dict, typing.List[typing.Tuple[str, str]]] = None) -> bool:
+        """
+        Pushes a resource to the client, along with the response on a stream.
 
-        t.add_done_callback(self._processing_done(env, event.stream_id))
+        This sends a PUSH_PROMISE for a GET request of the path, and then processes that request
+        like any other, sending its response on the promised stream.
+
+        :param stream_id: The stream of the request the pushed resource belongs to.
+        :param path: The path of the resource to push.
+        :param headers: Any extra headers for the pushed request.
+        :return: True if the push was promised, or False if it wasn't because the client has \
+            disabled pushes, the connection's push budget has run out, or the response on the \
+            stream has already started.
+        """
+        state = self.streams.get(stream_id)
+        if state is None or state._emit_status is not None or self._shutting_down:
+            return False
+
+        if not self.conn.remote_settings.enable_push or self.pushes_remaining <= 0:
+            return False
+
+        request_headers = [
+            (":method", "GET"),
+            (":scheme", get_header(state.headers, ":scheme")),
+            (":authority", get_header(state.headers, ":authority")),
+            (":path", path),
+        ]
+        if headers:
+            if hasattr(headers, "items"):
+                headers = headers.items()
+            request_headers.extend((name.lower(), value) for name, value in headers)
+
+        promised_stream_id = self.conn.get_next_available_stream_id()
+        try:
+            self.conn.push_stream(stream_id, promised_stream_id, request_headers)
+        except ProtocolError:
+            # The client's limit on concurrent streams has been reached.
+            return False
+
+        self.pushes_remaining -= 1
+        self.schedule_write()
+
+        # Pushed streams depend on the stream they were pushed for.
+        self.priority.insert(promised_stream_id, stream_id)
+        r = self.start_request(promised_stream_id, request_headers)
+        # A pushed request has no body.
+        r.insert_data(REQUEST_FINISHED)
+        return True
 
     def window_opened(self, event: WindowUpdated):
         """
         Called when a control flow window has opened again.
         """
         if event.stream_id:
-            # Set the lock on the event, which will cause the sending_loop to wake up.
-            self._locked[event.stream_id].set()
+            # Let the writer send on this stream again.
+            if self.stream_data.get(event.stream_id):
+                self.priority.set_active(event.stream_id, True)
+                self.schedule_write()
         else:
-            # Unlock all events.
-            for ev in self._locked.keys():
-                ev.set()
+            # Every stream might have been waiting on the connection window.
+            self.unblock_streams()
+
+    def priority_updated(self, event: PriorityUpdated):
+        """
+        Called when the client changes the priority of a stream.
+        """
+        if event.stream_id not in self.priority and \
+                len(self.priority) >= self.MAX_PRIORITY_NODES:
+            # Clients can prioritise streams they haven't opened yet, to group other streams
+            # under. Don't let them do it without limit.
+            return
+
+        self.priority.reprioritize(event.stream_id, event.depends_on, event.weight,
+                                   event.exclusive)
 
     def receive_data(self, event: DataReceived):
         """
@@ -509,11 +1067,30 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         try:
             req = self.streams[event.stream_id]
         except KeyError:
+            # Nothing will read this data.
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            if self.stream_closed(event.stream_id):
+                # This stream was refused, and has already been reset.
+                return
+
             # Reset the stream, because the client is stupid.
             self.conn.reset_stream(event.stream_id, ErrorCodes.PROTOCOL_ERROR)
         else:
+            # The space used by padding is given back now, and the space used by the data is
+            # given back as the app reads it.
+            padding = event.flow_controlled_length - len(event.data)
+            if padding:
+                self.conn.acknowledge_received_data(padding, event.stream_id)
+
             req.insert_data(event.data)
 
+    def stream_closed(self, stream_id: int) -> bool:
+        """
+        Checks if h2 considers a stream closed, such as after it has been refused.
+        """
+        stream = self.conn.streams.get(stream_id)
+        return stream is None or stream.closed
+
     def stream_complete(self, event: StreamEnded):
         """
         Called when a stream is complete.
@@ -523,12 +1100,88 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         try:
             req = self.streams[event.stream_id]
         except KeyError:
+            if self.stream_closed(event.stream_id):
+                # This stream was refused, and has already been reset.
+                return
+
             # shoo
             self.conn.reset_stream(event.stream_id, ErrorCodes.PROTOCOL_ERROR)
             return
         else:
             req.insert_data(REQUEST_FINISHED)
 
+    def stream_reset(self, event: StreamReset):
+        """
+        Called when the client resets a stream.
+        """
+        self.release_stream(event.stream_id)
+        if self._shutting_down and not self.streams:
+            self.close()
+
+    def acknowledge_data(self, stream_id: int, size: int):
+        """
+        Opens the flow control windows for body data that the app has read from a stream.
+
+        :param stream_id: The stream the data was received on.
+        :param size: The number of bytes read.
+        """
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        self.conn.acknowledge_received_data(size, stream_id)
+        self.schedule_write()
+
+    def release_stream(self, stream_id: int):
+        """
+        Releases everything kept for a stream, once it has ended or been reset.
+
+        This cancels any streamed body that is still being produced. The task processing the
+        request itself is left to finish, and its response is discarded.
+        """
+        state = self.streams.pop(stream_id, None)
+        if state is not None:
+            # Don't let the rest of the body hold up the connection's window.
+            state.discard()
+
+        self.stream_data.pop(stream_id, None)
+        self.priority.remove(stream_id)
+
+        task = self.body_tasks.pop(stream_id, None)
+        if task is not None:
+            task.cancel()
+
+    def shutdown(self):
+        """
+        Starts closing this connection gracefully, because the server is shutting down.
+
+        This sends a GOAWAY with the ID of the last stream that will be processed. Streams the
+        client opens after that are refused, and the connection is closed once the streams in
+        progress are finished. Streamed responses are ended now, as they might never end by
+        themselves.
+        """
+        if self._shutting_down:
+            return
+
+        self._shutting_down = True
+
+        # h2's close_connection would also stop the streams in progress from sending anything, so
+        # the GOAWAY frame is built by hand.
+        self._last_stream_id = self.conn.highest_inbound_stream_id
+        # Anything h2 has buffered goes first.
+        self.raw_write(self.conn.data_to_send())
+        frame = GoAwayFrame(0)
+        frame.last_stream_id = self._last_stream_id
+        frame.error_code = ErrorCodes.NO_ERROR
+        self.raw_write(frame.serialize())
+
+        for stream_id, task in list(self.body_tasks.items()):
+            # Bodies that aren't streamed end by themselves.
+            if self.streams[stream_id].streamed:
+                task.cancel()
+
+        if not self.streams:
+            self.close()
+
     def close(self, error_code: int=0):
         """
         Called to terminate the connection for some reason.
@@ -536,7 +1189,8 @@ class H2KyoukaiProtocol(asyncio.Protocol):
         This will close the underlying transport.
         """
         # Send a GOAWAY frame.
-        self.conn.close_connection(error_code)
+        # After a shutdown, this must not announce a higher last stream ID than the first one.
+        self.conn.close_connection(error_code, last_stream_id=self._last_stream_id)
         self.raw_write(self.conn.data_to_send())
 
         self.transport.close()
@@ -3,21 +3,26 @@ A high-performance HTTP/1.1 backend for the Kyoukai webserver using `httptools
 <https://github.com/MagicStack/httptools>`_.
 """
 import asyncio
-import base64
 import gzip
 import logging
+import sys
 import traceback
+import typing
 import warnings
 import zlib
 from io import BytesIO
+from urllib.parse import urlsplit
 
 import httptools
 from asphalt.core import Context
-from werkzeug.exceptions import MethodNotAllowed, BadRequest, InternalServerError
+from werkzeug.exceptions import MethodNotAllowed, BadRequest, InternalServerError, HTTPException
+from werkzeug.routing import RequestRedirect
 from werkzeug.wrappers import Response
 
 from kyoukai.backends.http2 import H2KyoukaiProtocol
-from kyoukai.wsgi import to_wsgi_environment, get_formatted_response
+from kyoukai.backends.websocket import WebSocket, CLOSE_INTERNAL_ERROR, is_websocket_handshake
+from kyoukai.wsgi import to_wsgi_environment, get_formatted_response, LazyHeaderEnviron, \
+    get_formatted_response_head, is_streaming_response
 
 CRITICAL_ERROR_TEXT = """HTTP/1.0 500 INTERNAL SERVER ERROR
 Server: Kyoukai
@@ -61,8 +66,128 @@ Content-Length: 25
 Invalid compressed data
 """.replace("\n", "\r\n")
 
+HTTP_CONTINUE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
+HTTP_EXPECTATION_FAILED = """HTTP/1.1 417 EXPECTATION FAILED
+Server: Kyoukai
+X-Powered-By: Kyoukai
+X-HTTP-Backend: httptools
+Connection: close
+Content-Length: 0
+
+""".replace("\n", "\r\n")
+
+HTTP_REQUEST_TIMEOUT = """HTTP/1.1 408 REQUEST TIMEOUT
+Server: Kyoukai
+X-Powered-By: Kyoukai
+X-HTTP-Backend: httptools
+Connection: close
+Content-Length: 0
+
+""".replace("\n", "\r\n")
+
+HTTP_HEADERS_TOO_LARGE = """HTTP/1.1 431 REQUEST HEADER FIELDS TOO LARGE
+Server: Kyoukai
+X-Powered-By: Kyoukai
+X-HTTP-Backend: httptools
+Connection: close
+Content-Length: 0
+
+""".replace("\n", "\r\n")
+
+HTTP_URI_TOO_LONG = """HTTP/1.1 414 URI TOO LONG
+Server: Kyoukai
+X-Powered-By: Kyoukai
+X-HTTP-Backend: httptools
+Connection: close
+Content-Length: 0
+
+""".replace("\n", "\r\n")
+
 PROTOCOL_CLASS = "KyoukaiProtocol"
 
+# The parts of the WSGI environment that are the same for every request.
+# Each connection copies this once and fills in its own details; each request then copies that.
+ENVIRON_TEMPLATE = {
+    "SCRIPT_NAME": "",
+    "wsgi.version": (1, 0),
+    "wsgi.errors": sys.stderr,
+    "wsgi.url_scheme": "http",
+    "wsgi.input_terminated": True,
+    "wsgi.async": True,
+    "wsgi.multithread": True,  # technically false sometimes, but oh well
+    "wsgi.multiprocess": False,
+    "wsgi.run_once": False,
+}
+
+# Headers that are needed for almost every request, and so are decoded straight away.
+# This maps the lowercase header name to the key in the WSGI environment.
+EAGER_HEADERS = {
+    b"host": "HTTP_HOST",
+    b"content-type": "CONTENT_TYPE",
+    b"content-length": "CONTENT_LENGTH",
+    b"cookie": "HTTP_COOKIE",
+    b"expect": "HTTP_EXPECT",
+}
+
+# The first bytes a HTTP/2 client sends, when it knows the server speaks HTTP/2 already.
+HTTP2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# HTTP/1.1 headers that are about the connection, which don't carry over to HTTP/2.
+HOP_BY_HOP_HEADERS = {
+    "HTTP_CONNECTION", "HTTP_KEEP_ALIVE", "HTTP_PROXY_CONNECTION", "HTTP_TRANSFER_ENCODING",
+    "HTTP_UPGRADE", "HTTP_HTTP2_SETTINGS", "HTTP_TE", "HTTP_HOST",
+}
+
+SERVER_PROTOCOLS = {
+    "1.1": "HTTP/1.1",
+    "1.0": "HTTP/1.0",
+}
+
+# Connection states, used to pick which timeout currently applies.
+_STATE_IDLE = 0
+_STATE_HEADERS = 1
+_STATE_BODY = 2
+_STATE_PROCESSING = 3
+
+
+def get_upgrade_headers(environ: dict) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Gets the HTTP/2 headers for a HTTP/1.1 request that is being upgraded with h2c.
+
+    :param environ: The WSGI environment of the request.
+    """
+    path = environ["PATH_INFO"]
+    if environ.get("QUERY_STRING"):
+        path += "?" + environ["QUERY_STRING"]
+
+    headers = [
+        (":method", environ["REQUEST_METHOD"]),
+        (":scheme", environ.get("wsgi.url_scheme", "http")),
+        (":authority", environ.get("HTTP_HOST", "")),
+        (":path", path),
+    ]
+    for key, value in environ.items():
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            headers.append((key.replace("_", "-").lower(), value))
+        elif key.startswith("HTTP_") and key not in HOP_BY_HOP_HEADERS:
+            headers.append((key[5:].replace("_", "-").lower(), value))
+
+    return headers
+
+
+class _RequestRejected(Exception):
+    """
+    Raised from inside a parser callback to stop parsing and reject the request.
+
+    httptools wraps this in a :class:`httptools.HttpParserCallbackError`, which
+    :meth:`.KyoukaiProtocol.data_received` unwraps to write :attr:`response`.
+    """
+
+    def __init__(self, response: typing.Union[str, bytes]):
+        super().__init__(response)
+        self.response = response
+
 
 class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
     """
@@ -70,6 +195,27 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
     """
     MAX_BODY_SIZE = 12 * 1024 * 1024
 
+    #: The maximum number of headers a single request may send.
+    MAX_HEADER_COUNT = 100
+    #: The maximum combined size, in bytes, of the header names and values of a single request.
+    MAX_HEADER_SIZE = 64 * 1024
+    #: The maximum size, in bytes, of the URL of a single request.
+    MAX_URL_SIZE = 8 * 1024
+
+    #: The number of seconds a client has to send the complete request headers.
+    #: This is measured from the start of the request, or from when the connection was made for
+    #: the first request, so trickling headers does not extend it.
+    HEADER_TIMEOUT = 10.0
+    #: The number of seconds the client may go without sending any body data.
+    BODY_TIMEOUT = 30.0
+    #: The number of seconds an idle keep-alive connection is kept open for.
+    KEEP_ALIVE_TIMEOUT = 5.0
+
+    #: The size, in bytes, of the transport's write buffer at which writing is paused.
+    WRITE_BUFFER_HIGH = 64 * 1024
+    #: The size, in bytes, the write buffer must drain to before writing is resumed.
+    WRITE_BUFFER_LOW = 16 * 1024
+
     def __init__(self, component, parent_context: Context,
                  server_ip: str, server_port: int):
         """
@@ -95,7 +241,8 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         self.lock = asyncio.Lock()
 
         # The parser itself.
-        # This is created per connection, and uses our own class.
+        # This is created per connection, uses our own class, and is kept for every request made
+        # over the connection.
         self.parser = httptools.HttpRequestParser(self)
 
         # A waiter that 'waits' on the event to clear.
@@ -108,26 +255,125 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         # Intermediary data storage.
         # This is a list because headers are appended as (Name, Value) pairs.
         # In HTTP/1.1, there can be multiple headers with the same name but different values.
+        # These are kept as the raw bytes from the parser, and are only decoded when building the
+        # environment.
+        # These are emptied once a request is complete, and reused for the next request.
         self.headers = []
         self.body = BytesIO()
-        self.full_url = ""
+        self.full_url = b""
+
+        # The per-connection WSGI environment template. This is filled in on connection_made.
+        self._environ_template = None  # type: dict
+
+        # Per-request data copied out of the parser when the headers are complete.
+        # The parser moves on to the next pipelined request before the app sees this one, so it
+        # can't be asked later.
+        self._method = b""
+        self._version = "1.1"
+        self._keep_alive = True
+
+        # The environment of the current request, built once the headers are complete.
+        # This is kept until the next request's headers are complete, for upgrade requests.
+        self._environ = None  # type: LazyHeaderEnviron
+        self._upgrading = False
+
+        # The WebSocket this connection is being upgraded to, if any.
+        self._websocket = None  # type: WebSocket
+
+        # The number of bytes of a h2c upgrade request's body still to be received, if the
+        # connection is waiting for them before switching to HTTP/2.
+        self._upgrade_body_left = None  # type: int
+
+        # The data received on a new cleartext connection, while it could still be the start of
+        # the HTTP/2 connection preface. This is None once it can't be.
+        self._preface = None  # type: bytes
+
+        # Set once the server is shutting down. The connection is closed after the current
+        # requests instead of being kept alive.
+        self._shutting_down = False
+
+        # The task writing a streamed response body, if any.
+        # This is cancelled if the client goes away, as the body may never end by itself.
+        self._stream_task = None  # type: asyncio.Task
 
         self.loop = self.app.loop
         self.logger = logging.getLogger("Kyoukai.HTTP11")
 
+        # Limits and timeouts, overridable from the component config.
+        cfg = component.cfg
+        self.max_header_count = cfg.get("max_header_count", self.MAX_HEADER_COUNT)
+        self.max_header_size = cfg.get("max_header_size", self.MAX_HEADER_SIZE)
+        self.max_url_size = cfg.get("max_url_size", self.MAX_URL_SIZE)
+        # httptools buffers a header until all of it has arrived, so the size of a request's head
+        # is also checked as it is received. This allows for the request line, and the ": " and
+        # CRLF around each header, on top of the URL and the headers themselves.
+        self._max_head_size = (self.max_url_size + self.max_header_size +
+                               4 * self.max_header_count + 64)
+        self.header_timeout = cfg.get("header_timeout", self.HEADER_TIMEOUT)
+        self.body_timeout = cfg.get("body_timeout", self.BODY_TIMEOUT)
+        self.keep_alive_timeout = cfg.get("keep_alive_timeout", self.KEEP_ALIVE_TIMEOUT)
+        self.write_buffer_high = cfg.get("write_buffer_high", self.WRITE_BUFFER_HIGH)
+        self.write_buffer_low = cfg.get("write_buffer_low", self.WRITE_BUFFER_LOW)
+
+        # Writes queued for the end of this event loop iteration.
+        self._pending_writes = []
+        self._pending_size = 0
+        self._flush_handle = None  # type: asyncio.Handle
+
+        # Write flow control.
+        # The transport calls pause_writing once its buffer is over the high water mark, and
+        # streaming writers wait in drain() until it's back under the low water mark.
+        self._writing_paused = False
+        self._drain_waiter = None  # type: asyncio.Future
+
+        # Set while reading is paused for a WebSocket the app hasn't accepted yet.
+        self._reading_paused = False
+
+        # The running size of the headers for the current request.
+        self._header_size = 0
+        # Set while the head of a request is being received, along with the number of bytes of it
+        # received in later reads than the one it started in.
+        self._reading_head = False
+        self._head_began = False
+        self._head_size = 0
+
+        # Set once a request has been rejected. The connection is closed once the requests before
+        # it have been responded to, and anything else the client sends is ignored.
+        self._rejected = False
+
+        # Timeout tracking.
+        # Only one timer handle exists per connection. Activity just moves ``_deadline`` forward,
+        # and the timer re-arms itself when it fires early, so resetting a timeout is a float
+        # assignment rather than a cancel and reschedule.
+        self._state = _STATE_IDLE
+        self._deadline = None
+        self._timer = None  # type: asyncio.TimerHandle
+        self._timer_when = None
+        # The number of requests that have been received but not yet responded to.
+        self._in_flight = 0
+
     def replace(self, other: type, *args, **kwargs) -> type:
         """
         Replaces our type with the other.
         """
+        # Anything queued has to go out before the new protocol writes.
+        self._flush()
+
         # Copy the properties we need.
         component = self.component
-        app = component.app
+        parent_context = self.parent_context
+        transport = self.transport
         # Goodbye, ourselves!
         self.__class__ = other
 
         # Hello, not ourselves!
         # Call the new __init__.
-        other.__init__(self, component, app, *args, **kwargs)
+        other.__init__(self, component, parent_context, *args, **kwargs)
+
+        # Some transports (uvloop's) cache the protocol's bound methods, which would still point
+        # at the old class. Setting the protocol again makes them look the methods up again.
+        if transport is not None and hasattr(transport, "set_protocol"):
+            transport.set_protocol(self)
 
         return self
 
@@ -136,9 +382,15 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         """
         Called when a message begins.
         """
-        self.body = BytesIO()
-        self.headers = []
-        self.full_url = ""
+        self.full_url = b""
+        self._header_size = 0
+        self._reading_head = True
+        self._head_began = True
+        self._head_size = 0
+        if self._state != _STATE_HEADERS:
+            # The first request on a connection is already timed from when the connection was
+            # made, so waiting before sending the first byte doesn't extend it.
+            self._set_timeout(_STATE_HEADERS, self.header_timeout)
 
     def on_header(self, name: bytes, value: bytes):
         """
@@ -147,12 +399,34 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         :param name: The name of the header.
         :param value: The value of the header.
         """
-        self.headers.append((name.decode(), value.decode()))
+        self._header_size += len(name) + len(value)
+        if len(self.headers) >= self.max_header_count or self._header_size > self.max_header_size:
+            raise _RequestRejected(HTTP_HEADERS_TOO_LARGE)
+
+        self.headers.append((name, value))
 
     def on_headers_complete(self):
         """
         Called when the headers have been completely sent.
         """
+        self._reading_head = False
+        self._method = self.parser.get_method()
+        self._version = self.parser.get_http_version()
+        self._keep_alive = self.parser.should_keep_alive()
+        self._environ = self._build_environ()
+
+        self._upgrading = self.parser.should_upgrade()
+        if self._upgrading:
+            # This is handled by data_received once httptools raises HttpParserUpgrade.
+            return
+
+        self._set_timeout(_STATE_BODY, self.body_timeout)
+
+        expect = dict.get(self._environ, "HTTP_EXPECT")
+        if expect is not None and self._version != "1.0":
+            # HTTP/1.0 clients don't wait for 100 Continue, so the header is ignored (RFC 7231,
+            # section 5.1.1).
+            self._handle_expect(expect)
 
     def on_body(self, body: bytes):
         """
@@ -163,21 +437,36 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         self.body.write(body)
         if self.body.tell() >= self.MAX_BODY_SIZE:
             # write a "too big" message
-            self.write(HTTP_TOO_BIG)
-            self.close()
+            raise _RequestRejected(HTTP_TOO_BIG)
+
+        # The body timeout is an inactivity timeout, so push it back.
+        self._deadline = self.loop.time() + self.body_timeout
 
     def on_url(self, url: bytes):
         """
         Called when a URL is received from the client.
+
+        This can be called more than once per request, if the URL was split across packets.
         """
-        self.full_url = url.decode("utf-8")
+        self.full_url += url
+        if len(self.full_url) > self.max_url_size:
+            raise _RequestRejected(HTTP_URI_TOO_LONG)
 
     def on_message_complete(self):
         """
         Called when a message is complete.
         This creates the worker task which will begin processing the request.
         """
-        task = self.loop.create_task(self._wait_wrapper())
+        if self._upgrading:
+            return
+
+        new_environ = self._environ
+        new_environ["wsgi.input"] = self._take_body(new_environ)
+
+        # The app is now responsible for this connection; it is not timed out while processing.
+        self._state = _STATE_PROCESSING
+        self._in_flight += 1
+        task = self.loop.create_task(self._wait_wrapper(new_environ, self._keep_alive))
         self.waiter = task
 
     # asyncio procs
@@ -194,13 +483,37 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
             # Sometimes socket.socket.getpeername() isn't available, so it tried to unpack a None.
             # Or, it returns None (wtf?)
             # So just provide some fake values.
-            warnings.warn("getpeername() returned None, cannot provide transport information.")
+            # Unix domain socket peers don't have an address, which is expected.
+            if not isinstance(transport.get_extra_info("peername"), str):
+                warnings.warn("getpeername() returned None, cannot provide "
+                              "transport information.")
             self.ip, self.client_port = None, None
 
         self.transport = transport
+        if not self.component.track_connection(self):
+            # Over the connection limit.
+            self.transport.close()
+            return
+
+        self.transport.set_write_buffer_limits(high=self.write_buffer_high,
+                                               low=self.write_buffer_low)
+
+        self._environ_template = dict(ENVIRON_TEMPLATE)
+        self._environ_template.update({
+            "kyoukai.protocol": self,
+            "SERVER_NAME": self.component.get_server_name(),
+            "SERVER_PORT": str(self.server_port),
+            "REMOTE_ADDR": self.ip,
+            "REMOTE_PORT": self.client_port,
+        })
+
+        # A client that connects must start sending a request within the header timeout.
+        self._set_timeout(_STATE_HEADERS, self.header_timeout)
 
         ssl_sock = self.transport.get_extra_info("ssl_object")
         if ssl_sock is not None:
+            self._environ_template["wsgi.url_scheme"] = "https"
+
             # Check if we negotiated a HTTP/2 connection.
             # This will check the ALPN protocol, but failing that, fall back to the NPN protocol.
             negotiated_protocol = ssl_sock.selected_alpn_protocol()
@@ -209,23 +522,92 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
 
             if negotiated_protocol == "h2":
                 # switch protocol to http/2 handler
-                transport = self.transport
-                new_self = self.replace(H2KyoukaiProtocol)  # type: H2KyoukaiProtocol
-                # make sure the new connection
-                type(new_self).connection_made(new_self, transport)
+                self.switch_to_http2()
                 return
+        elif self.component.cfg.get("http2", False) is True:
+            # Clients can speak HTTP/2 straight away, without TLS or an upgrade.
+            self._preface = b""
 
         self.component.connection_made.dispatch(protocol=self)
 
     def connection_lost(self, exc):
         self.logger.debug("Connection lost from {}:{}".format(self.ip, self.client_port))
+        self._cancel_timeout()
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+
+        # Wake up anything waiting to write; it will find out it's closed.
+        self.resume_writing()
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending_writes.clear()
+
+        self.component.untrack_connection(self)
         self.component.connection_lost.dispatch(protocol=self)
 
+    def shutdown(self):
+        """
+        Starts closing this connection gracefully, because the server is shutting down.
+
+        An idle keep-alive connection is closed straight away. Otherwise, the connection is closed
+        once every request received so far has been responded to. Streamed responses are ended
+        now, as they might never end by themselves.
+        """
+        self._shutting_down = True
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+
+        if self._in_flight == 0:
+            # Also close connections that haven't sent anything of their next request yet.
+            if self._state == _STATE_IDLE or (self._state == _STATE_HEADERS and
+                                              not self.full_url and not self.headers):
+                self.close()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
     def data_received(self, data: bytes):
         """
         Called when data is received into the connection.
         """
+        if self._websocket is not None:
+            # The app hasn't accepted the WebSocket yet, so hold on to this until it has.
+            # Reading stops until then, so that the client can't make this grow without limit.
+            self._websocket._buffered += data
+            if not self._reading_paused:
+                self._reading_paused = True
+                self.transport.pause_reading()
+            return
+
+        if self._rejected:
+            return
+
+        if self._upgrade_body_left is not None:
+            self._receive_upgrade_body(data)
+            return
+
+        if self._preface is not None:
+            data = self._preface + data
+            if len(data) < len(HTTP2_PREFACE) and HTTP2_PREFACE.startswith(data):
+                # Wait for the rest, to see if it's a HTTP/2 client.
+                self._preface = data
+                return
+
+            self._preface = None
+            if data.startswith(HTTP2_PREFACE):
+                self.logger.debug("Switching to HTTP/2 with prior knowledge.")
+                self.switch_to_http2(data)
+                return
+
         # Feed it into the parser, and handle any errors that might happen.
+        self._head_began = False
         try:
             self.parser.feed_data(data)
         except httptools.HttpParserInvalidMethodError as e:
@@ -235,24 +617,28 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
             # (handle_parser_exception) which will generate a fake WSGI environment, and then
             # automatically return a werkzeug httpexception that corresponds.
             self.handle_parser_exception(e)
+        except httptools.HttpParserCallbackError as e:
+            # One of our callbacks refused the request, e.g because the headers were too large.
+            # The real exception is chained onto the callback error by httptools.
+            if isinstance(e.__context__, _RequestRejected):
+                self._reject(e.__context__.response)
+                return
+
+            traceback.print_exc()
+            self.handle_parser_exception(e)
         except httptools.HttpParserError as e:
             traceback.print_exc()
             self.handle_parser_exception(e)
         except httptools.HttpParserUpgrade as e:
             # It's a HTTP upgrade!
             # The only valid values of these that we wish to support (currently) are `h2c` and
-            # `Websocket`. Currently, Kyoukai does not support websocket upgrade (soon™).
-            # However, we cannot silently ignore websocket upgrades - we discard those for now and
-            # disconnect.
-            # Anything else, we also discard and disconnect.
+            # `Websocket`.
+            # Anything else, we discard and disconnect.
 
             # httptools sucks, and only provides us an offset.
-            # so what we do is hope the `Upgrade` header is in our header list.
-            for name, header in self.headers:
-                if name.lower() == "upgrade":
-                    upgrade = header
-                    break
-            else:
+            # so what we do is hope the `Upgrade` header is in our environment.
+            upgrade = self._environ.get("HTTP_UPGRADE") if self._environ is not None else None
+            if upgrade is None:
                 # thanks, we can't do shit.
                 self.handle_parser_exception(e)
                 return
@@ -261,39 +647,59 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
                 # Copy the transport into our local scope, as it becomes None after we've switched
                 # type. Once we've replaced ourselves, call `connection_made` on the new type to
                 # initialize.
-                for name, header in self.headers:
-                    if name.lower() == "http2-settings":
-                        http2_settings = header
-                        break
-                else:
+                http2_settings = self._environ.get("HTTP_HTTP2_SETTINGS")
+                if http2_settings is None:
                     # can't find the http2_settings header, rip
                     self.handle_parser_exception(e)
                     return
 
+                if self._environ.get("HTTP_TRANSFER_ENCODING") is not None:
+                    # A chunked body can't be told apart from the HTTP/2 data after it without
+                    # parsing it, which httptools has stopped doing.
+                    self.handle_parser_exception(e)
+                    return
+
                 self.logger.info("Upgrading HTTP/1.1 to HTTP/2 connection.")
 
-                # base64 decode the http2 settings packet
-                decoded = base64.urlsafe_b64decode(http2_settings)
-                # send a 101 switching protocols
-                self.write(HTTP_SWITCHING_PROTOCOLS)
+                offset = e.args[0] if e.args else len(data)
+                length = int(self._environ.get("CONTENT_LENGTH") or 0)
+                if length and not self.body.tell():
+                    # Newer versions of httptools stop at the end of the headers, so the body is
+                    # read here before switching. Older ones have already read it.
+                    if length >= self.MAX_BODY_SIZE:
+                        self.raw_write(HTTP_TOO_BIG.encode())
+                        self.close()
+                        return
 
-                transport = self.transport
-                new_self = self.replace(H2KyoukaiProtocol)  # type: H2KyoukaiProtocol
+                    self._upgrade_body_left = length
+                    self._set_timeout(_STATE_BODY, self.body_timeout)
+                    self._receive_upgrade_body(data[offset:])
+                    return
 
-                # update with the new settings
-                new_self.conn.initiate_upgrade_connection(decoded)
-                # this will have updated settings; now switch protocols.
-                type(new_self).connection_made(new_self, transport)
+                self._upgrade_to_h2c(data[offset:])
                 return
 
-            # If it's Websocket, disconnect.
+            # If it's Websocket, route it through the app like a normal request.
             if upgrade.lower() == "websocket":
-                self.handle_parser_exception(e)
+                if not is_websocket_handshake(self._environ):
+                    self.handle_parser_exception(e)
+                    return
+
+                # The offset is where the data after the upgrade request starts.
+                offset = e.args[0] if e.args else len(data)
+                self._upgrade_websocket(data[offset:])
                 return
 
             # If it's anything else, disconnect.
             self.handle_parser_exception(e)
             return
+        else:
+            if self._reading_head and not self._head_began:
+                # All of this read was more of the head of the same request. The read it started
+                # in isn't counted, so this can go over by at most one read.
+                self._head_size += len(data)
+                if self._head_size > self._max_head_size:
+                    self._reject(HTTP_HEADERS_TOO_LARGE)
 
     # kyoukai handling
     def handle_parser_exception(self, exc: Exception):
@@ -318,20 +724,57 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
             r = InternalServerError()
 
         # Make a fake environment.
-        new_environ = to_wsgi_environment(headers=self.headers, method="", path="/",
+        headers = [(name.decode("latin-1"), value.decode("latin-1"))
+                   for name, value in self.headers]
+        new_environ = to_wsgi_environment(headers=headers, method="", path="/",
                                           http_version="1.0", body=None)
         new_environ["SERVER_NAME"] = self.component.get_server_name()
         new_environ["SERVER_PORT"] = str(self.server_port)
         new_environ["REMOTE_ADDR"] = self.ip
 
-        self.raw_write(get_formatted_response(r, new_environ))
-        self.parser = httptools.HttpRequestParser(self)
-        self.close()
+        self._reject(get_formatted_response(r, new_environ))
+
+    def _reject(self, response):
+        """
+        Rejects the current request, closing the connection once the requests before it have been
+        responded to.
+
+        :param response: The response to send, as a string or bytes.
+        """
+        if isinstance(response, str):
+            response = response.encode()
+
+        self._rejected = True
+        self._write_in_order(response, close=True)
+
+    def _write_in_order(self, data: bytes, close: bool = False):
+        """
+        Writes data that isn't part of a response once the requests before it have been responded
+        to.
+
+        :param data: The data to write.
+        :param close: If the connection should be closed after writing.
+        """
+        if self._in_flight:
+            # Earlier pipelined requests haven't been responded to yet, so this has to wait until
+            # they have.
+            self.loop.create_task(self._write_after(data, close))
+            return
 
-    async def _wait_wrapper(self):
+        self.raw_write(data)
+        if close:
+            self.close()
+
+    async def _write_after(self, data: bytes, close: bool):
+        async with self.lock:
+            self.raw_write(data)
+            if close:
+                self.close()
+
+    async def _wait_wrapper(self, new_environ: dict, keep_alive: bool):
         try:
             if hasattr(self, "_wait"):
-                await self._wait()
+                await self._wait(new_environ, keep_alive)
             else:
                 return
         except:
@@ -342,71 +785,286 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
             # we might have change protocol by now.
             # if so, don't try and cancel the non-existant thing.
             if hasattr(self, "waiter"):
-                self.waiter.cancel()
-                self.waiter = None
-                self.parser = httptools.HttpRequestParser(self)
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    # Only clear the waiter once every pipelined request is done, as it points at
+                    # the task for the most recent one.
+                    self.waiter = None
+                    if self._shutting_down:
+                        self.close()
+                    elif self.transport.is_closing():
+                        pass
+                    elif self._state == _STATE_PROCESSING:
+                        # Nothing else has been pipelined, so wait for the next request.
+                        self._set_timeout(_STATE_IDLE, self.keep_alive_timeout)
+                    else:
+                        # The next request started arriving while this one was processed. It
+                        # wasn't timed out in the meantime, so its timeout starts now.
+                        self._set_timeout(self._state, self.header_timeout
+                                          if self._state == _STATE_HEADERS else self.body_timeout)
+
+    def _decode_body(self, body: BytesIO, encoding: str) -> BytesIO:
+        """
+        Decompresses the body of the current request.
 
-    async def _wait(self):
+        :param body: The raw body of the request.
+        :param encoding: The Content-Encoding the client sent.
+        :return: The decoded body.
         """
-        The main core of the protocol.
+        # no special encoding
+        if encoding == "identity":
+            pass
+
+        # gzip, decompress as such
+        elif encoding == "gzip":
+            self.logger.debug("Decoding body data as gzip.")
+            try:
+                decompressed_data = gzip.decompress(body.read())
+            except zlib.error:
+                raise _RequestRejected(HTTP_INVALID_COMPRESSION)
+
+            body = BytesIO(decompressed_data)
+
+        # deflate, decompress as such
+        elif encoding == "deflate":
+            z = zlib.decompressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+            try:
+                decompressed_data = z.decompress(body.read())
+            except zlib.error:
+                raise _RequestRejected(HTTP_INVALID_COMPRESSION)
 
-        This constructs a new Werkzeug request from the headers.
+            body = BytesIO(decompressed_data)
+        else:
+            self.logger.error("Unknown Content-Encoding sent by client: {}".format(encoding))
+
+        return body
+
+    def _handle_expect(self, expect: str):
+        """
+        Handles the ``Expect`` header of the current request.
+
+        ``100 Continue`` is only sent if the request would be routed, and its body is not too
+        large. Otherwise, the final response is sent instead and the connection is closed, so the
+        client never sends the body. Either is only sent once the requests pipelined before this one
+        have been responded to.
+
+        :param expect: The value of the Expect header.
+        """
+        if expect.lower() != "100-continue":
+            raise _RequestRejected(HTTP_EXPECTATION_FAILED)
+
+        environ = self._environ
+        try:
+            content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise _RequestRejected(get_formatted_response(BadRequest().get_response(environ),
+                                                          environ))
+
+        if content_length >= self.MAX_BODY_SIZE:
+            raise _RequestRejected(HTTP_TOO_BIG)
+
+        try:
+            self.app.root.match(environ)
+        except RequestRedirect as e:
+            # this is answered without invoking the app, so do what the app would do
+            e.code = 307
+            raise _RequestRejected(get_formatted_response(e.get_response(environ), environ))
+        except HTTPException as e:
+            raise _RequestRejected(get_formatted_response(e.get_response(environ), environ))
+
+        self._write_in_order(HTTP_CONTINUE)
+
+    def _take_body(self, environ: dict) -> BytesIO:
+        """
+        Takes the body of the request that has just been parsed out of the body buffer.
+
+        :param environ: The environment of the request.
+        :return: A new :class:`BytesIO` containing the decoded body.
         """
         # Check if the body has data in it by asking it to tell us what position it's seeked to.
         # If it's > 0, it has data, so we can use it. Otherwise, it doesn't, so it's useless.
         told = self.body.tell()
-        if told:
-            self.logger.debug("Read {} bytes of body data from the connection".format(told))
-            self.body.seek(0)
-            body = self.body
+        if not told:
+            return BytesIO()
+
+        self.logger.debug("Read {} bytes of body data from the connection".format(told))
+        # BytesIO shares the bytes object it is created with, so this is only one copy.
+        body = BytesIO(self.body.getvalue())
+        self.body.seek(0)
+        self.body.truncate()
+
+        encoding = environ.get("HTTP_CONTENT_ENCODING")
+        if encoding is not None:
+            body = self._decode_body(body, encoding)
+
+        return body
+
+    def _build_environ(self) -> dict:
+        """
+        Builds the WSGI environment for the request whose headers have just been parsed.
+
+        This copies everything the request needs out of the per-connection buffers, so that they
+        can be reused for the next request on this connection. ``wsgi.input`` is filled in once
+        the body has been received.
+        """
+        # Split the headers into the ones decoded now, and the ones left for the environment to
+        # decode when they're looked up.
+        environ = {}
+        raw_headers = {}
+        for name, value in self.headers:
+            name = name.lower()
+            key = EAGER_HEADERS.get(name)
+            if key is not None:
+                value = value.decode("latin-1")
+                if key in environ:
+                    value = environ[key] + ("; " if name == b"cookie" else ", ") + value
+                environ[key] = value
+            elif name in raw_headers:
+                raw_headers[name] += b", " + value
+            else:
+                raw_headers[name] = value
+        self.headers.clear()
+
+        if self.full_url == b"*":
+            # ``OPTIONS *`` is about the server as a whole, and isn't a URL.
+            path, query = b"*", None
         else:
-            body = None
-
-        version = self.parser.get_http_version()
-        method = self.parser.get_method().decode()
-
-        for header, value in self.headers:
-            # check if a content-encoding has been passed
-            if header == "Content-Encoding" and body is not None:
-                # no special encoding
-                if value == "identity":
-                    pass
-
-                # gzip, decompress as such
-                elif value == "gzip":
-                    self.logger.debug("Decoding body data as gzip.")
-                    try:
-                        decompressed_data = gzip.decompress(body.read())
-                    except zlib.error:
-                        self.write(HTTP_INVALID_COMPRESSION)
-                        self.close()
-                        return
+            try:
+                url = httptools.parse_url(self.full_url)
+            except httptools.HttpParserInvalidURLError:
+                # Other targets httptools can't parse, such as the authority of a CONNECT, are
+                # split the same way as before.
+                url = urlsplit(self.full_url)
+            path, query = url.path, url.query
+
+        environ["PATH_INFO"] = path.decode("latin-1") if path else ""
+        environ["QUERY_STRING"] = query.decode("latin-1") if query else ""
+        environ["REQUEST_METHOD"] = self._method.decode("latin-1")
+        environ["SERVER_PROTOCOL"] = SERVER_PROTOCOLS.get(self._version) or \
+            "HTTP/" + self._version
+        new_environ = LazyHeaderEnviron(self._environ_template, raw_headers)
+        new_environ.update(environ)
+        return new_environ
+
+    def switch_to_http2(self, data: bytes = b"", **kwargs) -> H2KyoukaiProtocol:
+        """
+        Replaces this protocol with a :class:`.H2KyoukaiProtocol` for the rest of the connection.
 
-                    body = BytesIO(decompressed_data)
+        :param data: Any data that has already been received for the HTTP/2 connection.
+        :param kwargs: Passed to :meth:`.H2KyoukaiProtocol.connection_made`, for h2c upgrades.
+        :return: The new protocol.
+        """
+        # Copy the transport into our local scope, as it becomes None after we've switched type.
+        # Once we've replaced ourselves, call `connection_made` on the new type to initialize.
+        transport = self.transport
+        self._cancel_timeout()
+        new_self = self.replace(H2KyoukaiProtocol)  # type: H2KyoukaiProtocol
+        type(new_self).connection_made(new_self, transport, **kwargs)
+        if data and not transport.is_closing():
+            type(new_self).data_received(new_self, data)
+
+        return new_self
+
+    def _receive_upgrade_body(self, data: bytes):
+        """
+        Receives the body of a h2c upgrade request, and switches to HTTP/2 once it is complete.
 
-                # deflate, decompress as such
-                elif value == "deflate":
-                    z = zlib.decompressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    try:
-                        decompressed_data = z.decompress(body.read())
-                    except zlib.error:
-                        self.write(HTTP_INVALID_COMPRESSION)
-                        self.close()
-                        return
+        :param data: Data received after the request headers.
+        """
+        body, data = data[:self._upgrade_body_left], data[self._upgrade_body_left:]
+        self.body.write(body)
+        self._upgrade_body_left -= len(body)
+        if self._upgrade_body_left:
+            # The body timeout is an inactivity timeout, so push it back.
+            self._deadline = self.loop.time() + self.body_timeout
+            return
 
-                    body = BytesIO(decompressed_data)
+        self._upgrade_body_left = None
+        self._upgrade_to_h2c(data)
+
+    def _upgrade_to_h2c(self, data: bytes):
+        """
+        Switches to HTTP/2 after a h2c upgrade request has been received in full.
+
+        :param data: Any data the client sent after the request, which is HTTP/2.
+        """
+        # send a 101 switching protocols
+        self.write(HTTP_SWITCHING_PROTOCOLS)
+
+        # The body is passed on as it was sent, along with its Content-Encoding header, the same
+        # as the body of any other HTTP/2 request.
+        body = self.body.getvalue()
+        self.body.seek(0)
+        self.body.truncate()
+
+        # The client sends the HTTP/2 preface once it has the 101, but it might have been sent
+        # along with the request anyway.
+        # h2 base64 decodes the settings packet itself, and the request is answered on stream 1.
+        self.switch_to_http2(data, upgrade_settings=self._environ["HTTP_HTTP2_SETTINGS"],
+                             upgrade_headers=get_upgrade_headers(self._environ),
+                             upgrade_body=body)
+
+    def _upgrade_websocket(self, extra: bytes):
+        """
+        Starts handling a WebSocket upgrade request.
+
+        The request is passed to the app like any other. The protocol is only swapped once the
+        route accepts the WebSocket.
+
+        :param extra: Any data the client sent after the upgrade request.
+        """
+        self._cancel_timeout()
+
+        environ = self._environ
+        environ["wsgi.input"] = BytesIO()
+
+        websocket = WebSocket(self, environ,
+                              max_queue=self.component.cfg.get("websocket_max_queue", 32))
+        websocket._buffered += extra
+        environ["kyoukai.websocket"] = websocket
+        self._websocket = websocket
+
+        self.loop.create_task(self._wait_websocket(environ, websocket))
+
+    async def _wait_websocket(self, new_environ: dict, websocket: WebSocket):
+        """
+        Runs the app for a WebSocket upgrade request.
+
+        If the route accepted the WebSocket, it is closed once the route returns. Otherwise, the
+        route's response is sent as a normal HTTP response.
+        """
+        new_r = self.app.request_class(new_environ, False)
+
+        async with self.lock:
+            try:
+                result = await self.app.process_request(new_r, self.parent_context)
+            except Exception:
+                self.logger.exception("Error in Kyoukai request handling!")
+                result = None
+
+            if websocket.accepted:
+                # This object is now a WebSocketProtocol, so only the WebSocket can be used.
+                if result is None or result.status_code >= 500:
+                    await websocket.close(CLOSE_INTERNAL_ERROR)
                 else:
-                    self.logger.error("Unknown Content-Encoding sent by client: {}".format(value))
+                    await websocket.close()
+                return
 
-        new_environ = to_wsgi_environment(headers=self.headers, method=method, path=self.full_url,
-                                          http_version=version, body=body)
+            if result is None:
+                self._raw_write(CRITICAL_ERROR_TEXT.encode("utf-8"))
+            else:
+                self.write_response(result, new_environ)
+            self.close()
 
-        new_environ["kyoukai.protocol"] = self
-        new_environ["SERVER_NAME"] = self.component.get_server_name()
-        new_environ["SERVER_PORT"] = str(self.server_port)
-        new_environ["REMOTE_ADDR"] = self.ip
-        new_environ["REMOTE_PORT"] = self.client_port
+    async def _wait(self, new_environ: dict, keep_alive: bool):
+        """
+        The main core of the protocol.
 
+        This constructs a new Werkzeug request from the environment, and passes it to the app.
+
+        :param new_environ: The WSGI environment for this request.
+        :param keep_alive: If the connection should be kept open after this request.
+        """
         # Construct a Request object.
         new_r = self.app.request_class(new_environ, False)
 
@@ -421,16 +1079,77 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
                 self._raw_write(CRITICAL_ERROR_TEXT.encode("utf-8"))
                 return
             else:
+                if self._shutting_down:
+                    result.headers["Connection"] = "close"
+
                 # Write the response.
-                self.write_response(result, new_environ)
+                if is_streaming_response(result):
+                    if not await self.write_streaming_response(result, new_environ):
+                        keep_alive = False
+                else:
+                    self.write_response(result, new_environ)
             finally:
-                if not self.parser.should_keep_alive():
+                if not keep_alive:
                     self.close()
-                # unlock the event and remove the waiter
-                self.parser = httptools.HttpRequestParser(self)
+
+    # timeouts
+    def _set_timeout(self, state: int, timeout: float):
+        """
+        Moves the connection into a new state, and sets the deadline for that state.
+
+        :param state: The new connection state.
+        :param timeout: The number of seconds from now the deadline is at.
+        """
+        self._state = state
+        self._deadline = deadline = self.loop.time() + timeout
+
+        if self._timer is not None:
+            if self._timer_when <= deadline:
+                # The pending timer will fire first, and re-arm itself for the new deadline.
+                return
+
+            self._timer.cancel()
+
+        self._timer_when = deadline
+        self._timer = self.loop.call_at(deadline, self._on_timeout)
+
+    def _cancel_timeout(self):
+        """
+        Cancels the timeout on this connection.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timeout(self):
+        """
+        Called when the timer handle fires.
+
+        If the deadline was moved in the meantime, the timer is simply re-armed. Nothing is timed
+        out while the app is processing a request; a request pipelined behind it is timed once it
+        has been responded to.
+        """
+        self._timer = None
+        if self._state == _STATE_PROCESSING or self._in_flight or self.transport is None:
+            return
+
+        if self.loop.time() < self._deadline:
+            self._timer_when = self._deadline
+            self._timer = self.loop.call_at(self._deadline, self._on_timeout)
+            return
+
+        if self._state == _STATE_IDLE:
+            self.logger.debug("Closing idle connection from {}:{}".format(self.ip,
+                                                                          self.client_port))
+        else:
+            self.logger.debug("Request from {}:{} timed out".format(self.ip, self.client_port))
+            self.write(HTTP_REQUEST_TIMEOUT)
+
+        self.close()
 
     # transport methods
     def close(self):
+        self._flush()
         return self.transport.close()
 
     def write_response(self, response: Response, fake_environ: dict):
@@ -439,6 +1158,86 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
         """
         return self.raw_write(get_formatted_response(response, fake_environ))
 
+    async def write_streaming_response(self, response: Response, fake_environ: dict) -> bool:
+        """
+        Writes a Werkzeug response with an asynchronous body to the transport, sending each part
+        of the body as it is produced.
+
+        HTTP/1.1 clients get the body with chunked transfer encoding. Anything older gets the body
+        as-is, and the connection is closed afterwards to mark the end of it.
+
+        :return: If the connection can be kept alive afterwards.
+        """
+        chunked = fake_environ.get("SERVER_PROTOCOL") == "HTTP/1.1"
+        body = response.response
+
+        if fake_environ["REQUEST_METHOD"] == "HEAD" or response.status_code in (204, 304):
+            self.raw_write(get_formatted_response_head(response, fake_environ))
+            self._stream_task = self.loop.create_task(self._write_body(body, b"", False, True))
+        else:
+            self.raw_write(get_formatted_response_head(response, fake_environ, chunked))
+            self._stream_task = self.loop.create_task(
+                self._write_body(body, response.charset, chunked, False)
+            )
+
+        try:
+            await self._stream_task
+        except asyncio.CancelledError:
+            # The client went away.
+            return False
+        finally:
+            self._stream_task = None
+
+        return chunked
+
+    async def _write_body(self, body: typing.AsyncIterable, charset: str, chunked: bool,
+                          discard: bool):
+        """
+        Writes an asynchronous body to the transport.
+
+        :param body: The body to write.
+        :param charset: The charset to encode str parts with.
+        :param chunked: If the body should be written with chunked transfer encoding.
+        :param discard: If the body should be closed without writing any of it.
+        """
+        try:
+            if discard:
+                return
+
+            async for part in body:
+                if isinstance(part, str):
+                    part = part.encode(charset)
+
+                # An empty chunk would end the body early.
+                if not part:
+                    continue
+
+                if chunked:
+                    part = b"%x\r\n%b\r\n" % (len(part), part)
+
+                self.raw_write(part)
+                # Don't pull any more of the body until the client has caught up.
+                await self.drain()
+
+            if chunked:
+                self.raw_write(b"0\r\n\r\n")
+        finally:
+            aclose = getattr(body, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def drain(self):
+        """
+        Waits until the transport's write buffer has drained below the low water mark.
+
+        This returns straight away if the buffer isn't full, or the connection is closed.
+        """
+        if self._writing_paused and not self.transport.is_closing():
+            if self._drain_waiter is None or self._drain_waiter.done():
+                self._drain_waiter = self.loop.create_future()
+
+            await self._drain_waiter
+
     def write(self, data: str):
         """
         Writes data to the socket.
@@ -454,12 +1253,42 @@ class KyoukaiProtocol(asyncio.Protocol):  # pragma: no cover
 
     def _raw_write(self, data: bytes):
         """
-        Does a raw write to the underlying transport, if we can.
+        Queues a raw write to the underlying transport.
+
+        Writes are coalesced, and flushed together once per event loop iteration, so that a
+        response and any pipelined responses after it go out in a single send. The queue is
+        flushed early once it reaches the write buffer's low water mark.
 
         :param data: The data to write.
         """
+        self._pending_writes.append(data)
+        self._pending_size += len(data)
+
+        if self._pending_size >= self.write_buffer_low:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        """
+        Writes any queued data to the underlying transport, if we can.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._pending_writes:
+            return
+
+        pending = self._pending_writes
+        self._pending_writes = []
+        self._pending_size = 0
+
         try:
-            self.transport.write(data)
+            if len(pending) == 1:
+                self.transport.write(pending[0])
+            else:
+                self.transport.writelines(pending)
         except OSError:
             # connection might be closed...
             # just ignore it.
@@ -0,0 +1,194 @@
+"""
+HTTP/2 stream prioritisation.
+
+This implements the priority tree from RFC 7540, section 5.3. Every stream depends on a parent
+stream, or on the root of the tree, and has a weight from 1 to 256.
+
+A stream that is ready to send is always picked before any of the streams that depend on it. If a
+stream isn't ready, its share goes to its dependent streams instead, split between them in
+proportion to their weights. Siblings are picked with stride scheduling: each time a stream is
+picked, its pass is moved forward by an amount inversely proportional to its weight, and the
+ready sibling with the lowest pass goes next.
+"""
+import typing
+
+#: The weight of a stream that the client has not prioritised.
+DEFAULT_WEIGHT = 16
+
+# The pass a stream with a weight of 1 moves forward by each time it is picked.
+STRIDE = 256
+
+
+class _Node(object):
+    __slots__ = ("stream_id", "weight", "parent", "children", "active", "count", "pass_", "vtime")
+
+    def __init__(self, stream_id: int, weight: int = DEFAULT_WEIGHT):
+        self.stream_id = stream_id
+        self.weight = weight
+        self.parent = None  # type: _Node
+        self.children = []  # type: typing.List[_Node]
+
+        # If this stream is ready to send.
+        self.active = False
+        # The number of ready streams in this subtree, including this one.
+        self.count = 0
+
+        # The stride scheduling pass of this stream, among its siblings.
+        self.pass_ = 0.0
+        # The pass of the child that was last picked, which newly ready children start from.
+        self.vtime = 0.0
+
+
+class PriorityTree(object):
+    """
+    Picks which of the ready streams on a HTTP/2 connection sends next.
+    """
+
+    def __init__(self):
+        self._root = _Node(0, STRIDE)
+        self._nodes = {}  # type: typing.Dict[int, _Node]
+
+    def __contains__(self, stream_id: int) -> bool:
+        return stream_id in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def insert(self, stream_id: int, depends_on: int = None, weight: int = None,
+               exclusive: bool = False):
+        """
+        Adds a new stream to the tree.
+
+        :param stream_id: The stream to add.
+        :param depends_on: The stream this one depends on. If this is None, or not in the tree, \
+            the stream depends on the root with the default weight.
+        :param weight: The weight of the stream, from 1 to 256.
+        :param exclusive: If this stream should become the only dependency of its parent, \
+            taking over the parent's other dependencies.
+        """
+        if stream_id in self._nodes:
+            self.reprioritize(stream_id, depends_on, weight, exclusive)
+            return
+
+        parent = self._nodes.get(depends_on, self._root)
+        if parent is self._root and depends_on:
+            # RFC 7540 5.3.1: a dependency on an unknown stream gets the default priority.
+            weight, exclusive = None, False
+
+        node = _Node(stream_id, weight or DEFAULT_WEIGHT)
+        self._nodes[stream_id] = node
+        self._attach(node, parent, exclusive)
+
+    def reprioritize(self, stream_id: int, depends_on: int = None, weight: int = None,
+                     exclusive: bool = False):
+        """
+        Changes the priority of a stream, from a PRIORITY frame.
+
+        Streams that aren't in the tree yet are added to it.
+        """
+        node = self._nodes.get(stream_id)
+        if node is None:
+            self.insert(stream_id, depends_on, weight, exclusive)
+            return
+
+        parent = self._nodes.get(depends_on, self._root)
+        if parent is node:
+            # A stream can't depend on itself; h2 treats this as a protocol error.
+            return
+
+        # RFC 7540 5.3.3: if the new parent depends on this stream, it is moved up to take this
+        # stream's place first.
+        ancestor = parent.parent
+        while ancestor is not None and ancestor is not node:
+            ancestor = ancestor.parent
+        if ancestor is node:
+            self._detach(parent)
+            self._attach(parent, node.parent)
+
+        self._detach(node)
+        node.weight = weight or DEFAULT_WEIGHT
+        self._attach(node, parent, exclusive)
+
+    def remove(self, stream_id: int):
+        """
+        Removes a stream from the tree. The streams that depended on it depend on its parent.
+        """
+        node = self._nodes.pop(stream_id, None)
+        if node is None:
+            return
+
+        self._set_active(node, False)
+        parent = node.parent
+        for child in list(node.children):
+            self._detach(child)
+            self._attach(child, parent)
+
+        self._detach(node)
+
+    def set_active(self, stream_id: int, active: bool):
+        """
+        Marks a stream as ready to send, or not.
+        """
+        node = self._nodes.get(stream_id)
+        if node is not None:
+            self._set_active(node, active)
+
+    def next(self) -> typing.Optional[int]:
+        """
+        Picks the next stream to send from.
+
+        :return: The stream ID, or None if no stream is ready.
+        """
+        node = self._root
+        if not node.count:
+            return None
+
+        while True:
+            best = None
+            for child in node.children:
+                if child.count and (best is None or child.pass_ < best.pass_):
+                    best = child
+
+            node.vtime = best.pass_
+            best.pass_ += STRIDE / best.weight
+            if best.active:
+                return best.stream_id
+
+            node = best
+
+    def _set_active(self, node: _Node, active: bool):
+        if node.active == active:
+            return
+
+        node.active = active
+        self._propagate(node, 1 if active else -1)
+
+    def _propagate(self, node: _Node, delta: int):
+        # Updates the ready count of a node and all of its ancestors.
+        while node is not None:
+            was_ready = node.count > 0
+            node.count += delta
+            if not was_ready and node.count and node.parent is not None:
+                # Don't let a stream that has been idle catch up on the passes it missed.
+                node.pass_ = max(node.pass_, node.parent.vtime)
+
+            node = node.parent
+
+    def _attach(self, node: _Node, parent: _Node, exclusive: bool = False):
+        if exclusive:
+            for child in list(parent.children):
+                self._detach(child)
+                self._attach(child, node)
+
+        node.parent = parent
+        parent.children.append(node)
+        if node.count:
+            self._propagate(parent, node.count)
+            node.pass_ = max(node.pass_, parent.vtime)
+
+    def _detach(self, node: _Node):
+        parent = node.parent
+        parent.children.remove(node)
+        node.parent = None
+        if node.count:
+            self._propagate(parent, -node.count)
@@ -0,0 +1,843 @@
+"""
+WebSocket support for the httptools backend.
+
+A WebSocket upgrade request is routed like any other request, with hooks and error handlers
+running as normal. The route function gets a :class:`WebSocket` as ``ctx.websocket``, and the
+handshake is only completed once the route accepts it:
+
+.. code-block:: python
+
+    @app.route("/echo")
+    async def echo(ctx: HTTPRequestContext):
+        await ctx.websocket.accept()
+        async for message in ctx.websocket:
+            await ctx.websocket.send(message)
+
+If the route returns or raises without accepting, the client gets the normal HTTP response instead.
+
+Once accepted, the connection's protocol is swapped for a :class:`WebSocketProtocol` using
+:meth:`.KyoukaiProtocol.replace`.
+"""
+import asyncio
+import base64
+import collections
+import hashlib
+import logging
+import struct
+import typing
+import warnings
+
+from asphalt.core import Context
+
+# The GUID used to calculate Sec-WebSocket-Accept, from RFC 6455.
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Opcodes.
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+DATA_OPCODES = (OP_CONTINUATION, OP_TEXT, OP_BINARY)
+CONTROL_OPCODES = (OP_CLOSE, OP_PING, OP_PONG)
+
+# Close codes.
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_NO_STATUS = 1005
+CLOSE_ABNORMAL = 1006
+CLOSE_INVALID_DATA = 1007
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_TOO_BIG = 1009
+CLOSE_INTERNAL_ERROR = 1011
+CLOSE_TRY_AGAIN_LATER = 1013
+
+HTTP_SWITCHING_PROTOCOLS = """HTTP/1.1 101 SWITCHING PROTOCOLS
+Upgrade: websocket
+Connection: Upgrade
+Sec-WebSocket-Accept: {accept}
+Server: Kyoukai
+X-Powered-By: Kyoukai
+X-HTTP-Backend: httptools
+{headers}
+""".replace("\n", "\r\n")
+
+PROTOCOL_CLASS = "WebSocketProtocol"
+
+
+class WebSocketClosed(Exception):
+    """
+    Raised when sending to or receiving from a WebSocket that has been closed.
+    """
+
+    def __init__(self, code: int, reason: str = ""):
+        super().__init__("WebSocket closed with code {} {}".format(code, reason).rstrip())
+
+        #: The close code sent by the client, or 1006 if the connection was dropped.
+        self.code = code
+
+        #: The close reason sent by the client.
+        self.reason = reason
+
+
+class _ProtocolError(Exception):
+    """
+    Raised when parsing a frame fails. The connection is closed with :attr:`code`.
+    """
+
+    def __init__(self, code: int, reason: str = ""):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+
+def encode_frame(opcode: int, payload: bytes, fin: bool = True) -> bytes:
+    """
+    Encodes a single unmasked WebSocket frame, as sent by a server.
+
+    :param opcode: The opcode of the frame.
+    :param payload: The payload of the frame.
+    :param fin: If this is the final frame of a message.
+    :return: The encoded frame, ready to be written to a transport.
+    """
+    first = opcode | 0x80 if fin else opcode
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", first, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+
+    return header + payload
+
+
+def encode_close(code: int, reason: str = "") -> bytes:
+    """
+    Encodes a close frame.
+
+    :param code: The close code.
+    :param reason: The close reason.
+    """
+    return encode_frame(OP_CLOSE, struct.pack("!H", code) + reason.encode("utf-8"))
+
+
+def unmask(payload: bytes, mask: bytes) -> bytes:
+    """
+    Unmasks the payload of a frame sent by a client.
+
+    This XORs the whole payload as one big integer, which is much faster than doing it byte by
+    byte in Python.
+
+    :param payload: The masked payload.
+    :param mask: The 4-byte masking key.
+    """
+    length = len(payload)
+    if not length:
+        return payload
+
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")) \
+        .to_bytes(length, "little")
+
+
+def is_websocket_handshake(environ: dict) -> bool:
+    """
+    Checks if a request is a valid WebSocket opening handshake.
+
+    This only checks the parts not already checked by the HTTP parser.
+    """
+    return environ.get("REQUEST_METHOD") == "GET" and \
+        environ.get("HTTP_SEC_WEBSOCKET_VERSION") == "13" and \
+        bool(environ.get("HTTP_SEC_WEBSOCKET_KEY"))
+
+
+class WebSocket(object):
+    """
+    A WebSocket connection, as seen by a route function as ``ctx.websocket``.
+
+    Messages are received with :meth:`receive` or by iterating with ``async for``, and sent with
+    :meth:`send`. Both apply backpressure: reading from the client is paused when too many
+    received messages are waiting, and :meth:`send` waits while the transport's write buffer is
+    full.
+    """
+
+    def __init__(self, protocol, environ: dict, *, max_queue: int = 32):
+        """
+        :param protocol: The :class:`.KyoukaiProtocol` that received the handshake.
+        :param environ: The WSGI environment of the handshake request.
+        :param max_queue: The number of received messages to hold before reading is paused.
+        """
+        self._protocol = protocol
+        self.loop = protocol.loop
+
+        #: The WSGI environment of the handshake request.
+        self.environ = environ
+
+        #: If the handshake has been completed.
+        self.accepted = False
+
+        #: If the WebSocket has been closed.
+        self.closed = False
+
+        #: The close code, once closed.
+        self.close_code = None  # type: int
+
+        #: The close reason, once closed.
+        self.close_reason = ""
+
+        #: The subprotocol that was chosen in :meth:`accept`.
+        self.subprotocol = None  # type: str
+
+        self.max_queue = max_queue
+
+        # Received messages waiting for ``receive``.
+        self._messages = collections.deque()
+        self._waiter = None  # type: asyncio.Future
+
+        # Data received after the handshake, but before the protocol was swapped.
+        self._buffered = bytearray()
+
+        # The (hub, channel) pairs this WebSocket is subscribed to, so it can be removed from them
+        # when it's closed.
+        self._subscriptions = set()
+
+    @property
+    def subprotocols(self) -> typing.List[str]:
+        """
+        :return: The subprotocols the client asked for, in order of preference.
+        """
+        header = self.environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL", "")
+        return [p.strip() for p in header.split(",") if p.strip()]
+
+    async def accept(self, subprotocol: str = None, headers: typing.List[tuple] = None):
+        """
+        Completes the handshake, and switches the connection to the WebSocket protocol.
+
+        This is called automatically by :meth:`send` and :meth:`receive` if needed.
+
+        :param subprotocol: The subprotocol to use, from :attr:`subprotocols`.
+        :param headers: Any extra headers to send with the handshake response.
+        """
+        if self.accepted:
+            return
+
+        key = self.environ["HTTP_SEC_WEBSOCKET_KEY"].encode("latin-1")
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode()
+
+        extra_headers = list(headers or [])
+        if subprotocol is not None:
+            extra_headers.append(("Sec-WebSocket-Protocol", subprotocol))
+            self.subprotocol = subprotocol
+
+        headers_fmt = "".join("{}: {}\r\n".format(name, value) for name, value in extra_headers)
+        self._protocol.write(HTTP_SWITCHING_PROTOCOLS.format(accept=accept, headers=headers_fmt))
+
+        # Swap the protocol over, then feed it anything the client already sent.
+        protocol = self._protocol
+        transport = protocol.transport
+        protocol.replace(WebSocketProtocol, self)
+        type(protocol).connection_made(protocol, transport)
+        self.accepted = True
+
+        buffered, self._buffered = self._buffered, None
+        if buffered:
+            protocol.data_received(bytes(buffered))
+
+        if len(self._messages) < self.max_queue:
+            protocol.resume_reading()
+
+    async def receive(self) -> typing.Union[str, bytes]:
+        """
+        Receives the next message from the client.
+
+        :return: A str for text messages, or bytes for binary messages.
+        :raises WebSocketClosed: If the WebSocket is closed.
+        """
+        if not self.accepted:
+            await self.accept()
+
+        while not self._messages:
+            if self.closed:
+                raise WebSocketClosed(self.close_code, self.close_reason)
+
+            self._waiter = self.loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        message = self._messages.popleft()
+        if len(self._messages) < self.max_queue:
+            self._protocol.resume_reading()
+
+        return message
+
+    async def send(self, data: typing.Union[str, bytes]):
+        """
+        Sends a message to the client.
+
+        This waits if the transport's write buffer is full.
+
+        :param data: A str to send a text message, or bytes to send a binary message.
+        :raises WebSocketClosed: If the WebSocket is closed.
+        """
+        if isinstance(data, str):
+            frame = encode_frame(OP_TEXT, data.encode("utf-8"))
+        else:
+            frame = encode_frame(OP_BINARY, bytes(data))
+
+        await self.send_frame(frame)
+
+    async def send_frame(self, frame: bytes):
+        """
+        Sends an already encoded frame to the client.
+
+        :param frame: The frame, from :func:`encode_frame`.
+        """
+        if not self.accepted:
+            await self.accept()
+
+        if self.closed:
+            raise WebSocketClosed(self.close_code, self.close_reason)
+
+        self._protocol.raw_write(frame)
+        await self._protocol.drain()
+
+    async def ping(self, data: bytes = b""):
+        """
+        Sends a ping, and waits for the client to reply with a pong.
+
+        :param data: The ping payload. This must be at most 125 bytes.
+        """
+        if not self.accepted:
+            await self.accept()
+
+        if self.closed:
+            raise WebSocketClosed(self.close_code, self.close_reason)
+
+        await self._protocol.ping(data)
+
+    async def close(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        """
+        Closes the WebSocket, waiting for the client to acknowledge it.
+
+        :param code: The close code to send.
+        :param reason: The close reason to send.
+        """
+        if not self.accepted or self.closed:
+            return
+
+        await self._protocol.close_websocket(code, reason)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except WebSocketClosed:
+            raise StopAsyncIteration
+
+    # Called by the protocol.
+    def _message_received(self, message: typing.Union[str, bytes]):
+        self._messages.append(message)
+        if len(self._messages) >= self.max_queue:
+            self._protocol.pause_reading()
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _connection_closed(self, code: int, reason: str):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.close_code = code
+        self.close_reason = reason
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+        for hub, channel in list(self._subscriptions):
+            hub.unsubscribe(channel, self)
+
+
+class WebSocketHub(object):
+    """
+    A publish/subscribe hub for sending the same message to many WebSockets.
+
+    Each published message is encoded into a frame once, and the same bytes are written to the
+    transport of every subscriber. Subscribers that aren't keeping up are either skipped for that
+    message, or closed, depending on :attr:`slow_consumer_policy`.
+
+    The app has one of these as :attr:`.Kyoukai.hub`:
+
+    .. code-block:: python
+
+        @app.route("/feed")
+        async def feed(ctx: HTTPRequestContext):
+            await ctx.websocket.accept()
+            ctx.app.hub.subscribe("feed", ctx.websocket)
+            async for message in ctx.websocket:
+                pass
+
+        # elsewhere
+        app.hub.publish("feed", "something happened")
+    """
+    #: The number of bytes that may be waiting in a subscriber's write buffer before it is
+    #: considered too slow.
+    MAX_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, *, max_buffer_size: int = None, slow_consumer_policy: str = "skip"):
+        """
+        :param max_buffer_size: The number of bytes that may be waiting in a subscriber's write \
+            buffer before it is considered too slow.
+        :param slow_consumer_policy: What to do with slow subscribers. ``skip`` drops the message \
+            for that subscriber, and ``close`` closes the subscriber's connection.
+        """
+        if slow_consumer_policy not in ("skip", "close"):
+            raise ValueError("slow_consumer_policy must be 'skip' or 'close'")
+
+        self.max_buffer_size = max_buffer_size or self.MAX_BUFFER_SIZE
+        self.slow_consumer_policy = slow_consumer_policy
+
+        # channel -> {websocket: None}
+        # This is a dict rather than a set, so messages go out in subscription order.
+        self._channels = {}  # type: typing.Dict[str, typing.Dict[WebSocket, None]]
+
+    def subscribe(self, channel: str, websocket: WebSocket):
+        """
+        Subscribes a WebSocket to a channel.
+
+        The WebSocket is unsubscribed automatically when it is closed.
+        """
+        if websocket.closed:
+            return
+
+        self._channels.setdefault(channel, {})[websocket] = None
+        websocket._subscriptions.add((self, channel))
+
+    def unsubscribe(self, channel: str, websocket: WebSocket):
+        """
+        Unsubscribes a WebSocket from a channel.
+        """
+        subscribers = self._channels.get(channel)
+        if subscribers is not None:
+            subscribers.pop(websocket, None)
+            if not subscribers:
+                del self._channels[channel]
+
+        websocket._subscriptions.discard((self, channel))
+
+    def subscribers(self, channel: str) -> int:
+        """
+        :return: The number of WebSockets subscribed to a channel.
+        """
+        return len(self._channels.get(channel, ()))
+
+    def publish(self, channel: str, message: typing.Union[str, bytes]) -> int:
+        """
+        Sends a message to every WebSocket subscribed to a channel.
+
+        This doesn't wait for anything to be written.
+
+        :param channel: The channel to publish to.
+        :param message: A str to send a text message, or bytes to send a binary message.
+        :return: The number of subscribers the message was written to.
+        """
+        if isinstance(message, str):
+            frame = encode_frame(OP_TEXT, message.encode("utf-8"))
+        else:
+            frame = encode_frame(OP_BINARY, bytes(message))
+
+        return self.publish_frame(channel, frame)
+
+    def publish_frame(self, channel: str, frame: bytes) -> int:
+        """
+        Writes an already encoded frame to every WebSocket subscribed to a channel.
+
+        :param channel: The channel to publish to.
+        :param frame: The frame, from :func:`encode_frame`.
+        :return: The number of subscribers the frame was written to.
+        """
+        subscribers = self._channels.get(channel)
+        if not subscribers:
+            return 0
+
+        max_buffer_size = self.max_buffer_size
+        close_slow = self.slow_consumer_policy == "close"
+        slow = []
+        sent = 0
+
+        for websocket in subscribers:
+            if not websocket.accepted or websocket.closed:
+                continue
+
+            transport = websocket._protocol.transport
+            if transport.get_write_buffer_size() > max_buffer_size:
+                if close_slow:
+                    slow.append(websocket)
+                continue
+
+            transport.write(frame)
+            sent += 1
+
+        for websocket in slow:
+            websocket._protocol._fail(CLOSE_TRY_AGAIN_LATER, "Too slow")
+
+        return sent
+
+
+class WebSocketProtocol(asyncio.Protocol):  # pragma: no cover
+    """
+    The protocol for a connection that has been upgraded to a WebSocket.
+
+    This parses frames from the client, answers pings, handles the closing handshake, and passes
+    complete messages to its :class:`WebSocket`.
+    """
+    #: The maximum size of a single message, in bytes. Larger messages close the connection with
+    #: code 1009.
+    MAX_SIZE = 1024 * 1024
+
+    #: The number of seconds to wait for the client to acknowledge a close.
+    CLOSE_TIMEOUT = 5.0
+
+    def __init__(self, component, parent_context: Context, websocket: WebSocket):
+        """
+        :param component: The :class:`kyoukai.asphalt.KyoukaiComponent` for this connection.
+        :param parent_context: The parent context for this connection.
+        :param websocket: The :class:`WebSocket` that messages are passed to.
+        """
+        self.component = component
+        self.parent_context = parent_context
+        self.websocket = websocket
+
+        self.loop = component.app.loop
+        self.logger = logging.getLogger("Kyoukai.WebSocket")
+
+        self.max_size = component.cfg.get("websocket_max_size", self.MAX_SIZE)
+
+        # The transport for this connection.
+        self.transport = None  # type: asyncio.WriteTransport
+        self.ip, self.client_port = None, None
+
+        # Data that hasn't been parsed into a frame yet.
+        self._buffer = bytearray()
+
+        # The frames of a fragmented message.
+        self._fragments = []
+        self._fragment_opcode = None
+        self._fragment_size = 0
+
+        # Pings waiting for a pong, in the order they were sent.
+        self._pings = collections.OrderedDict()
+
+        # Set once the closing handshake has started or the connection has been lost.
+        self._closing = False
+        self._close_waiter = None  # type: asyncio.Future
+
+        # Flow control.
+        # Reading and writing may already have been paused while this was still a HTTP
+        # connection.
+        self._reading_paused = getattr(self, "_reading_paused", False)
+        self._writing_paused = getattr(self, "_writing_paused", False)
+        self._drain_waiter = None  # type: asyncio.Future
+
+    # asyncio procs
+    def connection_made(self, transport: asyncio.WriteTransport):
+        """
+        Called when the connection is swapped over to this protocol.
+        """
+        self.transport = transport
+        try:
+            self.ip, self.client_port = transport.get_extra_info("peername")
+        except (TypeError, ValueError):
+            # Unix domain socket peers don't have an address, which is expected.
+            if not isinstance(transport.get_extra_info("peername"), str):
+                warnings.warn("getpeername() returned None, cannot provide "
+                              "transport information.")
+            self.ip, self.client_port = None, None
+
+        # This is the same connection the HTTP protocol was tracked for, so it's still counted.
+        self.logger.debug("WebSocket opened from {}:{}".format(self.ip, self.client_port))
+
+    def connection_lost(self, exc):
+        self.logger.debug("WebSocket lost from {}:{}".format(self.ip, self.client_port))
+        self._closing = True
+        self.websocket._connection_closed(CLOSE_ABNORMAL, "")
+
+        if self._close_waiter is not None and not self._close_waiter.done():
+            self._close_waiter.set_result(None)
+
+        for fut in self._pings.values():
+            if not fut.done():
+                fut.set_exception(WebSocketClosed(self.websocket.close_code,
+                                                  self.websocket.close_reason))
+        self._pings.clear()
+
+        # Wake up anything waiting to write; it will find out it's closed.
+        self.resume_writing()
+
+        self.component.untrack_connection(self)
+        self.component.connection_lost.dispatch(protocol=self)
+
+    def data_received(self, data: bytes):
+        """
+        Called when data is received from the client.
+        """
+        self._buffer += data
+        try:
+            self._parse_frames()
+        except _ProtocolError as e:
+            self.logger.debug("Closing WebSocket with {}: {}".format(e.code, e.reason))
+            self._fail(e.code, e.reason)
+
+    def shutdown(self):
+        """
+        Closes the WebSocket with 1001 Going Away, because the server is shutting down.
+        """
+        self.loop.create_task(self.close_websocket(CLOSE_GOING_AWAY, "Server shutting down"))
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    # frame handling
+    def _parse_frames(self):
+        """
+        Parses as many complete frames out of the buffer as possible.
+        """
+        buf = self._buffer
+        pos = 0
+        try:
+            while not self._closing or self._close_waiter is not None:
+                available = len(buf) - pos
+                if available < 2:
+                    break
+
+                first, second = buf[pos], buf[pos + 1]
+                fin = bool(first & 0x80)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                header_size = 2
+
+                if first & 0x70:
+                    raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Reserved bits set")
+
+                if not second & 0x80:
+                    raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Client frames must be masked")
+
+                if opcode not in DATA_OPCODES and opcode not in CONTROL_OPCODES:
+                    raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Unknown opcode")
+
+                if length == 126:
+                    if available < 4:
+                        break
+                    length, = struct.unpack_from("!H", buf, pos + 2)
+                    header_size = 4
+                elif length == 127:
+                    if available < 10:
+                        break
+                    length, = struct.unpack_from("!Q", buf, pos + 2)
+                    header_size = 10
+
+                if opcode in CONTROL_OPCODES:
+                    if not fin or length > 125:
+                        raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Invalid control frame")
+                elif self._fragment_size + length > self.max_size:
+                    # Checked before waiting for the payload, so it's never buffered.
+                    raise _ProtocolError(CLOSE_TOO_BIG, "Message too big")
+
+                end = pos + header_size + 4 + length
+                if len(buf) < end:
+                    break
+
+                mask = bytes(buf[pos + header_size:pos + header_size + 4])
+                payload = unmask(bytes(buf[pos + header_size + 4:end]), mask)
+                pos = end
+
+                self._handle_frame(fin, opcode, payload)
+        finally:
+            del buf[:pos]
+
+    def _handle_frame(self, fin: bool, opcode: int, payload: bytes):
+        """
+        Handles a single frame.
+        """
+        if opcode == OP_PING:
+            self.raw_write(encode_frame(OP_PONG, payload))
+
+        elif opcode == OP_PONG:
+            # A pong acknowledges the ping with the same payload, and every ping before it.
+            if payload in self._pings:
+                while self._pings:
+                    data, fut = self._pings.popitem(last=False)
+                    if not fut.done():
+                        fut.set_result(None)
+                    if data == payload:
+                        break
+
+        elif opcode == OP_CLOSE:
+            self._handle_close(payload)
+
+        elif opcode == OP_CONTINUATION:
+            if self._fragment_opcode is None:
+                raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Unexpected continuation frame")
+
+            self._fragments.append(payload)
+            self._fragment_size += len(payload)
+            if fin:
+                message = b"".join(self._fragments)
+                opcode = self._fragment_opcode
+                self._fragments = []
+                self._fragment_opcode = None
+                self._fragment_size = 0
+                self._deliver(opcode, message)
+
+        else:
+            if self._fragment_opcode is not None:
+                raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Expected continuation frame")
+
+            if fin:
+                self._deliver(opcode, payload)
+            else:
+                self._fragment_opcode = opcode
+                self._fragments.append(payload)
+                self._fragment_size = len(payload)
+
+    def _deliver(self, opcode: int, message: bytes):
+        """
+        Passes a complete message to the WebSocket.
+        """
+        if opcode == OP_TEXT:
+            try:
+                message = message.decode("utf-8")
+            except UnicodeDecodeError:
+                raise _ProtocolError(CLOSE_INVALID_DATA, "Invalid UTF-8")
+
+        self.websocket._message_received(message)
+
+    def _handle_close(self, payload: bytes):
+        """
+        Handles a close frame from the client.
+        """
+        if len(payload) >= 2:
+            code, = struct.unpack_from("!H", payload)
+            try:
+                reason = payload[2:].decode("utf-8")
+            except UnicodeDecodeError:
+                raise _ProtocolError(CLOSE_INVALID_DATA, "Invalid UTF-8")
+        elif payload:
+            raise _ProtocolError(CLOSE_PROTOCOL_ERROR, "Invalid close frame")
+        else:
+            code, reason = CLOSE_NO_STATUS, ""
+
+        self.websocket._connection_closed(code, reason)
+
+        if self._close_waiter is not None:
+            # This acknowledges our close.
+            if not self._close_waiter.done():
+                self._close_waiter.set_result(None)
+            return
+
+        # The client started the closing handshake, so echo it back and hang up.
+        self._closing = True
+        echo = CLOSE_NORMAL if code == CLOSE_NO_STATUS else code
+        self.raw_write(encode_close(echo))
+        self.transport.close()
+
+    def _fail(self, code: int, reason: str = ""):
+        """
+        Closes the connection without waiting for the client, after a protocol error.
+        """
+        if not self._closing:
+            self._closing = True
+            self.raw_write(encode_close(code, reason))
+
+        self.websocket._connection_closed(code, reason)
+        self.transport.close()
+
+    # websocket methods
+    async def ping(self, data: bytes = b""):
+        """
+        Sends a ping and waits for the matching pong.
+        """
+        if len(data) > 125:
+            raise ValueError("Ping payloads must be at most 125 bytes")
+
+        fut = self._pings.get(data)
+        if fut is None:
+            fut = self._pings[data] = self.loop.create_future()
+            self.raw_write(encode_frame(OP_PING, data))
+
+        await fut
+
+    async def close_websocket(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        """
+        Runs the closing handshake.
+
+        This sends a close frame, waits up to :attr:`CLOSE_TIMEOUT` seconds for the client to
+        send one back, then closes the transport.
+        """
+        if self._closing:
+            return
+
+        self._closing = True
+        self._close_waiter = self.loop.create_future()
+        self.raw_write(encode_close(code, reason))
+        try:
+            await asyncio.wait_for(self._close_waiter, self.CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.debug("Client did not acknowledge WebSocket close in time")
+        finally:
+            self.websocket._connection_closed(code, reason)
+            self.transport.close()
+
+    # flow control
+    def pause_reading(self):
+        """
+        Stops reading from the client, because too many messages are waiting to be received.
+        """
+        if not self._reading_paused and not self._closing:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        """
+        Starts reading from the client again.
+        """
+        if self._reading_paused and not self._closing:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    async def drain(self):
+        """
+        Waits until the transport's write buffer has room.
+        """
+        if self._writing_paused and not self._closing:
+            if self._drain_waiter is None or self._drain_waiter.done():
+                self._drain_waiter = self.loop.create_future()
+
+            await self._drain_waiter
+
+    # transport methods
+    def raw_write(self, data: bytes):
+        """
+        Writes data to the transport.
+        """
+        try:
+            self.transport.write(data)
+        except OSError:
+            # connection might be closed...
+            # just ignore it.
+            return
+
+    def close(self):
+        return self.transport.close()
@@ -0,0 +1,260 @@
+"""
+Server-Sent Events support.
+
+An :class:`SSEResponse` streams events to the client as they are produced, instead of buffering the
+whole body. It works with both the httptools and the HTTP/2 backends.
+
+.. code-block:: python
+
+    stream = EventStream()
+
+    @app.route("/events")
+    async def events(ctx: HTTPRequestContext):
+        return stream.response(ctx.request)
+
+    # anywhere else
+    stream.publish("something happened", event="update")
+"""
+import asyncio
+import collections
+import re
+import typing
+
+from werkzeug.wrappers import Request, Response
+
+# The line endings of the event stream format. Other characters str.splitlines() breaks on, such as
+# U+2028, are part of the data.
+_LINE_ENDINGS = re.compile(r"\r\n|\r|\n")
+
+
+def format_event(data: str, *, event: str = None, id: str = None, retry: int = None) -> bytes:
+    """
+    Serializes a single event into the ``text/event-stream`` format.
+
+    :param data: The event data. This may span multiple lines.
+    :param event: The event type.
+    :param id: The event ID, which the client sends back as ``Last-Event-ID`` when reconnecting.
+    :param retry: The reconnection time the client should use, in milliseconds.
+    :return: The serialized event.
+    :raises ValueError: If the event type or ID contains a line break.
+    """
+    lines = []
+    if event is not None:
+        if _LINE_ENDINGS.search(event):
+            raise ValueError("Event types cannot contain line breaks")
+        lines.append("event: {}".format(event))
+    if id is not None:
+        if _LINE_ENDINGS.search(str(id)):
+            raise ValueError("Event IDs cannot contain line breaks")
+        lines.append("id: {}".format(id))
+    if retry is not None:
+        lines.append("retry: {}".format(int(retry)))
+
+    for line in _LINE_ENDINGS.split(str(data)):
+        lines.append("data: {}".format(line))
+
+    lines.append("\n")
+    return "\n".join(lines).encode("utf-8")
+
+
+# A comment line, which clients ignore. This keeps idle connections (and any proxies) open.
+PING = b": ping\n\n"
+
+
+class _PingingIterator(object):
+    """
+    Wraps an async iterator of events, inserting a ping whenever it's idle for too long.
+    """
+
+    def __init__(self, events: typing.AsyncIterable, ping_interval: float):
+        self._events = events.__aiter__()
+        self._ping_interval = ping_interval
+        self._pending = None  # type: asyncio.Future
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._events.__anext__())
+
+        if self._ping_interval:
+            # the pending event is kept across pings, rather than cancelled
+            done, _ = await asyncio.wait([self._pending], timeout=self._ping_interval)
+            if not done:
+                return PING
+
+        try:
+            event = await self._pending
+        finally:
+            self._pending = None
+
+        if isinstance(event, str):
+            return format_event(event)
+
+        return event
+
+    async def aclose(self):
+        """
+        Stops waiting for the next event.
+        """
+        if self._pending is not None:
+            self._pending.cancel()
+            try:
+                await self._pending
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._pending = None
+
+        aclose = getattr(self._events, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class SSEResponse(Response):
+    """
+    A response that streams Server-Sent Events to the client.
+
+    The events come from an async iterable. Each item can be bytes, which are sent as-is and
+    should come from :func:`format_event`, or a str, which is sent as a data-only event.
+    """
+
+    def __init__(self, events: typing.AsyncIterable, *, ping_interval: float = 15.0, **kwargs):
+        """
+        :param events: The async iterable to take events from.
+        :param ping_interval: The number of seconds without an event before a keep-alive \
+            comment is sent. Set to 0 to disable pings.
+        """
+        kwargs.setdefault("mimetype", "text/event-stream")
+        super().__init__(**kwargs)
+
+        # Set directly, as werkzeug would try to iterate it synchronously.
+        self.response = _PingingIterator(events, ping_interval)
+        self.headers["Cache-Control"] = "no-cache"
+        # Stops nginx from buffering the stream.
+        self.headers["X-Accel-Buffering"] = "no"
+
+
+class _Subscriber(object):
+    """
+    A single client of an :class:`EventStream`.
+    """
+
+    def __init__(self, stream: 'EventStream', backlog: typing.Iterable[bytes]):
+        self._stream = stream
+        self._queue = collections.deque(backlog)
+        self._waiter = None  # type: asyncio.Future
+        self.dropped = False
+
+    def put(self, payload: bytes):
+        if len(self._queue) >= self._stream.max_queue:
+            # This client isn't keeping up. End its stream; it will reconnect with
+            # Last-Event-ID and catch up from the history.
+            self.dropped = True
+            self._stream._subscribers.discard(self)
+        else:
+            self._queue.append(payload)
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        while not self._queue:
+            if self.dropped:
+                raise StopAsyncIteration
+
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        return self._queue.popleft()
+
+    async def aclose(self):
+        self._stream._subscribers.discard(self)
+
+
+class EventStream(object):
+    """
+    A source of events that is shared between many clients.
+
+    Each event is serialized once when it is published, and the same bytes are queued for every
+    subscriber. The most recent events are kept in a ring buffer, so clients that reconnect with a
+    ``Last-Event-ID`` header are sent what they missed.
+    """
+
+    def __init__(self, *, history: int = 100, max_queue: int = 100):
+        """
+        :param history: The number of recent events to keep for clients that reconnect.
+        :param max_queue: The number of events that may be waiting for a single client before \
+            it is disconnected.
+        """
+        self.max_queue = max_queue
+
+        # The ring buffer of (id, payload) for recent events.
+        self._history = collections.deque(maxlen=history)
+        self._subscribers = set()
+        self._last_id = 0
+
+    def publish(self, data: str, *, event: str = None, id: str = None,
+                retry: int = None) -> bytes:
+        """
+        Publishes an event to every subscriber.
+
+        :param data: The event data.
+        :param event: The event type.
+        :param id: The event ID. If this is not provided, an increasing number is used.
+        :param retry: The reconnection time the client should use, in milliseconds.
+        :return: The serialized event.
+        """
+        if id is None:
+            self._last_id += 1
+            id = str(self._last_id)
+
+        payload = format_event(data, event=event, id=id, retry=retry)
+        self._history.append((str(id), payload))
+
+        for subscriber in list(self._subscribers):
+            subscriber.put(payload)
+
+        return payload
+
+    def subscribe(self, last_event_id: str = None) -> typing.AsyncIterator[bytes]:
+        """
+        Subscribes to this stream.
+
+        :param last_event_id: The ID of the last event the client saw. Any later events in the \
+            history are sent first. If the ID is no longer in the history, the whole history is \
+            sent.
+        :return: An async iterator of serialized events.
+        """
+        backlog = []
+        if last_event_id is not None:
+            for index, (id, _) in enumerate(self._history):
+                if id == last_event_id:
+                    backlog = [payload for _, payload in list(self._history)[index + 1:]]
+                    break
+            else:
+                backlog = [payload for _, payload in self._history]
+
+        subscriber = _Subscriber(self, backlog)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def response(self, request: Request, *, ping_interval: float = 15.0) -> SSEResponse:
+        """
+        Creates a :class:`SSEResponse` that streams this to a client.
+
+        :param request: The request, used for its ``Last-Event-ID`` header.
+        :param ping_interval: The number of seconds without an event before a keep-alive \
+            comment is sent.
+        """
+        last_event_id = request.headers.get("Last-Event-ID")
+        return SSEResponse(self.subscribe(last_event_id), ping_interval=ping_interval)
+
+    def __len__(self):
+        return len(self._subscribers)
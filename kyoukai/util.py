@@ -1,11 +1,16 @@
 """
 Misc utilities for usage inside the framework.
 """
+import asyncio
 import json
+import logging
+import socket
 import typing
 
 from werkzeug.wrappers import Response
 
+logger = logging.getLogger("Kyoukai")
+
 
 # response utilities
 def as_html(text: str, code: int = 200, headers: dict = None) -> Response:
@@ -105,3 +110,62 @@ def wrap_response(args, response_class: Response = Response) -> Response:
 
     # Otherwise, wrap it in a response.
     return response_class(args)
+
+
+# event loop utilities
+def new_event_loop(loop: str = None) -> asyncio.AbstractEventLoop:
+    """
+    Creates a new event loop of the named type.
+
+    .. code-block:: python
+
+        loop = new_event_loop("uvloop")
+
+    :param loop: The type of loop to create. ``"uvloop"`` creates a :mod:`uvloop` loop, or the \
+        default asyncio loop if uvloop is not installed. ``"asyncio"`` or None creates the \
+        default asyncio loop.
+    :return: A new event loop.
+    """
+    if loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("uvloop is not installed, falling back to the asyncio event loop.")
+        else:
+            return uvloop.new_event_loop()
+    elif loop not in (None, "asyncio"):
+        raise ValueError("Unknown event loop type '{}'".format(loop))
+
+    return asyncio.new_event_loop()
+
+
+# socket utilities
+def socket_from_fd(fd: int) -> socket.socket:
+    """
+    Creates a socket object for an inherited stream socket.
+
+    ``socket.socket(fileno=fd)`` only detects the family of the socket on Python 3.7 and newer, so
+    it's read with ``SO_DOMAIN`` where the platform has it, or worked out from the socket's address
+    otherwise.
+
+    :param fd: The file descriptor of the socket. The new socket object owns it.
+    :return: The socket object.
+    """
+    # fromfd duplicates the fd, so closing this doesn't close the original.
+    probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if hasattr(socket, "SO_DOMAIN"):
+            family = probe.getsockopt(socket.SOL_SOCKET, socket.SO_DOMAIN)
+        else:
+            # The address is decoded by its real family, whatever the socket object thinks.
+            address = probe.getsockname()
+            if isinstance(address, (str, bytes)):
+                family = socket.AF_UNIX
+            elif len(address) == 4:
+                family = socket.AF_INET6
+            else:
+                family = socket.AF_INET
+    finally:
+        probe.close()
+
+    return socket.socket(family, socket.SOCK_STREAM, fileno=fd)
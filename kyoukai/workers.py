@@ -0,0 +1,680 @@
+"""
+Pre-forked worker processes for the built-in server.
+
+When ``workers`` is more than 1, :meth:`.Kyoukai.run` finalizes the app and then forks that many
+worker processes. Each worker runs its own event loop and accepts from its own listening socket,
+bound with ``SO_REUSEPORT``, so the kernel spreads new connections between them.
+
+The parent process stays behind as a supervisor. It replaces workers that exit unexpectedly, and
+forwards signals to every worker.
+
+The supervisor binds every listening socket itself, and keeps them open. On ``SIGHUP``, it starts
+a new supervisor with the same command, with the sockets passed on as inherited file descriptors,
+so the new code starts a new generation of workers that accept from the same sockets. Once the new
+workers are up, the new supervisor tells the old one through a pipe, and the old supervisor sends
+its workers ``SIGTERM`` and exits once they have drained their connections. No socket is ever
+closed, so no connection is refused during the restart, and if the new code fails to start the old
+supervisor carries on as before.
+
+Before forking, every object the app has created so far is moved out of the garbage collector's
+reach with :func:`gc.freeze`. Otherwise, the first collection in each worker writes to the header
+of every inherited object, and the copy-on-write pages the workers share with the supervisor are
+copied into each of them.
+"""
+import asyncio
+import gc
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import time
+import typing
+
+from asphalt.core import run_application
+
+from kyoukai.util import socket_from_fd
+
+logger = logging.getLogger("Kyoukai.Workers")
+
+#: The signals that are forwarded from the supervisor to every worker.
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2)
+
+#: The signal that makes the supervisor restart with a new generation of workers.
+RELOAD_SIGNAL = signal.SIGHUP
+
+#: The environment variable the listening sockets are passed to a reloaded supervisor in.
+LISTEN_FDS_ENV = "KYOUKAI_LISTEN_FDS"
+
+#: The signals that shut the supervisor down, once the workers have exited.
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class WorkerSupervisor(object):
+    """
+    Forks and supervises the worker processes of a :class:`.KyoukaiComponent`.
+    """
+
+    #: The number of seconds a worker has to stay up for to be considered started.
+    #: Workers that exit sooner than this are restarted after :attr:`RESTART_DELAY`, so that a
+    #: worker which crashes on startup doesn't spin.
+    MIN_UPTIME = 1.0
+
+    #: The number of seconds to wait before restarting a worker that crashed on startup.
+    RESTART_DELAY = 1.0
+
+    def __init__(self, component, workers: int, *, event_loop_policy: str = None):
+        """
+        :param component: The component each worker runs.
+        :param workers: The number of worker processes to keep running.
+        :param event_loop_policy: The asphalt event loop policy each worker runs with.
+        """
+        self.component = component
+        self.app = component.app
+        self.workers = workers
+        self.event_loop_policy = event_loop_policy
+
+        #: The running workers, as a dictionary of pid -> (worker number, start time).
+        self.children = {}
+
+        #: The command used to start a new supervisor on reload.
+        self.command = get_command()
+
+        # The listening sockets, as a dictionary of fd -> socket.
+        self._sockets = {}
+        # The fds of the sockets each worker accepts from, by worker number.
+        self._slots = []
+        # Unix domain socket paths to remove on exit.
+        self._unix_paths = []
+
+        self._stopping = False
+        self._exit_code = 0
+
+        # Signal handlers only wake the main loop up, through this pipe, and it does the work.
+        self._wakeup_fds = None  # type: typing.Tuple[int, int]
+        # Workers waiting to be restarted, as a dictionary of worker number -> time to restart.
+        self._restarts = {}
+        # The time of the next memory report, if they're enabled.
+        self._next_report = None  # type: float
+
+        self._reload_requested = False
+        # The pid of the new supervisor while a reload is in progress, and the pipe it reports
+        # through once its workers have started.
+        self._reload_pid = None  # type: int
+        self._reload_fd = None  # type: int
+        # In a supervisor started by a reload, the pipe to report to the old supervisor through,
+        # and when to report if every worker is still up by then.
+        self._ready_fd = None  # type: int
+        self._ready_deadline = None  # type: float
+
+    def run(self) -> int:
+        """
+        Starts the workers, and supervises them until they have all exited.
+
+        :return: The exit code for the supervisor.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Running multiple workers requires SO_REUSEPORT, which this "
+                               "platform does not support")
+
+        # Finalize once here, so the workers share the routing map instead of building their own.
+        self.app.finalize()
+        if not self._inherit_listeners():
+            self._bind_listeners()
+
+        # Create the SSL context before forking, so the workers share its session ticket keys.
+        self.component.get_ssl_context()
+
+        # gc.freeze is only available on Python 3.7+.
+        if self.component.cfg.get("gc_freeze", True) and hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+            logger.debug("Froze {} objects before forking.".format(gc.get_freeze_count()))
+
+        # Set up before forking, so that no worker exits before it would be noticed.
+        self._wakeup_fds = os.pipe()
+        for fd in self._wakeup_fds:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self._wakeup_fds[1])
+        # SIGCHLD is ignored by default, so it needs a handler to write to the wakeup fd.
+        signal.signal(signal.SIGCHLD, self._handle_child)
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, self._handle_signal)
+        signal.signal(RELOAD_SIGNAL, self._handle_reload)
+
+        for number in range(self.workers):
+            self.spawn(number)
+
+        logger.info("Started {} workers.".format(self.workers))
+        if self._ready_fd is not None:
+            # Only let the old supervisor go once every new worker has stayed up.
+            self._ready_deadline = time.monotonic() + self.MIN_UPTIME
+
+        report_interval = self.component.cfg.get("memory_report_interval", None)
+        if report_interval:
+            self._next_report = time.monotonic() + report_interval
+
+        while self.children or self._restarts:
+            self._wait()
+            self._reap()
+
+            if self._stopping and self._restarts:
+                # These crashed on startup, and were never restarted.
+                self._restarts.clear()
+                self._exit_code = 1
+
+            if self._reload_fd is not None:
+                self._check_reload()
+
+            if self._reload_requested:
+                self._reload_requested = False
+                self._start_reload()
+
+            now = time.monotonic()
+            if self._ready_deadline is not None and now >= self._ready_deadline:
+                self._report_ready()
+
+            if self._next_report is not None and now >= self._next_report:
+                self._next_report = now + report_interval
+                self._report_memory()
+
+            for number, when in list(self._restarts.items()):
+                if now >= when:
+                    del self._restarts[number]
+                    self.spawn(number)
+
+        if self._ready_fd is not None:
+            # Stopped before taking over, so the old supervisor still accepts on these.
+            self._unix_paths = []
+
+        signal.set_wakeup_fd(-1)
+        for fd in self._wakeup_fds:
+            os.close(fd)
+        for fd in (self._reload_fd, self._ready_fd):
+            if fd is not None:
+                os.close(fd)
+
+        for sock in self._sockets.values():
+            sock.close()
+
+        for path in self._unix_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        return self._exit_code
+
+    def _wait(self):
+        """
+        Waits for a signal, a report from a new supervisor, or until the next restart or memory
+        report is due.
+        """
+        deadlines = list(self._restarts.values())
+        for deadline in (self._next_report, self._ready_deadline):
+            if deadline is not None:
+                deadlines.append(deadline)
+
+        fds = [self._wakeup_fds[0]]
+        if self._reload_fd is not None:
+            fds.append(self._reload_fd)
+
+        timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+        select.select(fds, [], [], timeout)
+
+        try:
+            while os.read(self._wakeup_fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _reap(self):
+        """
+        Collects every worker that has exited, and schedules replacements for them.
+        """
+        while self.children or self._reload_pid is not None:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                # Nothing left to wait for, so whatever we thought was still running isn't.
+                self.children.clear()
+                self._reload_pid = None
+                return
+
+            if pid == 0:
+                return
+
+            if pid == self._reload_pid:
+                # The new supervisor's pipe is closed by now too, which _check_reload handles.
+                self._reload_pid = None
+                continue
+
+            number, started = self.children.pop(pid, (None, None))
+            if number is None:
+                continue
+
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if self._stopping:
+                logger.info("Worker {} (pid {}) exited with {}.".format(number, pid, code))
+                continue
+
+            if self._ready_fd is not None:
+                logger.error("Worker {} (pid {}) exited with {} while starting; keeping the "
+                             "previous workers.".format(number, pid, code))
+                self._abort_startup()
+                continue
+
+            logger.warning("Worker {} (pid {}) exited unexpectedly with {}, restarting it."
+                           .format(number, pid, code))
+            # A worker that crashes on startup is restarted after a delay, so it doesn't spin.
+            delay = self.RESTART_DELAY if time.monotonic() - started < self.MIN_UPTIME else 0
+            self._restarts[number] = time.monotonic() + delay
+
+    def _add_socket(self, sock: socket.socket) -> int:
+        self._sockets[sock.fileno()] = sock
+        return sock.fileno()
+
+    def _bind_listeners(self):
+        """
+        Binds the listening sockets for every worker.
+
+        Each worker gets its own socket for every TCP listener, bound with ``SO_REUSEPORT``, so the
+        kernel balances connections between the workers. SO_REUSEPORT doesn't apply to Unix domain
+        sockets, so those are bound once and every worker accepts from the same socket, as with
+        inherited fds.
+        """
+        shared = []
+        per_worker = []
+        for listener in self.component.get_listeners():
+            if "fd" in listener:
+                shared.append(self._add_socket(socket_from_fd(int(listener["fd"]))))
+            elif "path" in listener:
+                path = listener["path"]
+                # Remove a socket left behind by a previous run, like create_unix_server does.
+                if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                    os.unlink(path)
+
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.bind(path)
+                sock.listen(100)
+                shared.append(self._add_socket(sock))
+                self._unix_paths.append(path)
+            else:
+                per_worker.append((listener.get("host", self.component.ip),
+                                   listener.get("port", self.component.port)))
+
+        for _ in range(self.workers):
+            fds = list(shared)
+            for host, port in per_worker:
+                fds.extend(self._add_socket(sock) for sock in bind_tcp(host, port))
+
+            self._slots.append(fds)
+
+    def _inherit_listeners(self) -> bool:
+        """
+        Takes over the listening sockets passed on by the supervisor this one replaced.
+
+        :return: True if there were sockets to take over.
+        """
+        data = os.environ.pop(LISTEN_FDS_ENV, None)
+        if data is None:
+            return False
+
+        try:
+            data = json.loads(data)
+            slots = [[int(fd) for fd in fds] for fds in data["workers"]]
+            unix_paths = [str(path) for path in data["unix_paths"]]
+            ready_fd = int(data["ready_fd"])
+        except (ValueError, TypeError, KeyError) as e:
+            raise RuntimeError("Invalid {}: {!r}".format(LISTEN_FDS_ENV, e)) from e
+
+        if not slots:
+            raise RuntimeError("Invalid {}: no workers".format(LISTEN_FDS_ENV))
+
+        for fd in sorted(set(fd for fds in slots for fd in fds)):
+            try:
+                self._add_socket(socket_from_fd(fd))
+            except OSError as e:
+                for sock in self._sockets.values():
+                    sock.close()
+                self._sockets.clear()
+                raise RuntimeError("Inherited fd {} is not a socket: {}".format(fd, e)) from e
+
+        self._slots = slots
+        self._unix_paths = unix_paths
+        self._ready_fd = ready_fd
+
+        # The sockets were bound for the old number of workers.
+        if len(self._slots) != self.workers:
+            logger.warning("Keeping {} workers; changing the number of workers needs a full "
+                           "restart.".format(len(self._slots)))
+            self.workers = len(self._slots)
+
+        return True
+
+    def reload(self) -> int:
+        """
+        Starts a new supervisor, to start a new generation of workers running fresh code.
+
+        The listening sockets are passed on to the new supervisor. Once its workers have stayed up
+        for :attr:`MIN_UPTIME`, it reports back, and this supervisor stops its own workers and
+        exits. Until then, this supervisor keeps serving, and carries on as before if the new one
+        fails to start.
+
+        :return: The pid of the new supervisor.
+        """
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+
+        data = {
+            "workers": self._slots,
+            "unix_paths": self._unix_paths,
+            "ready_fd": write_fd,
+        }
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = json.dumps(data)
+
+        logger.info("Reloading, with {}.".format(" ".join(self.command)))
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for fd in list(self._sockets) + [write_fd]:
+                    os.set_inheritable(fd, True)
+                os.execve(self.command[0], self.command, env)
+            finally:
+                os._exit(127)
+
+        os.close(write_fd)
+        self._reload_pid = pid
+        self._reload_fd = read_fd
+        return pid
+
+    def _start_reload(self):
+        if self._stopping or self._reload_fd is not None or self._ready_fd is not None:
+            logger.warning("Not reloading while the supervisor is starting, stopping or already "
+                           "reloading.")
+            return
+
+        try:
+            pid = self.reload()
+        except OSError:
+            logger.exception("Failed to reload")
+            return
+
+        logger.info("Started a new supervisor with pid {}.".format(pid))
+
+    def _check_reload(self):
+        """
+        Checks whether the new supervisor has reported back, or has failed to start.
+        """
+        try:
+            data = os.read(self._reload_fd, 64)
+        except BlockingIOError:
+            return
+
+        os.close(self._reload_fd)
+        self._reload_fd = None
+
+        if not data:
+            # The new supervisor closed the pipe without reporting, by exiting or giving up.
+            logger.error("The new supervisor (pid {}) failed to start; keeping the current "
+                         "workers.".format(self._reload_pid))
+            return
+
+        logger.info("The new supervisor (pid {}) has started; stopping {} worker(s)."
+                    .format(self._reload_pid, len(self.children)))
+        # The new supervisor isn't ours to forward signals to or wait for any more.
+        self._reload_pid = None
+        self._stop_workers()
+
+    def _report_ready(self):
+        """
+        Tells the old supervisor that every new worker has started, so that it stops its own.
+        """
+        self._ready_deadline = None
+        try:
+            os.write(self._ready_fd, b"ready")
+        except OSError as e:
+            # The old supervisor has gone away; there is nobody left to tell.
+            logger.warning("Could not report to the previous supervisor: {}".format(e))
+        finally:
+            os.close(self._ready_fd)
+            self._ready_fd = None
+
+    def _abort_startup(self):
+        """
+        Gives up on a reload after a new worker failed to start, and leaves the old supervisor
+        running.
+        """
+        os.close(self._ready_fd)
+        self._ready_fd = None
+        self._ready_deadline = None
+        self._exit_code = 1
+        self._stop_workers()
+
+    def _stop_workers(self):
+        """
+        Stops every worker, and exits once they have drained, leaving the listening sockets to
+        another supervisor.
+        """
+        self._stopping = True
+        self._next_report = None
+        self._restarts.clear()
+        # The other supervisor still accepts on these.
+        self._unix_paths = []
+
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, number: int) -> int:
+        """
+        Forks a new worker process.
+
+        :param number: The number of the worker, from 0 to ``workers - 1``.
+        :return: The pid of the new worker.
+        """
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = self._run_worker(number)
+            except BaseException:
+                logger.exception("Worker {} failed".format(number))
+            finally:
+                # Never return into the supervisor's code.
+                os._exit(code)
+
+        self.children[pid] = (number, time.monotonic())
+        return pid
+
+    def get_memory_usage(self) -> typing.Dict[int, int]:
+        """
+        Gets the unique set size of every worker.
+
+        This is the memory that only that worker uses, and is the amount freed if it exits. Pages
+        still shared with the supervisor aren't counted.
+
+        :return: A dictionary of worker number -> unique set size in bytes.
+        """
+        return {number: get_uss(pid) for pid, (number, _) in self.children.items()}
+
+    def _run_worker(self, number: int) -> int:
+        """
+        Runs the component inside a worker process.
+
+        :return: The exit code for the worker.
+        """
+        # The supervisor's signal handling isn't for the worker.
+        signal.set_wakeup_fd(-1)
+        for fd in self._wakeup_fds:
+            os.close(fd)
+        for fd in (self._reload_fd, self._ready_fd):
+            if fd is not None:
+                os.close(fd)
+        for signum in FORWARDED_SIGNALS + (signal.SIGCHLD,):
+            signal.signal(signum, signal.SIG_DFL)
+        # A SIGHUP sent to the whole process group is for the supervisor to reload on. Inheriting
+        # its handler would make the worker start a second supervisor.
+        signal.signal(RELOAD_SIGNAL, signal.SIG_IGN)
+
+        # The event loop inherited from the supervisor shares its selector with every other
+        # process, so each worker needs a new one. Switching the policy creates one as well.
+        if self.event_loop_policy is None:
+            # A loop given to the app is one of these too, so the app gets the new one.
+            self.app.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.app.loop)
+
+        # Keep only this worker's own sockets open. The shutdown closes them, so the sockets stay
+        # open in the supervisor for the next generation.
+        own = self._slots[number]
+        for fd, sock in self._sockets.items():
+            if fd in own:
+                # The component takes over the fd.
+                sock.detach()
+            else:
+                sock.close()
+
+        self._sockets.clear()
+        self.component.cfg["listeners"] = [{"fd": fd} for fd in own]
+
+        self.component.worker = number
+        try:
+            run_application(self.component, event_loop_policy=self.event_loop_policy)
+        except SystemExit as e:
+            return e.code or 0
+
+        return 0
+
+    def _report_memory(self):
+        try:
+            usage = self.get_memory_usage()
+        except OSError as e:
+            # A worker that has just exited, or a platform without /proc.
+            logger.warning("Could not read the memory usage of the workers: {}".format(e))
+            return
+
+        logger.info("Worker memory (USS): {}, total {:.1f} MiB".format(
+            ", ".join("{}: {:.1f} MiB".format(number, size / 1048576)
+                      for number, size in sorted(usage.items())),
+            sum(usage.values()) / 1048576
+        ))
+
+    def _handle_signal(self, signum: int, frame):
+        if signum in SHUTDOWN_SIGNALS:
+            self._stopping = True
+            self._next_report = None
+            # A new supervisor stopped before it took over must not stop the old one's workers.
+            self._ready_deadline = None
+
+        pids = list(self.children)
+        if self._reload_pid is not None:
+            # A new supervisor that hasn't taken over yet would be left running otherwise.
+            pids.append(self._reload_pid)
+
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _handle_child(self, signum: int, frame):
+        # Only here to wake the main loop up.
+        pass
+
+    def _handle_reload(self, signum: int, frame):
+        # Reloading forks, so it is left to the main loop instead of done inside the handler.
+        self._reload_requested = True
+
+
+def bind_tcp(host: str, port: int) -> typing.List[socket.socket]:
+    """
+    Binds listening sockets for a host and port with ``SO_REUSEPORT``, the same way
+    :meth:`asyncio.AbstractEventLoop.create_server` does.
+
+    :param host: The host to bind to. An empty string or None binds to every interface.
+    :param port: The port to bind to.
+    :return: A socket for every address the host resolves to.
+    """
+    infos = socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM,
+                               flags=socket.AI_PASSIVE)
+    sockets = []
+    for family, type_, proto, _, address in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Stop an IPv6 socket from also binding the IPv4 address.
+            if family == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(address)
+            sock.listen(100)
+        except OSError:
+            sock.close()
+            for other in sockets:
+                other.close()
+            raise
+
+        sockets.append(sock)
+
+    return sockets
+
+
+def get_command() -> typing.List[str]:
+    """
+    Gets the command the current process was started with, to run it again.
+    """
+    # sys.orig_argv (Python 3.10+) keeps ``-m`` and the interpreter's own options.
+    argv = getattr(sys, "orig_argv", None)
+    if argv:
+        return [sys.executable] + argv[1:]
+
+    return [sys.executable] + sys.argv
+
+
+def get_uss(pid: int) -> int:
+    """
+    Gets the unique set size (USS) of a process: the private memory that is not shared with any
+    other process.
+
+    This reads ``/proc``, so it only works on Linux.
+
+    :param pid: The process to measure.
+    :return: The unique set size in bytes.
+    """
+    # smaps_rollup is much faster to read, but only exists since Linux 4.14.
+    path = "/proc/{}/smaps_rollup".format(pid)
+    if not os.path.exists(path):
+        path = "/proc/{}/smaps".format(pid)
+
+    uss = 0
+    with open(path) as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                uss += int(line.split()[1])
+
+    # smaps reports sizes in kB.
+    return uss * 1024
+
+
+def run_workers(component, workers: int, *, event_loop_policy: str = None):
+    """
+    Runs a component in several worker processes, and exits once they have all exited.
+
+    :param component: The component to run.
+    :param workers: The number of worker processes.
+    :param event_loop_policy: The asphalt event loop policy each worker runs with.
+    """
+    # Set up logging the same way the workers' run_application does.
+    logging.basicConfig(level=logging.INFO)
+
+    supervisor = WorkerSupervisor(component, workers, event_loop_policy=event_loop_policy)
+    sys.exit(supervisor.run())
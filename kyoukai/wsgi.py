@@ -56,6 +56,126 @@ class SaneWSGIWrapper(object):
         return self.format()
 
 
+class LazyHeaderEnviron(dict):
+    """
+    A WSGI environment that only decodes request headers when they are looked up.
+
+    Most requests never touch most of their headers, so these are kept as the raw bytes from the
+    parser until something asks for them. Looking up a single ``HTTP_*`` key decodes just that
+    header; anything that needs every key (iteration, ``len``, ``copy``, etc) decodes them all
+    first.
+
+    :param environ: The already decoded part of the environment.
+    :param raw_headers: A dict of lowercase header name to header value, both as bytes. \
+        Repeated headers should already be joined with ``b", "``.
+    """
+    __slots__ = ("_raw_headers",)
+
+    def __init__(self, environ: dict, raw_headers: typing.Dict[bytes, bytes]):
+        super().__init__(environ)
+        self._raw_headers = raw_headers
+
+    def _decode_header(self, key: str):
+        """
+        Decodes the raw header that corresponds to ``key``, if there is one.
+
+        :return: The decoded value, or None if there is no such header.
+        """
+        if not self._raw_headers or not key.startswith("HTTP_"):
+            return None
+
+        raw_name = key[5:].replace("_", "-").lower().encode("latin-1")
+        value = self._raw_headers.pop(raw_name, None)
+        if value is None:
+            return None
+
+        value = value.decode("latin-1")
+        dict.__setitem__(self, key, value)
+        return value
+
+    def decode_all(self):
+        """
+        Decodes every header that has not been looked up yet.
+        """
+        raw_headers, self._raw_headers = self._raw_headers, None
+        if not raw_headers:
+            return
+
+        for name, value in raw_headers.items():
+            key = "HTTP_" + name.decode("latin-1").upper().replace("-", "_")
+            # Anything set on the environment since takes priority over the raw headers.
+            dict.setdefault(self, key, value.decode("latin-1"))
+
+    def __missing__(self, key):
+        value = self._decode_header(key)
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._decode_header(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    # Everything below needs every key, so decodes all of the headers first.
+    def __iter__(self):
+        self.decode_all()
+        return super().__iter__()
+
+    def __len__(self):
+        self.decode_all()
+        return super().__len__()
+
+    def __repr__(self):
+        self.decode_all()
+        return super().__repr__()
+
+    def __eq__(self, other):
+        self.decode_all()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self.decode_all()
+        return super().__ne__(other)
+
+    def __delitem__(self, key):
+        self.decode_all()
+        return super().__delitem__(key)
+
+    def keys(self):
+        self.decode_all()
+        return super().keys()
+
+    def values(self):
+        self.decode_all()
+        return super().values()
+
+    def items(self):
+        self.decode_all()
+        return super().items()
+
+    def pop(self, *args):
+        self.decode_all()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.decode_all()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.decode_all()
+        return super().setdefault(key, default)
+
+    def copy(self) -> dict:
+        self.decode_all()
+        return dict(self)
+
+
 def to_wsgi_environment(headers: list, method: str, path: str,
                         http_version: str, body: BytesIO = None) -> MultiDict:
     """
@@ -128,3 +248,31 @@ def get_formatted_response(response: Response, environment: dict) -> bytes:
     wrapper.unfuck_iterable(iterator)
 
     return wrapper.format()
+
+
+def is_streaming_response(response: Response) -> bool:
+    """
+    Checks if a response has an asynchronous body, which has to be streamed rather than buffered.
+
+    :param response: The response object to check.
+    """
+    return hasattr(response.response, "__aiter__")
+
+
+def get_formatted_response_head(response: Response, environment: dict,
+                                chunked: bool = False) -> bytes:
+    """
+    Transform the status and headers of a Werkzeug response into the head of a HTTP response,
+    without touching the body.
+
+    :param response: The response object to transform.
+    :param chunked: If the body will be sent with chunked transfer encoding.
+    :return: Bytes of text that can be sent to a client, before the body.
+    """
+    headers = response.get_wsgi_headers(environment)
+    if chunked:
+        headers["Transfer-Encoding"] = "chunked"
+
+    wrapper = SaneWSGIWrapper()
+    wrapper.start_response(response.status, headers.to_wsgi_list())
+    return wrapper.format()
@@ -23,6 +23,7 @@ deps = [
     "httptools>=0.0.9,<0.1.0",
     "asphalt>=2.1.1,!=3.0.0",
     "werkzeug>=0.12.0,<0.13.0",
+    # The HTTP/2 backend relies on how h2 3.0 enforces MAX_CONCURRENT_STREAMS.
     "h2>=3.0.0,<3.1.0",
 ]
 
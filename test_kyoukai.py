@@ -1,14 +1,51 @@
 """
 py.test test suite for kyoukai
 """
+import asyncio
+import gc
+import json
+import os
+import shutil
+import signal
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
 import pytest
+from asphalt.core import Context
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.errors import ErrorCodes
+from h2.events import (
+    DataReceived, PushedStreamReceived, RemoteSettingsChanged, StreamEnded, StreamReset
+)
+from h2.settings import SettingCodes, Settings
+from hyperframe.frame import DataFrame, Frame, GoAwayFrame, RstStreamFrame, SettingsFrame
+from werkzeug.exceptions import Forbidden
+from werkzeug.formparser import parse_form_data
 from werkzeug.wrappers import Response
 
 from kyoukai import __version__
-from kyoukai.asphalt import HTTPRequestContext
+from kyoukai.asphalt import OP_PRIORITIZE_CHACHA, HTTPRequestContext, KyoukaiComponent
+from kyoukai.backends.http2 import (
+    H2KyoukaiComponent, H2KyoukaiProtocol, H2State, REQUEST_FINISHED
+)
+from kyoukai.backends.httptools_ import get_upgrade_headers
+from kyoukai.backends.priority import PriorityTree
+from kyoukai.backends.websocket import (
+    encode_frame, unmask, OP_CLOSE, OP_CONTINUATION, OP_PING, OP_PONG, OP_TEXT, WebSocket,
+    WebSocketHub
+)
+from kyoukai.sse import EventStream, SSEResponse, format_event
 from kyoukai.testing import TestKyoukai
-from kyoukai.util import wrap_response
-from kyoukai.wsgi import to_wsgi_environment, get_formatted_response
+from kyoukai.util import socket_from_fd, wrap_response
+from kyoukai.workers import FORWARDED_SIGNALS, RELOAD_SIGNAL, WorkerSupervisor, get_uss
+from kyoukai.wsgi import to_wsgi_environment, get_formatted_response, LazyHeaderEnviron
 
 app = TestKyoukai("kyoukai_test")
 
@@ -69,6 +106,23 @@ async def test_basic_post():
         assert r.data == b"Hello, world!"
 
 
+@pytest.mark.asyncio
+async def test_http_exception():
+    """
+    Tests that HTTP exceptions are turned into their own response.
+    """
+    with app.testing_bp() as bp:
+        @bp.route("/")
+        def root(ctx: HTTPRequestContext):
+            raise Forbidden()
+
+        r = await app.inject_request({}, "/")
+        assert r.status_code == 403
+
+        r = await app.inject_request({}, "/missing")
+        assert r.status_code == 404
+
+
 def test_wrap_response():
     """
     Tests wrapping a Response object.
@@ -108,4 +162,1543 @@ async def test_get_formatted_response():
                            (__version__.encode(), __version__.encode())
 
 
+def test_lazy_header_environ():
+    """
+    Tests that headers in a LazyHeaderEnviron are only decoded when needed.
+    """
+    environ = LazyHeaderEnviron({"PATH_INFO": "/"}, {b"user-agent": b"test",
+                                                     b"x-forwarded-for": b"a, b"})
+    assert environ["HTTP_USER_AGENT"] == "test"
+    assert "HTTP_X_FORWARDED_FOR" in environ
+    assert "HTTP_X_MISSING" not in environ
+    assert environ.get("HTTP_X_MISSING", "default") == "default"
+
+    # anything that needs every key decodes everything first
+    environ["HTTP_USER_AGENT"] = "overridden"
+    assert dict(environ.items()) == {"PATH_INFO": "/", "HTTP_USER_AGENT": "overridden",
+                                     "HTTP_X_FORWARDED_FOR": "a, b"}
+
+
+@pytest.mark.parametrize("so_domain", [True, False])
+def test_socket_from_fd(monkeypatch, so_domain: bool, tmp_path):
+    """
+    Tests that inherited sockets get the right family, with or without SO_DOMAIN.
+    """
+    if not so_domain:
+        monkeypatch.delattr(socket, "SO_DOMAIN", raising=False)
+
+    listeners = [socket.socket(socket.AF_INET), socket.socket(socket.AF_UNIX)]
+    listeners[0].bind(("127.0.0.1", 0))
+    listeners[1].bind(str(tmp_path / "test.sock"))
+    if socket.has_ipv6:
+        listeners.append(socket.socket(socket.AF_INET6))
+        listeners[2].bind(("::1", 0))
+
+    for listener in listeners:
+        with listener:
+            listener.listen()
+            sock = socket_from_fd(os.dup(listener.fileno()))
+            with sock:
+                assert sock.family == listener.family
+                assert sock.type == socket.SOCK_STREAM
+                assert sock.getsockname() == listener.getsockname()
+
+
+@pytest.mark.skipif(shutil.which("openssl") is None, reason="needs the openssl command")
+def test_ssl_context(tmp_path):
+    """
+    Tests the TLS options and cipher order of the SSL context.
+    """
+    certfile, keyfile = str(tmp_path / "server.crt"), str(tmp_path / "server.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def get_ssl_context(**options):
+        options.update(enabled=True, ssl_certfile=certfile, ssl_keyfile=keyfile)
+        return KyoukaiComponent(app, ssl=options).get_ssl_context()
+
+    context = get_ssl_context()
+    ciphers = [c["name"] for c in context.get_ciphers() if c["protocol"] != "TLSv1.3"]
+    assert "CHACHA20" in ciphers[0]
+    assert context.options & OP_PRIORITIZE_CHACHA == 0
+
+    context = get_ssl_context(prefer_chacha20=True, ciphers="ECDH+AESGCM:ECDH+CHACHA20")
+    flags = ssl.OP_CIPHER_SERVER_PREFERENCE | OP_PRIORITIZE_CHACHA
+    if ssl.OPENSSL_VERSION_INFO >= (1, 1, 1):
+        assert context.options & flags == flags
+    else:
+        assert context.options & OP_PRIORITIZE_CHACHA == 0
+    ciphers = [c["name"] for c in context.get_ciphers() if c["protocol"] != "TLSv1.3"]
+    assert "AES" in ciphers[0] and "CHACHA20" in ciphers[-1]
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/smaps"), reason="needs Linux's /proc")
+def test_worker_memory_usage():
+    """
+    Tests measuring the memory only a worker uses.
+    """
+    before = get_uss(os.getpid())
+    assert before > 0
+
+    # touch every page, so that it's really allocated
+    data = bytearray(16 * 1024 * 1024)
+    for i in range(0, len(data), 4096):
+        data[i] = 1
+    assert get_uss(os.getpid()) >= before + len(data) // 2
+
+    supervisor = WorkerSupervisor(KyoukaiComponent(app), 2)
+    supervisor.children = {os.getpid(): (1, time.monotonic())}
+    assert supervisor.get_memory_usage() == {1: pytest.approx(get_uss(os.getpid()), rel=0.1)}
+
+
+def test_worker_signals(monkeypatch):
+    """
+    Tests that a forked worker doesn't keep the supervisor's signal handling.
+    """
+    def run_application(component, **kwargs):
+        reset = (signal.getsignal(RELOAD_SIGNAL) == signal.SIG_IGN and
+                 all(signal.getsignal(signum) == signal.SIG_DFL
+                     for signum in FORWARDED_SIGNALS + (signal.SIGCHLD,)) and
+                 signal.set_wakeup_fd(-1) == -1)
+        sys.exit(0 if reset else 3)
+
+    monkeypatch.setattr("kyoukai.workers.run_application", run_application)
+
+    supervisor = WorkerSupervisor(KyoukaiComponent(app), 1)
+    supervisor._slots = [[]]
+    supervisor._wakeup_fds = os.pipe()
+    signums = FORWARDED_SIGNALS + (signal.SIGCHLD, RELOAD_SIGNAL)
+    original = {signum: signal.getsignal(signum) for signum in signums}
+    try:
+        signal.signal(signal.SIGCHLD, supervisor._handle_child)
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, supervisor._handle_signal)
+        signal.signal(RELOAD_SIGNAL, supervisor._handle_reload)
+
+        pid = supervisor.spawn(0)
+        _, status = os.waitpid(pid, 0)
+    finally:
+        for signum, handler in original.items():
+            signal.signal(signum, handler)
+        for fd in supervisor._wakeup_fds:
+            os.close(fd)
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+@pytest.mark.parametrize("min_uptime", [10, 0])
+def test_worker_restart(monkeypatch, tmp_path, min_uptime: float):
+    """
+    Tests that a worker that exits is restarted, after a delay if it crashed on startup.
+    """
+    starts = tmp_path / "starts"
+
+    def run_application(component, **kwargs):
+        with starts.open("a") as f:
+            f.write("{}\n".format(time.monotonic()))
+        if len(starts.read_text().splitlines()) == 1:
+            sys.exit(1)
+
+        # the restarted worker stops the supervisor
+        os.kill(os.getppid(), signal.SIGTERM)
+        time.sleep(5)
+
+    monkeypatch.setattr("kyoukai.workers.run_application", run_application)
+    monkeypatch.setattr(WorkerSupervisor, "MIN_UPTIME", min_uptime)
+    monkeypatch.setattr(WorkerSupervisor, "RESTART_DELAY", 0.5)
+    monkeypatch.setattr(WorkerSupervisor, "_bind_listeners",
+                        lambda self: setattr(self, "_slots", [[]]))
+
+    supervisor = WorkerSupervisor(KyoukaiComponent(app, gc_freeze=False), 1)
+    signums = FORWARDED_SIGNALS + (signal.SIGCHLD, RELOAD_SIGNAL)
+    original = {signum: signal.getsignal(signum) for signum in signums}
+    try:
+        assert supervisor.run() == 0
+    finally:
+        for signum, handler in original.items():
+            signal.signal(signum, handler)
+
+    first, second = map(float, starts.read_text().splitlines())
+    if min_uptime:
+        assert second - first >= 0.5
+    else:
+        assert second - first < 0.5
+
+
+def test_inherit_listeners(monkeypatch, tmp_path):
+    """
+    Tests taking over the listening sockets passed on by a reload.
+    """
+    supervisor = WorkerSupervisor(KyoukaiComponent(app), 3)
+    monkeypatch.delenv("KYOUKAI_LISTEN_FDS", raising=False)
+    assert not supervisor._inherit_listeners()
+
+    listeners = [socket.socket(socket.AF_INET), socket.socket(socket.AF_UNIX)]
+    listeners[0].bind(("127.0.0.1", 0))
+    listeners[1].bind(str(tmp_path / "test.sock"))
+    for listener in listeners:
+        listener.listen()
+    tcp, unix = (os.dup(listener.fileno()) for listener in listeners)
+
+    read_fd, write_fd = os.pipe()
+    try:
+        for value in ("not json", '{"workers": [[3]]}', '{"workers": [], "unix_paths": [], '
+                      '"ready_fd": 1}', '{"workers": [["a"]], "unix_paths": [], "ready_fd": 1}'):
+            monkeypatch.setenv("KYOUKAI_LISTEN_FDS", value)
+            with pytest.raises(RuntimeError):
+                supervisor._inherit_listeners()
+
+        # a pipe isn't a socket, and the sockets taken over before it are closed again
+        copy = os.dup(unix)
+        bad = os.dup(read_fd)
+        monkeypatch.setenv("KYOUKAI_LISTEN_FDS", json.dumps({
+            "workers": [[copy, bad]], "unix_paths": [], "ready_fd": write_fd
+        }))
+        with pytest.raises(RuntimeError):
+            supervisor._inherit_listeners()
+        assert not supervisor._sockets
+        with pytest.raises(OSError):
+            os.fstat(copy)
+        os.close(bad)
+
+        monkeypatch.setenv("KYOUKAI_LISTEN_FDS", json.dumps({
+            "workers": [[unix, tcp], [unix]], "unix_paths": [str(tmp_path / "test.sock")],
+            "ready_fd": write_fd
+        }))
+        assert supervisor._inherit_listeners()
+        assert "KYOUKAI_LISTEN_FDS" not in os.environ
+
+        # the sockets were bound for two workers, so there are only two
+        assert supervisor.workers == 2
+        assert supervisor._slots == [[unix, tcp], [unix]]
+        assert supervisor._unix_paths == [str(tmp_path / "test.sock")]
+        assert supervisor._ready_fd == write_fd
+        assert supervisor._sockets[tcp].getsockname() == listeners[0].getsockname()
+        assert supervisor._sockets[unix].family == socket.AF_UNIX
+    finally:
+        for sock in list(supervisor._sockets.values()) + listeners:
+            sock.close()
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+@pytest.mark.parametrize("ready", [True, False])
+def test_reload_handoff(ready: bool):
+    """
+    Tests that the old supervisor only stops its workers once the new one reports that it's
+    ready, and keeps them if it never does.
+    """
+    old = WorkerSupervisor(KyoukaiComponent(app), 1)
+    new = WorkerSupervisor(KyoukaiComponent(app), 1)
+    worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    old.children[worker.pid] = (0, time.monotonic())
+
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    old._reload_pid, old._reload_fd = os.getpid(), read_fd
+    new._ready_fd, new._ready_deadline = write_fd, time.monotonic()
+    try:
+        # nothing has been reported yet
+        old._check_reload()
+        assert old._reload_fd == read_fd and not old._stopping
+
+        if ready:
+            new._report_ready()
+        else:
+            # a new worker failed to start
+            new._abort_startup()
+            assert new._exit_code == 1
+        assert new._ready_fd is None and new._ready_deadline is None
+
+        old._check_reload()
+        assert old._reload_fd is None
+        if ready:
+            assert old._stopping and old._reload_pid is None
+            assert worker.wait(5) == -signal.SIGTERM
+        else:
+            assert not old._stopping and old._reload_pid == os.getpid()
+            assert worker.poll() is None
+    finally:
+        if old._reload_fd is not None:
+            os.close(old._reload_fd)
+        worker.kill()
+        worker.wait()
+
+
+def test_websocket_frames():
+    """
+    Tests encoding WebSocket frames, and unmasking client payloads.
+    """
+    assert encode_frame(OP_TEXT, b"hi") == b"\x81\x02hi"
+    assert encode_frame(OP_TEXT, b"a" * 200)[:4] == b"\x81\x7e\x00\xc8"
+    assert encode_frame(OP_TEXT, b"a" * 70000)[:10] == b"\x81\x7f" + (70000).to_bytes(8, "big")
+
+    mask = b"\x01\x02\x03\x04"
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(b"Hello, world!"))
+    assert unmask(masked, mask) == b"Hello, world!"
+    assert unmask(b"", mask) == b""
+
+
+def test_websocket_hub():
+    """
+    Tests publishing to WebSockets through a hub, and skipping slow subscribers.
+    """
+    class FakeTransport:
+        def __init__(self, buffered):
+            self.buffered = buffered
+            self.written = []
+
+        def write(self, data):
+            self.written.append(data)
+
+        def get_write_buffer_size(self):
+            return self.buffered
+
+    class FakeProtocol:
+        def __init__(self, buffered=0):
+            self.loop = app.loop
+            self.transport = FakeTransport(buffered)
+
+    hub = WebSocketHub(max_buffer_size=100)
+    fast, slow = WebSocket(FakeProtocol(), {}), WebSocket(FakeProtocol(buffered=1000), {})
+    for websocket in (fast, slow):
+        websocket.accepted = True
+        hub.subscribe("test", websocket)
+
+    assert hub.publish("test", "hi") == 1
+    assert fast._protocol.transport.written == [b"\x81\x02hi"]
+    assert slow._protocol.transport.written == []
+
+    # closing a websocket unsubscribes it
+    fast._connection_closed(1000, "")
+    assert hub.subscribers("test") == 1
+
+
+def test_sse_event_stream():
+    """
+    Tests serializing events, and resuming from a Last-Event-ID.
+    """
+    assert format_event("a\nb", event="x", id="1") == b"event: x\nid: 1\ndata: a\ndata: b\n\n"
+    # only CR and LF are line breaks, and a trailing one is kept
+    assert format_event("a\r\nb\u2028c\x0b\n") == \
+        "data: a\ndata: b\u2028c\x0b\ndata: \n\n".encode("utf-8")
+    for kwargs in ({"event": "x\ndata: y"}, {"id": "1\r"}):
+        with pytest.raises(ValueError):
+            format_event("a", **kwargs)
+
+    stream = EventStream(history=2)
+    for i in range(3):
+        stream.publish(str(i))
+
+    # only the events after the last ID are replayed
+    assert list(stream.subscribe("2")._queue) == [b"id: 3\ndata: 2\n\n"]
+    # an ID that has left the history replays all of it
+    assert len(stream.subscribe("1")._queue) == 2
+
+    # each event is serialized once, and shared between subscribers
+    first, second = stream.subscribe(), stream.subscribe()
+    stream.publish("shared")
+    assert first._queue[0] is second._queue[0]
+
+
+def test_priority_tree():
+    """
+    Tests that streams are picked by their dependencies and weights.
+    """
+    tree = PriorityTree()
+    tree.insert(1, weight=16)
+    tree.insert(3, weight=48)
+    tree.insert(5, depends_on=1)
+    for stream_id in (1, 3, 5):
+        tree.set_active(stream_id, True)
+
+    # 5 only sends when 1 can't, and the rest is split by weight
+    picked = [tree.next() for _ in range(400)]
+    assert picked.count(1) == 100 and picked.count(3) == 300
+
+    tree.set_active(1, False)
+    picked = [tree.next() for _ in range(400)]
+    assert picked.count(5) == 100 and picked.count(3) == 300
+
+    # an exclusive dependency takes over every other stream
+    tree.insert(7, exclusive=True)
+    tree.set_active(7, True)
+    assert [tree.next() for _ in range(10)] == [7] * 10
+
+    # removing a stream moves its dependencies up to its parent
+    tree.remove(7)
+    assert set(tree.next() for _ in range(10)) == {3, 5}
+    for stream_id in (1, 3, 5):
+        tree.remove(stream_id)
+    assert tree.next() is None and not len(tree)
+
+
+class _MemoryTransport(asyncio.Transport):
+    """
+    A transport that keeps everything written to it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.writes = []
+        self.closed = False
+        self.reading = True
+
+    def write(self, data):
+        self.data += data
+        self.writes.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def set_protocol(self, protocol):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return "127.0.0.1", 12345
+
+        return default
+
+
+def _http11_connection(app: TestKyoukai, **cfg):
+    """
+    Connects a new httptools protocol to an in-memory transport.
+    """
+    app.finalize()
+    component = KyoukaiComponent(app, **cfg)
+    protocol = component.get_protocol(Context(), ("localhost", 4444))
+    transport = _MemoryTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+def _h2_connection(app: TestKyoukai, **cfg):
+    """
+    Connects a HTTP/2 client to a new protocol over an in-memory transport.
+    """
+    app.finalize()
+    component = H2KyoukaiComponent(app, "server.key", "server.crt")
+    component.cfg.update(cfg)
+    protocol = component.get_protocol(Context(), ("localhost", 4444))
+    transport = _MemoryTransport()
+    with warnings.catch_warnings():
+        # this isn't over TLS
+        warnings.simplefilter("ignore")
+        protocol.connection_made(transport)
+
+    client = H2Connection(H2Configuration(client_side=True))
+    client.initiate_connection()
+    return protocol, transport, client
+
+
+@pytest.mark.asyncio
+async def test_http2_stream_cleanup():
+    """
+    Tests that a long-lived HTTP/2 connection doesn't keep anything around for finished streams.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+
+    @h2_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        return Response("Hello, world!")
+
+    protocol, transport, client = _h2_connection(h2_app)
+    headers = [(":method", "GET"), (":path", "/"), (":scheme", "http"),
+               (":authority", "localhost")]
+
+    async def requests(count: int):
+        ended = 0
+        for _ in range(count // 50):
+            for _ in range(50):
+                client.send_headers(client.get_next_available_stream_id(), headers,
+                                    end_stream=True)
+            protocol.data_received(client.data_to_send())
+
+            for _ in range(100):
+                if not protocol.streams:
+                    break
+                await asyncio.sleep(0)
+
+            for event in client.receive_data(bytes(transport.data)):
+                if isinstance(event, DataReceived):
+                    client.acknowledge_received_data(len(event.data), event.stream_id)
+                elif isinstance(event, StreamEnded):
+                    ended += 1
+            transport.data.clear()
+            protocol.data_received(client.data_to_send())
+
+        return ended
+
+    # warm up any caches first
+    assert await requests(200) == 200
+
+    tracemalloc.start()
+    try:
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        assert await requests(2000) == 2000
+        gc.collect()
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    for state in (protocol.streams, protocol.stream_data, protocol.priority,
+                  protocol.body_tasks):
+        assert not state
+
+    # h2 itself remembers every closed stream, in a few dozen bytes, on both sides of the
+    # connection; a leaked H2State, queue, event and task is several KiB per stream
+    assert growth < 2000 * 512
+
+
+@pytest.mark.asyncio
+async def test_http2_shutdown():
+    """
+    Tests that shutting down a HTTP/2 connection sends a GOAWAY, refuses new streams, and lets the
+    streams in progress finish.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h2_app.route("/<int:wait>")
+    async def root(ctx: HTTPRequestContext, wait: int):
+        if wait:
+            await finish.wait()
+        return Response("Hello, world!")
+
+    protocol, transport, client = _h2_connection(h2_app)
+
+    def headers(path: str):
+        return [(":method", "GET"), (":path", path), (":scheme", "http"),
+                (":authority", "localhost")]
+
+    client.send_headers(1, headers("/1"), end_stream=True)
+    client.send_headers(3, headers("/0"), end_stream=True)
+    protocol.data_received(client.data_to_send())
+    await asyncio.sleep(0.01)
+
+    protocol.shutdown()
+    assert not transport.closed
+
+    # this was sent before the client saw the GOAWAY
+    client.send_headers(5, headers("/0"), end_stream=True)
+    protocol.data_received(client.data_to_send())
+
+    finish.set()
+    await asyncio.sleep(0.01)
+    assert transport.closed
+
+    # h2 won't read anything after a GOAWAY, so the frames are read directly
+    frames = []
+    data = memoryview(bytes(transport.data))
+    while data:
+        frame, length = Frame.parse_frame_header(data[:9])
+        frame.parse_body(data[9:9 + length])
+        frames.append(frame)
+        data = data[9 + length:]
+
+    # the connection is closed with a second GOAWAY, which mustn't announce a later stream
+    goaways = [frame for frame in frames if isinstance(frame, GoAwayFrame)]
+    assert [(frame.last_stream_id, frame.error_code) for frame in goaways] == \
+        [(3, ErrorCodes.NO_ERROR)] * 2
+    assert [(frame.stream_id, frame.error_code) for frame in frames
+            if isinstance(frame, RstStreamFrame)] == [(5, ErrorCodes.REFUSED_STREAM)]
+
+    # both streams from before the GOAWAY finished, the waiting one after it was sent
+    bodies = {}
+    for frame in frames:
+        if isinstance(frame, DataFrame):
+            bodies[frame.stream_id] = bodies.get(frame.stream_id, b"") + frame.data
+    assert bodies == {1: b"Hello, world!", 3: b"Hello, world!"}
+    assert {frame.stream_id for frame in frames if "END_STREAM" in frame.flags} == {1, 3}
+    assert frames.index(goaways[0]) < min(i for i, frame in enumerate(frames) if frame.stream_id == 1)
+
+
+@pytest.mark.asyncio
+async def test_http2_server_push():
+    """
+    Tests pushing a resource with a HTTP/2 response.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+    pushed = []
+
+    @h2_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        pushed.append(ctx.push("/style.css", {"Accept": "text/css"}))
+        return Response("Hello, world!")
+
+    @h2_app.route("/style.css")
+    async def style(ctx: HTTPRequestContext):
+        return Response(ctx.request.headers["Accept"])
+
+    async def get(enable_push: bool, max_pushes: int = 100):
+        protocol, transport, client = _h2_connection(h2_app, max_pushes=max_pushes)
+        client.update_settings({SettingCodes.ENABLE_PUSH: int(enable_push)})
+        client.send_headers(1, [(":method", "GET"), (":path", "/"), (":scheme", "http"),
+                                (":authority", "localhost")], end_stream=True)
+        protocol.data_received(client.data_to_send())
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+        bodies = {}
+        for event in client.receive_data(bytes(transport.data)):
+            if isinstance(event, PushedStreamReceived):
+                assert dict(event.headers)[b":path"] == b"/style.css"
+            elif isinstance(event, DataReceived):
+                bodies[event.stream_id] = bodies.get(event.stream_id, b"") + event.data
+        return bodies
+
+    assert await get(True) == {1: b"Hello, world!", 2: b"text/css"}
+    assert await get(False) == {1: b"Hello, world!"}
+    assert await get(True, max_pushes=0) == {1: b"Hello, world!"}
+    assert pushed == [True, False, False]
+
+
+@pytest.mark.asyncio
+async def test_http2_flow_control():
+    """
+    Tests that a HTTP/2 client can only send as much of a body as the app has room for.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+    reading = asyncio.Event()
+
+    @h2_app.route("/", methods=["POST"])
+    async def root(ctx: HTTPRequestContext):
+        await reading.wait()
+        body = await ctx.request.environ["wsgi.input"].read_async()
+        return Response(str(len(body)))
+
+    protocol, transport, client = _h2_connection(h2_app)
+    client.send_headers(1, [(":method", "POST"), (":path", "/"), (":scheme", "http"),
+                            (":authority", "localhost")])
+    protocol.data_received(client.data_to_send())
+
+    body = b"x" * 1024 * 1024
+    sent = 0
+    responses = []
+    for _ in range(200):
+        size = min(client.local_flow_control_window(1), client.max_outbound_frame_size,
+                   len(body) - sent)
+        if size:
+            client.send_data(1, body[sent:sent + size], end_stream=sent + size == len(body))
+            sent += size
+        protocol.data_received(client.data_to_send())
+
+        # nothing has been read, so the client can't send more than its initial window
+        buffered = protocol.streams[1].buffered if 1 in protocol.streams else 0
+        assert buffered <= 65535
+        if sent == 65535:
+            assert client.local_flow_control_window(1) == 0
+            reading.set()
+
+        await asyncio.sleep(0)
+        for event in client.receive_data(bytes(transport.data)):
+            if isinstance(event, DataReceived):
+                responses.append(event.data)
+        transport.data.clear()
+
+    assert sent == len(body)
+    assert responses == [str(len(body)).encode()]
+
+
+@pytest.mark.asyncio
+async def test_http2_connection_window():
+    """
+    Tests that a request body the app doesn't read doesn't stall uploads on other streams.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+
+    @h2_app.route("/stalled", methods=["POST"])
+    async def stalled(ctx: HTTPRequestContext):
+        await asyncio.Event().wait()
+
+    @h2_app.route("/", methods=["POST"])
+    async def root(ctx: HTTPRequestContext):
+        body = await ctx.request.environ["wsgi.input"].read_async()
+        return Response(str(len(body)))
+
+    protocol, transport, client = _h2_connection(h2_app, max_concurrent_streams=10)
+    assert protocol.conn.inbound_flow_control_window == 65535 * 10
+
+    headers = [(":method", "POST"), (":scheme", "http"), (":authority", "localhost")]
+    client.send_headers(1, headers + [(":path", "/stalled")])
+    for offset in range(0, 65535, 16384):
+        client.send_data(1, b"x" * min(16384, 65535 - offset))
+    client.send_headers(3, headers + [(":path", "/")])
+    protocol.data_received(client.data_to_send())
+
+    body = b"x" * 256 * 1024
+    sent = 0
+    responses = []
+    for _ in range(200):
+        size = min(client.local_flow_control_window(3), client.max_outbound_frame_size,
+                   len(body) - sent)
+        if size:
+            client.send_data(3, body[sent:sent + size], end_stream=sent + size == len(body))
+            sent += size
+        protocol.data_received(client.data_to_send())
+
+        await asyncio.sleep(0)
+        for event in client.receive_data(bytes(transport.data)):
+            if isinstance(event, DataReceived):
+                responses.append(event.data)
+        transport.data.clear()
+
+    assert sent == len(body)
+    assert responses == [str(len(body)).encode()]
+    # the stalled stream still only gets its own window
+    assert client.local_flow_control_window(1) == 0
+
+
+@pytest.mark.asyncio
+async def test_http2_body_reading():
+    """
+    Tests reading a HTTP/2 request body from the buffer.
+    """
+    class _Protocol:
+        acknowledged = 0
+
+        def __init__(self):
+            self.component = H2KyoukaiComponent(TestKyoukai("h2_test"), "server.key", "server.crt")
+
+        def acknowledge_data(self, stream_id, size):
+            self.acknowledged += size
+
+    protocol = _Protocol()
+    state = H2State([], 1, protocol)
+    for chunk in (b"hello ", b"wor", b"ld\nsecond line\n"):
+        state.insert_data(chunk)
+
+    assert state.read(3) == b"hel"
+    assert state.readline() == b"lo world\n"
+    buffer = bytearray(4)
+    assert state.readinto(buffer) == 4 and buffer == b"seco"
+    assert state.read() == b"nd line\n"
+    assert state.read() == b""
+    assert protocol.acknowledged == 24
+
+    # werkzeug can parse forms straight from it
+    state = H2State([], 3, protocol)
+    state.insert_data(b"a=1&b=")
+    state.insert_data(b"2")
+    _, form, _ = parse_form_data({"wsgi.input": state, "REQUEST_METHOD": "POST",
+                                  "CONTENT_TYPE": "application/x-www-form-urlencoded",
+                                  "CONTENT_LENGTH": "7"})
+    assert form.to_dict() == {"a": "1", "b": "2"}
+
+    state = H2State([], 5, protocol)
+    loop = asyncio.get_event_loop()
+    reading = loop.create_task(state.read_async())
+    for chunk in (b"one", b"two", REQUEST_FINISHED):
+        await asyncio.sleep(0)
+        state.insert_data(chunk)
+    assert await reading == b"onetwo"
+    assert protocol.acknowledged == 37
+
+
+@pytest.mark.asyncio
+async def test_http2_streaming_backpressure():
+    """
+    Tests that a HTTP/2 response body is only produced as fast as the client receives it.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+    produced = []
+
+    async def generate():
+        for i in range(100):
+            produced.append(i)
+            yield b"x" * 16384
+
+    async def fail():
+        yield b"partial"
+        raise ValueError("oops")
+
+    @h2_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        return Response(generate())
+
+    @h2_app.route("/fail")
+    async def failing(ctx: HTTPRequestContext):
+        return Response(fail())
+
+    async def get(path: str):
+        protocol, transport, client = _h2_connection(h2_app)
+        client.send_headers(1, [(":method", "GET"), (":path", path), (":scheme", "http"),
+                                (":authority", "localhost")], end_stream=True)
+        protocol.data_received(client.data_to_send())
+
+        received, unacknowledged, reset = 0, 0, None
+        for i in range(500):
+            await asyncio.sleep(0)
+            for event in client.receive_data(bytes(transport.data)):
+                if isinstance(event, DataReceived):
+                    received += len(event.data)
+                    unacknowledged += event.flow_controlled_length
+                elif isinstance(event, StreamReset):
+                    reset = event.error_code
+
+            # the client doesn't open its window for a while
+            if i > 50 and unacknowledged and 1 in client.streams:
+                client.acknowledge_received_data(unacknowledged, 1)
+                unacknowledged = 0
+            transport.data.clear()
+            protocol.data_received(client.data_to_send())
+
+            if i == 50 and path == "/":
+                # only the window and the stream's buffer have been produced
+                assert len(produced) <= 10
+
+        return received, reset
+
+    assert await get("/") == (100 * 16384, None)
+    assert len(produced) == 100
+
+    # the client is told the body failed, rather than seeing it end early
+    assert (await get("/fail"))[1] == ErrorCodes.INTERNAL_ERROR
+
+
+@pytest.mark.asyncio
+async def test_http2_settings():
+    """
+    Tests configuring the HTTP/2 settings, and refusing streams past the concurrent stream limit.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h2_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        await finish.wait()
+        return Response("Hello, world!")
+
+    protocol, transport, client = _h2_connection(h2_app, max_concurrent_streams=2,
+                                                 initial_window_size=1048576,
+                                                 max_frame_size=65536, header_table_size=8192)
+    # nothing changes until the client has acknowledged the settings
+    assert protocol.conn.max_inbound_frame_size == 16384
+    assert protocol.conn.decoder.max_allowed_table_size == 4096
+
+    # acknowledge the preamble's settings and the update without reading them, so the client
+    # ignores the limit
+    data = client.data_to_send() + SettingsFrame(0, flags=["ACK"]).serialize() * 2
+    for stream_id in (1, 3, 5):
+        client.send_headers(stream_id, [(":method", "GET"), (":path", "/"), (":scheme", "http"),
+                                        (":authority", "localhost")], end_stream=True)
+    protocol.data_received(data + client.data_to_send())
+    assert protocol.conn.max_inbound_frame_size == 65536
+    assert protocol.conn.decoder.max_allowed_table_size == 8192
+    await asyncio.sleep(0)
+    finish.set()
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+    settings, ended, reset = {}, [], {}
+    for event in client.receive_data(bytes(transport.data)):
+        if isinstance(event, RemoteSettingsChanged):
+            settings.update((code, setting.new_value)
+                            for code, setting in event.changed_settings.items())
+        elif isinstance(event, StreamEnded):
+            ended.append(event.stream_id)
+        elif isinstance(event, StreamReset):
+            reset[event.stream_id] = event.error_code
+
+    assert settings[SettingCodes.MAX_CONCURRENT_STREAMS] == 2
+    assert settings[SettingCodes.INITIAL_WINDOW_SIZE] == 1048576
+    assert settings[SettingCodes.MAX_FRAME_SIZE] == 65536
+    assert settings[SettingCodes.HEADER_TABLE_SIZE] == 8192
+    # a full window for every stream
+    assert client.outbound_flow_control_window == 1048576 * 2
+    assert ended == [1, 3]
+    assert reset == {5: ErrorCodes.REFUSED_STREAM}
+
+
+@pytest.mark.asyncio
+async def test_http2_upgrade():
+    """
+    Tests that the request a h2c upgrade was made with is answered on stream 1.
+    """
+    h2_app = TestKyoukai("h2_test", loop=asyncio.get_event_loop())
+
+    @h2_app.route("/upgrade")
+    async def upgrade(ctx: HTTPRequestContext):
+        return Response("{} {}".format(ctx.request.args["a"], ctx.request.headers["X-Test"]))
+
+    h2_app.finalize()
+    client = H2Connection(H2Configuration(client_side=True))
+    settings = client.initiate_upgrade_connection().decode()
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": "/upgrade", "QUERY_STRING": "a=1",
+        "HTTP_HOST": "localhost", "HTTP_CONNECTION": "Upgrade, HTTP2-Settings",
+        "HTTP_UPGRADE": "h2c", "HTTP_HTTP2_SETTINGS": settings, "HTTP_X_TEST": "2",
+    }
+    headers = get_upgrade_headers(environ)
+    assert headers[:4] == [(":method", "GET"), (":scheme", "http"), (":authority", "localhost"),
+                           (":path", "/upgrade?a=1")]
+    assert headers[4:] == [("x-test", "2")]
+
+    component = H2KyoukaiComponent(h2_app, None, None)
+    protocol = component.get_protocol(Context(), ("localhost", 4444))
+    transport = _MemoryTransport()
+    with warnings.catch_warnings():
+        # this isn't over TLS
+        warnings.simplefilter("ignore")
+        protocol.connection_made(transport, upgrade_settings=settings, upgrade_headers=headers)
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    body = b""
+    for event in client.receive_data(bytes(transport.data)):
+        if isinstance(event, DataReceived):
+            assert event.stream_id == 1
+            body += event.data
+
+    assert body == b"1 2"
+
+
+@pytest.mark.asyncio
+async def test_http11_header_limits():
+    """
+    Tests that requests with too many headers, or headers that are too large, are refused.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    for cfg, headers in (({"max_header_count": 2}, b"A: 1\r\nB: 2\r\nC: 3\r\n"),
+                         ({"max_header_size": 100}, b"A: " + b"a" * 100 + b"\r\n")):
+        protocol, transport = _http11_connection(h11_app, **cfg)
+        protocol.data_received(b"GET / HTTP/1.1\r\n" + headers + b"\r\n")
+        assert transport.data.startswith(b"HTTP/1.1 431 ")
+        assert transport.closed
+
+    # a URL is refused as soon as it gets too long
+    protocol, transport = _http11_connection(h11_app, max_url_size=100)
+    protocol.data_received(b"GET /")
+    for _ in range(3):
+        protocol.data_received(b"a" * 50)
+    assert transport.data.startswith(b"HTTP/1.1 414 ")
+    assert transport.closed
+
+    # a header is refused while it is still being sent, not once all of it has arrived
+    protocol, transport = _http11_connection(h11_app, max_header_size=100)
+    protocol.data_received(b"GET / HTTP/1.1\r\nA: ")
+    for _ in range(200):
+        protocol.data_received(b"a" * 100)
+        if transport.closed:
+            break
+    assert transport.data.startswith(b"HTTP/1.1 431 ")
+    assert transport.closed
+
+
+@pytest.mark.asyncio
+async def test_http11_pipelined_rejection():
+    """
+    Tests that a refused request is answered after the requests pipelined before it.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h11_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        await finish.wait()
+        return Response("Hello, world!")
+
+    protocol, transport = _http11_connection(h11_app, max_header_count=2)
+    protocol.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                           b"GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n")
+    await asyncio.sleep(0.01)
+    assert not transport.data and not transport.closed
+
+    finish.set()
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 200 ")
+    assert transport.data.index(b"HTTP/1.1 431 ") > transport.data.index(b"Hello, world!")
+    assert transport.closed
+
+
+@pytest.mark.asyncio
+async def test_http11_timeouts():
+    """
+    Tests that the header timeout runs from when the connection is made, and doesn't apply to a
+    pipelined request while the request before it is processed.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h11_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        await finish.wait()
+        return Response("Hello, world!")
+
+    # waiting before sending anything doesn't extend the timeout
+    protocol, transport = _http11_connection(h11_app, header_timeout=0.1)
+    await asyncio.sleep(0.06)
+    protocol.data_received(b"GET / HTTP/1.1\r\n")
+    await asyncio.sleep(0.08)
+    assert transport.data.startswith(b"HTTP/1.1 408 ")
+    assert transport.closed
+
+    protocol, transport = _http11_connection(h11_app, header_timeout=0.1)
+    protocol.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\nGET / HTTP/1.1\r\n")
+    await asyncio.sleep(0.15)
+    assert not transport.data and not transport.closed
+
+    # the second request is timed from when the first is responded to
+    finish.set()
+    await asyncio.sleep(0.05)
+    assert transport.data.startswith(b"HTTP/1.1 200 ") and not transport.closed
+    await asyncio.sleep(0.1)
+    assert b"HTTP/1.1 408 " in transport.data
+    assert transport.closed
+
+
+@pytest.mark.asyncio
+async def test_http11_backpressure():
+    """
+    Tests that a streamed body isn't pulled while the transport's write buffer is full.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+    pulled = []
+
+    async def body():
+        for i in range(3):
+            pulled.append(i)
+            yield "part {}".format(i)
+
+    @h11_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        response = Response()
+        response.response = body()
+        return response
+
+    protocol, transport = _http11_connection(h11_app)
+    protocol.pause_writing()
+    protocol.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await asyncio.sleep(0.01)
+    # the first part is written, then nothing more is pulled until the client catches up
+    assert pulled == [0]
+    assert transport.data.endswith(b"6\r\npart 0\r\n")
+
+    protocol.resume_writing()
+    await asyncio.sleep(0.01)
+    assert pulled == [0, 1, 2]
+    assert transport.data.endswith(b"6\r\npart 2\r\n0\r\n\r\n")
+
+
+@pytest.mark.asyncio
+async def test_http11_write_coalescing():
+    """
+    Tests that writes are sent together once per loop iteration, in the order they were made.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    @h11_app.route("/<int:delay>")
+    async def root(ctx: HTTPRequestContext, delay: int):
+        await asyncio.sleep(delay / 100)
+        return Response(str(delay))
+
+    protocol, transport = _http11_connection(h11_app, write_buffer_low=100)
+    protocol.raw_write(b"a")
+    protocol.raw_write(b"b")
+    assert transport.writes == []
+    await asyncio.sleep(0)
+    assert transport.writes == [b"ab"]
+
+    # reaching the low water mark sends everything straight away
+    protocol.raw_write(b"c")
+    protocol.raw_write(b"d" * 100)
+    assert transport.writes[-1] == b"c" + b"d" * 100
+
+    # closing sends anything that's left first
+    protocol.raw_write(b"e")
+    protocol.close()
+    assert transport.writes[-1] == b"e"
+    assert transport.closed
+
+    # pipelined responses are sent in the order of the requests
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(b"GET /2 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                           b"GET /0 HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await asyncio.sleep(0.05)
+    responses = bytes(transport.data).split(b"HTTP/1.1 200 OK")
+    assert len(responses) == 3
+    assert responses[1].endswith(b"\r\n\r\n2") and responses[2].endswith(b"\r\n\r\n0")
+
+
+@pytest.mark.asyncio
+async def test_http11_shutdown():
+    """
+    Tests that shutting down closes idle connections, and lets requests in progress finish first.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h11_app.route("/<int:wait>")
+    async def root(ctx: HTTPRequestContext, wait: int):
+        if wait:
+            await finish.wait()
+        return Response("Hello, world!")
+
+    h11_app.finalize()
+    component = KyoukaiComponent(h11_app, shutdown_timeout=5)
+    connections = []
+    for path in (b"/1", b"/0"):
+        protocol = component.get_protocol(Context(), ("localhost", 4444))
+        transport = _MemoryTransport()
+        protocol.connection_made(transport)
+        protocol.data_received(b"GET " + path + b" HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        connections.append((protocol, transport))
+
+    (busy, busy_transport), (idle, idle_transport) = connections
+    await asyncio.sleep(0.01)
+    assert idle_transport.data.startswith(b"HTTP/1.1 200 ")
+
+    shutdown = asyncio.ensure_future(component.shutdown())
+    await asyncio.sleep(0.01)
+    assert idle_transport.closed
+    idle.connection_lost(None)
+    assert not busy_transport.closed and not busy_transport.data
+    assert not shutdown.done()
+
+    # new connections are turned away
+    protocol = component.get_protocol(Context(), ("localhost", 4444))
+    transport = _MemoryTransport()
+    protocol.connection_made(transport)
+    assert transport.closed
+
+    finish.set()
+    await asyncio.sleep(0.01)
+    assert busy_transport.data.startswith(b"HTTP/1.1 200 ")
+    assert b"\r\nConnection: close\r\n" in busy_transport.data
+    assert busy_transport.closed
+    busy.connection_lost(None)
+    await asyncio.wait_for(shutdown, 1)
+
+
+@pytest.mark.asyncio
+async def test_http11_request_targets():
+    """
+    Tests requests that aren't for a plain path, and that the headers of a request are still
+    available when it asks to be upgraded.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    @h11_app.route("/", methods=["GET", "OPTIONS"])
+    async def root(ctx: HTTPRequestContext):
+        return Response("Hello, world!")
+
+    # ``OPTIONS *`` isn't routed anywhere, but it isn't a bad request either
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(b"OPTIONS * HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 404 ")
+
+    client = H2Connection(H2Configuration(client_side=True))
+    client.local_settings = Settings(initial_values={SettingCodes.INITIAL_WINDOW_SIZE: 1000,
+                                                     SettingCodes.MAX_HEADER_LIST_SIZE: 2000})
+    settings = client.initiate_upgrade_connection()
+    protocol, transport = _http11_connection(h11_app)
+    with warnings.catch_warnings():
+        # this isn't over TLS
+        warnings.simplefilter("ignore")
+        protocol.data_received(b"GET / HTTP/1.1\r\nHost: localhost\r\n"
+                               b"Connection: Upgrade, HTTP2-Settings\r\nUpgrade: h2c\r\n"
+                               b"HTTP2-Settings: " + settings + b"\r\n\r\n")
+    assert transport.data.startswith(b"HTTP/1.1 101 ")
+    # the HTTP2-Settings header is decoded once, and applied as the client's settings
+    assert protocol.conn.remote_settings.initial_window_size == 1000
+    assert protocol.conn.remote_settings.max_header_list_size == 2000
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    h2_data = bytes(transport.data).split(b"\r\n\r\n", 1)[1]
+    body = b"".join(event.data for event in client.receive_data(h2_data)
+                    if isinstance(event, DataReceived) and event.stream_id == 1)
+    assert body == b"Hello, world!"
+
+
+@pytest.mark.asyncio
+async def test_http2_prior_knowledge():
+    """
+    Tests telling HTTP/2 clients with prior knowledge apart from HTTP/1.1 clients.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    @h11_app.route("/", methods=["GET", "POST"])
+    async def root(ctx: HTTPRequestContext):
+        return Response("Hello, world!")
+
+    # the preface, split across reads
+    client = H2Connection(H2Configuration(client_side=True))
+    client.initiate_connection()
+    client.send_headers(1, [(":method", "GET"), (":path", "/"), (":scheme", "http"),
+                            (":authority", "localhost")], end_stream=True)
+    data = client.data_to_send()
+    protocol, transport = _http11_connection(h11_app, http2=True)
+    with warnings.catch_warnings():
+        # this isn't over TLS
+        warnings.simplefilter("ignore")
+        for chunk in (data[:1], data[1:9], data[9:20], data[20:]):
+            protocol.data_received(chunk)
+    assert isinstance(protocol, H2KyoukaiProtocol)
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+    body = b"".join(event.data for event in client.receive_data(bytes(transport.data))
+                    if isinstance(event, DataReceived) and event.stream_id == 1)
+    assert body == b"Hello, world!"
+
+    # a request that starts like the preface, and one that doesn't at all
+    for request in ([b"P", b"OST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n"],
+                    [b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"]):
+        protocol, transport = _http11_connection(h11_app, http2=True)
+        for chunk in request:
+            protocol.data_received(chunk)
+        await asyncio.sleep(0.01)
+        assert not isinstance(protocol, H2KyoukaiProtocol)
+        assert transport.data.startswith(b"HTTP/1.1 200 ")
+        assert transport.data.endswith(b"Hello, world!")
+
+
+@pytest.mark.asyncio
+async def test_http2_upgrade_body():
+    """
+    Tests that the body of a request upgraded with h2c is passed on to stream 1.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    @h11_app.route("/", methods=["POST"])
+    async def root(ctx: HTTPRequestContext):
+        body = await ctx.request.environ["wsgi.input"].read_async()
+        return Response(ctx.request.headers["X-Test"].encode() + body[::-1])
+
+    client = H2Connection(H2Configuration(client_side=True))
+    settings = client.initiate_upgrade_connection()
+    request = (b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\nX-Test: 1\r\n"
+               b"Connection: Upgrade, HTTP2-Settings\r\nUpgrade: h2c\r\n"
+               b"HTTP2-Settings: " + settings + b"\r\n\r\n")
+
+    protocol, transport = _http11_connection(h11_app)
+    with warnings.catch_warnings():
+        # this isn't over TLS
+        warnings.simplefilter("ignore")
+        protocol.data_received(request + b"hel")
+        await asyncio.sleep(0)
+        # nothing is switched until the whole body has arrived
+        assert not transport.data
+        protocol.data_received(b"lo" + client.data_to_send())
+    assert isinstance(protocol, H2KyoukaiProtocol)
+
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert transport.data.startswith(b"HTTP/1.1 101 ")
+    h2_data = bytes(transport.data).split(b"\r\n\r\n", 1)[1]
+    body = b"".join(event.data for event in client.receive_data(h2_data)
+                    if isinstance(event, DataReceived) and event.stream_id == 1)
+    assert body == b"1olleh"
+
+    # a chunked body can't be found the end of without parsing it
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(request.replace(b"Content-Length: 5", b"Transfer-Encoding: chunked") +
+                           b"5\r\nhello\r\n0\r\n\r\n")
+    assert transport.data.startswith(b"HTTP/1.1 400 ")
+    assert transport.closed
+
+
+@pytest.mark.asyncio
+async def test_http11_expect():
+    """
+    Tests that 100 Continue is only sent for requests that would be accepted.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+
+    @h11_app.route("/", methods=["POST"])
+    async def root(ctx: HTTPRequestContext):
+        return Response(ctx.request.data[::-1])
+
+    post = b"POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\nExpect: {}\r\n\r\n"
+
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(post.replace(b"{}", b"/", 1).replace(b"{}", b"100-continue"))
+    await asyncio.sleep(0)
+    assert transport.data == b"HTTP/1.1 100 Continue\r\n\r\n"
+    protocol.data_received(b"olleh")
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 ")
+    assert transport.data.endswith(b"hello")
+
+    # the final response is sent instead, so the client never sends the body
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(post.replace(b"{}", b"/missing", 1).replace(b"{}", b"100-continue"))
+    await asyncio.sleep(0)
+    assert transport.data.startswith(b"HTTP/1.1 404 ")
+    assert transport.closed
+
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(post.replace(b"{}", b"/", 1).replace(b"{}", b"something-else"))
+    await asyncio.sleep(0)
+    assert transport.data.startswith(b"HTTP/1.1 417 ")
+    assert transport.closed
+
+    # HTTP/1.0 clients don't know about Expect, so it's ignored
+    protocol, transport = _http11_connection(h11_app)
+    protocol.data_received(post.replace(b"1.1", b"1.0").replace(b"{}", b"/", 1)
+                           .replace(b"{}", b"100-continue") + b"olleh")
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 200 ")
+    assert transport.data.endswith(b"hello")
+
+
+@pytest.mark.asyncio
+async def test_http11_pipelined_expect():
+    """
+    Tests that the interim or final response to an Expect header is sent after the responses to
+    the requests pipelined before it.
+    """
+    h11_app = TestKyoukai("h11_test", loop=asyncio.get_event_loop())
+    finish = asyncio.Event()
+
+    @h11_app.route("/", methods=["GET", "POST"])
+    async def root(ctx: HTTPRequestContext):
+        await finish.wait()
+        return Response("Hello, world!")
+
+    get = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    post = b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\nExpect: {}\r\n\r\n"
+
+    for expect, interim in ((b"100-continue", b"HTTP/1.1 100 Continue\r\n\r\n"),
+                            (b"something-else", b"HTTP/1.1 417 ")):
+        finish.clear()
+        protocol, transport = _http11_connection(h11_app)
+        protocol.data_received(get + post.replace(b"{}", expect))
+        await asyncio.sleep(0.01)
+        assert not transport.data
+
+        finish.set()
+        await asyncio.sleep(0.01)
+        assert transport.data.startswith(b"HTTP/1.1 200 ")
+        assert transport.data.index(interim) > transport.data.index(b"Hello, world!")
+
+
+@pytest.mark.asyncio
+async def test_sse_response():
+    """
+    Tests streaming Server-Sent Events through the httptools backend.
+    """
+    sse_app = TestKyoukai("sse_test", loop=asyncio.get_event_loop())
+    publish = asyncio.Queue()
+
+    async def events():
+        while True:
+            event = await publish.get()
+            if event is None:
+                return
+            yield event
+
+    @sse_app.route("/events")
+    async def stream(ctx: HTTPRequestContext):
+        return SSEResponse(events(), ping_interval=0)
+
+    protocol, transport = _http11_connection(sse_app)
+    protocol.data_received(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 200 ")
+    assert b"Content-Type: text/event-stream" in transport.data
+
+    # each event is sent as soon as it's produced
+    publish.put_nowait(format_event("a\nb", event="x"))
+    await asyncio.sleep(0.01)
+    assert transport.data.endswith(b"event: x\ndata: a\ndata: b\n\n\r\n")
+    publish.put_nowait("c")
+    await asyncio.sleep(0.01)
+    assert transport.data.endswith(b"data: c\n\n\r\n")
+
+    publish.put_nowait(None)
+    await asyncio.sleep(0.01)
+    assert transport.data.endswith(b"0\r\n\r\n")
+
+
+def _client_frame(opcode: int, payload: bytes, fin: bool = True) -> bytes:
+    """
+    Encodes a masked WebSocket frame, as sent by a client.
+    """
+    mask = b"\x01\x02\x03\x04"
+    frame = encode_frame(opcode, payload, fin)
+    header = frame[:len(frame) - len(payload)]
+    return header[:1] + bytes([header[1] | 0x80]) + header[2:] + mask + unmask(payload, mask)
+
+
+@pytest.mark.asyncio
+async def test_websocket_upgrade():
+    """
+    Tests a WebSocket connection through the httptools backend, from the handshake to the close.
+    """
+    ws_app = TestKyoukai("ws_test", loop=asyncio.get_event_loop())
+    accept = asyncio.Event()
+
+    @ws_app.route("/ws")
+    async def ws(ctx: HTTPRequestContext):
+        await accept.wait()
+        await ctx.websocket.accept()
+        async for message in ctx.websocket:
+            if message == "ping":
+                await ctx.websocket.ping(b"p")
+                message = "pong"
+            await ctx.websocket.send(message)
+
+    handshake = (b"GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                 b"Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                 b"Sec-WebSocket-Version: 13\r\n\r\n")
+
+    protocol, transport = _http11_connection(ws_app, websocket_max_size=10)
+    protocol.data_received(handshake + _client_frame(OP_TEXT, b"hello"))
+    protocol.data_received(_client_frame(OP_TEXT, b"wor", fin=False))
+    # nothing more is read until the route accepts
+    assert not transport.reading
+    await asyncio.sleep(0.01)
+    assert not transport.data
+
+    accept.set()
+    await asyncio.sleep(0.01)
+    assert transport.data.startswith(b"HTTP/1.1 101 ")
+    assert b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n" in transport.data
+    assert transport.reading
+    assert transport.writes[-1] == encode_frame(OP_TEXT, b"hello")
+
+    # the rest of the fragmented message
+    protocol.data_received(_client_frame(OP_CONTINUATION, b"ld"))
+    await asyncio.sleep(0.01)
+    assert transport.writes[-1] == encode_frame(OP_TEXT, b"world")
+
+    protocol.data_received(_client_frame(OP_PING, b"x"))
+    assert transport.writes[-1] == encode_frame(OP_PONG, b"x")
+
+    protocol.data_received(_client_frame(OP_TEXT, b"ping"))
+    await asyncio.sleep(0.01)
+    assert transport.writes[-1] == encode_frame(OP_PING, b"p")
+    protocol.data_received(_client_frame(OP_PONG, b"p"))
+    await asyncio.sleep(0.01)
+    assert transport.writes[-1] == encode_frame(OP_TEXT, b"pong")
+
+    protocol.data_received(_client_frame(OP_CLOSE, struct.pack("!H", 1000)))
+    assert transport.writes[-1] == encode_frame(OP_CLOSE, struct.pack("!H", 1000))
+    assert transport.closed
+
+    # messages over websocket_max_size close the connection without being buffered
+    protocol, transport = _http11_connection(ws_app, websocket_max_size=10)
+    protocol.data_received(handshake)
+    await asyncio.sleep(0.01)
+    protocol.data_received(_client_frame(OP_TEXT, b"a" * 6, fin=False))
+    protocol.data_received(_client_frame(OP_CONTINUATION, b"a" * 6)[:4])
+    assert transport.writes[-1].startswith(encode_frame(OP_CLOSE, b"")[:1])
+    assert transport.writes[-1][2:4] == struct.pack("!H", 1009)
+    assert transport.closed
+
+
+@pytest.mark.asyncio
+async def test_event_loop(monkeypatch):
+    """
+    Tests that the server runs on the loop the component is started on, unless the app was given
+    a different one, and that Kyoukai.run passes the event loop policy on to asphalt.
+    """
+    other_loop = asyncio.new_event_loop()
+    loop_app = TestKyoukai("loop_test", loop=other_loop)
+    with pytest.raises(RuntimeError):
+        await KyoukaiComponent(loop_app, "127.0.0.1", 0).start(Context())
+    assert loop_app.loop is other_loop
+
+    # as if the app was created before asphalt's event loop policy replaced the loop
+    loop_app = TestKyoukai("loop_test")
+    loop_app.loop = other_loop
+    component = KyoukaiComponent(loop_app, "127.0.0.1", 0)
+    await component.start(Context())
+    try:
+        assert loop_app.loop is asyncio.get_event_loop()
+        port = component.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        assert (await reader.readline()).startswith(b"HTTP/1.1 404 ")
+        writer.close()
+    finally:
+        await component.shutdown()
+        other_loop.close()
+
+    calls = []
+    monkeypatch.setattr("kyoukai.app.run_application",
+                        lambda component, **kwargs: calls.append(kwargs))
+    loop_app.run(component=KyoukaiComponent(loop_app, event_loop_policy="uvloop"))
+    loop_app.run(event_loop_policy="asyncio")
+    assert calls == [{"event_loop_policy": "uvloop"}, {"event_loop_policy": "asyncio"}]
+
+
+@pytest.mark.asyncio
+async def test_connection_limit():
+    """
+    Tests that the server stops accepting at the connection limit, and starts again once enough
+    connections have closed.
+    """
+    limit_app = TestKyoukai("limit_test", loop=asyncio.get_event_loop())
+
+    @limit_app.route("/")
+    async def root(ctx: HTTPRequestContext):
+        return Response("Hello, world!")
+
+    component = KyoukaiComponent(limit_app, "127.0.0.1", 0, max_connections=2,
+                                 max_connections_low_water=1)
+    await component.start(Context())
+    port = component.server.sockets[0].getsockname()[1]
+
+    clients = [await asyncio.open_connection("127.0.0.1", port) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    assert component.get_metrics()["connections"] == 2
+    assert not component.get_metrics()["accepting"]
+    assert component.server is None and not component.servers
+
+    # this one waits in the listen backlog
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await asyncio.sleep(0.05)
+    assert component.get_metrics()["connections"] == 2
+
+    for _, client in clients:
+        client.close()
+    response = await asyncio.wait_for(reader.read(65536), 1)
+    assert response.startswith(b"HTTP/1.1 200 ")
+    assert component.get_metrics()["accepting"]
+    assert component.get_metrics()["peak_connections"] == 2
+    assert component.server is component.servers[0] and component.server.is_serving()
+
+    # shutting down while accepting resumes closes the servers that are still starting
+    component._pause_accepting()
+    component._resume_task = asyncio.ensure_future(component._resume_accepting())
+    writer.close()
+    await component.shutdown()
+    assert component.servers
+    assert not any(server.is_serving() for server in component._closed_servers + component.servers)
+    with pytest.raises(OSError):
+        await asyncio.open_connection("127.0.0.1", port)
 
+    # without listening sockets to pause, connections over the limit are closed
+    protocol, transport = _http11_connection(limit_app, max_connections=1)
+    second = protocol.component.get_protocol(Context(), ("localhost", 4444))
+    second_transport = _MemoryTransport()
+    second.connection_made(second_transport)
+    assert not transport.closed and second_transport.closed
+    assert protocol.component.get_metrics()["connections"] == 1